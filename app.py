@@ -10,26 +10,68 @@ la conexión a la base de datos, el envío de correos, etc.
 # IMPORTS - Todas las librerías que necesitamos
 # ============================================
 # Flask: el framework web que usamos
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, send_from_directory, jsonify, g, has_request_context, has_app_context, Response, stream_with_context, make_response
+# Jinja2: cache en disco de las plantillas ya compiladas
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+# click: para los comandos de consola (flask <comando>)
+import click
 # Flask-Mail: para enviar correos electrónicos
 from flask_mail import Mail, Message
 # Werkzeug: para hashear y verificar contraseñas de forma segura
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
+# itsdangerous: para los enlaces firmados con los que un admin nuevo elige su contraseña
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+# bcrypt: solo para verificar contraseñas antiguas creadas en PHP ($2y$); opcional
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
 # MySQL: para conectarnos a la base de datos
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, errorcode
 # functools: para crear decoradores (como @login_required)
-from functools import wraps
+from functools import wraps, lru_cache
 # os: para leer variables de entorno
 import os
+# json y uuid: para los datos y el token de cada correo en la cola (y el id de cada request)
+import json
+import uuid
+# hashlib: para la versión (ETag) de los catálogos en memoria
+import hashlib
+# threading y queue: para el pool de conexiones y los hilos de la cola de correos
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as TiempoAgotado
+from time import monotonic, sleep, perf_counter
+# hmac: para comparar el token de /admin/metricas sin filtrar información por tiempos
+import hmac
+# logging: para los mensajes de la aplicación (niveles, request_id, escritura en otro hilo)
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import contextlib
+import copy
+import sys
+# fcntl: candado del directorio donde los workers de gunicorn juntan sus métricas (no existe en Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# mimetypes: tipo de los archivos estáticos precomprimidos (.gz/.br)
+import mimetypes
 # datetime: para trabajar con fechas y horas
-from datetime import datetime, timedelta, time
-# ReportLab: para generar PDFs (aunque ya no lo usamos mucho)
+from datetime import datetime, timedelta, time, timezone
+# ReportLab: para generar el PDF de las cotizaciones
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
-from io import BytesIO
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from io import BytesIO, StringIO
+# csv y zlib: para exportar citas y cotizaciones (CSV y páginas del PDF comprimidas)
+import csv
+import zlib
 # dotenv: para cargar variables de entorno desde archivo .env
 from dotenv import load_dotenv
 
@@ -46,6 +88,447 @@ app = Flask(__name__)
 # Si alguien la obtiene, podría falsificar sesiones, así que es importante
 app.secret_key = os.environ.get('SECRET_KEY', 'vedx ykjx swwe nmue')
 
+# ============================================
+# CONFIGURACIÓN DE LOGS
+# ============================================
+# En lugar de print() usamos el módulo logging:
+# - Cada mensaje tiene un nivel (DEBUG, INFO, WARNING, ERROR). Con LOG_LEVEL=INFO
+#   las llamadas a logger.debug() se descartan sin armar el texto.
+# - Los mensajes se escriben con %s y argumentos (no f-strings) para que el
+#   texto solo se arme si el mensaje de verdad se va a escribir.
+# - El request solo deja el mensaje en una cola; un hilo aparte lo escribe en
+#   la consola, así una consola lenta no frena a los requests.
+# - Cada línea lleva el request_id, para seguir todo lo que pasó en un request.
+LOG_CONFIG = {
+    'nivel': os.environ.get('LOG_LEVEL', 'INFO').upper(),  # DEBUG, INFO, WARNING o ERROR
+    'formato': os.environ.get('LOG_FORMAT', 'texto').lower()  # 'texto' o 'json' (una línea JSON por mensaje)
+}
+
+class FiltroRequestId(logging.Filter):
+    """Agrega el request_id a cada mensaje ('-' si no viene de un request)."""
+    
+    def filter(self, record):
+        record.request_id = g.get('request_id', '-') if has_app_context() else '-'
+        return True
+
+class ManejadorCola(QueueHandler):
+    """
+    Deja los mensajes en la cola de logs.
+    
+    Arma el texto del mensaje en el hilo que lo genera (los argumentos podrían
+    cambiar después), pero el formato final y la escritura los hace el hilo
+    de QueueListener.
+    """
+    
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class FormatoJSON(logging.Formatter):
+    """Formato de una línea JSON por mensaje, para mandar los logs a un buscador de logs."""
+    
+    def format(self, record):
+        datos = {
+            'fecha': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'hilo': record.threadName,
+            'mensaje': record.getMessage()
+        }
+        if record.exc_text:
+            datos['excepcion'] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+_manejador_consola = logging.StreamHandler(sys.stdout)
+if LOG_CONFIG['formato'] == 'json':
+    _manejador_consola.setFormatter(FormatoJSON())
+else:
+    _manejador_consola.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s [%(request_id)s] %(message)s'))
+
+_cola_logs = queue.SimpleQueue()
+_manejador_cola = ManejadorCola(_cola_logs)
+_manejador_cola.addFilter(FiltroRequestId())
+
+logger = logging.getLogger('taller')
+logger.setLevel(getattr(logging, LOG_CONFIG['nivel'], logging.INFO))
+logger.addHandler(_manejador_cola)
+logger.propagate = False
+
+# Hilo que escribe los logs; al salir se vacía la cola antes de terminar
+escritor_logs = QueueListener(_cola_logs, _manejador_consola)
+escritor_logs.start()
+
+def reiniciar_logs_tras_fork():
+    """
+    El hilo escritor no pasa al proceso hijo de un fork: se arma una cola y
+    un hilo nuevos (si no, los mensajes del hijo se quedarían en la cola).
+    """
+    global escritor_logs
+    cola = queue.SimpleQueue()
+    _manejador_cola.queue = cola
+    escritor_logs = QueueListener(cola, _manejador_consola)
+    escritor_logs.start()
+
+def detener_logs():
+    escritor_logs.stop()
+
+atexit.register(detener_logs)
+
+def request_id_valido(valor):
+    """Acepta el X-Request-ID de un proxy solo si es corto y sin caracteres raros."""
+    return bool(valor) and len(valor) <= 64 and all(c.isalnum() or c in '-_.' for c in valor)
+
+@app.before_request
+def asignar_request_id():
+    """Le da un id a cada request (o usa el que mandó el proxy en X-Request-ID)."""
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if request_id_valido(request_id) else uuid.uuid4().hex[:16]
+
+@app.after_request
+def agregar_request_id(response):
+    """Regresa el request_id en la respuesta para poder buscarlo en los logs."""
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+# ============================================
+# MÉTRICAS DE RENDIMIENTO
+# ============================================
+# Cada request mide su duración, cuántas consultas hizo a la BD y cuánto
+# tiempo pasó en ellas; la cola de correos mide cuánto tarda cada envío.
+# Todo se acumula en memoria (por proceso) y se expone en /admin/metricas
+# en formato de texto de Prometheus, además del header Server-Timing.
+# Con varios workers (gunicorn) cada proceso guarda sus números en
+# METRICAS_DIR y /admin/metricas los suma (ver MetricasCompartidas).
+METRICAS_CONFIG = {
+    # Agregar el header Server-Timing a las respuestas (deja ver el tiempo de BD desde el navegador)
+    'server_timing': os.environ.get('METRICAS_SERVER_TIMING', 'True').lower() in ['true', '1', 'yes'],
+    # Token para que Prometheus lea /admin/metricas sin sesión (Authorization: Bearer <token>)
+    'token': os.environ.get('METRICAS_TOKEN', ''),
+    # Si un request hace más consultas que esto se registra un warning (posible N+1)
+    'umbral_consultas': int(os.environ.get('METRICAS_UMBRAL_CONSULTAS', 50)),
+    # Carpeta donde cada worker guarda sus métricas para sumarlas (vacío: solo las de este proceso)
+    'directorio': os.environ.get('METRICAS_DIR', ''),
+    # Cada cuántos segundos, como mucho, un worker guarda sus métricas en esa carpeta
+    'intervalo': float(os.environ.get('METRICAS_INTERVALO', 5))
+}
+
+class MetricasRendimiento:
+    """
+    Histogramas y contadores en memoria, compartidos por todos los hilos.
+    
+    - Duración de cada request por endpoint y método (histograma).
+    - Requests por endpoint, método y código de respuesta.
+    - Consultas a la BD por request y tiempo de BD por request, por endpoint.
+    - Duración de cada envío de correo por tipo y resultado.
+    
+    Los endpoints se identifican por el nombre de la vista (no por la URL)
+    para que /admin/cotizacion/1, /admin/cotizacion/2... cuenten juntos.
+    """
+    
+    BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    BUCKETS_CONSULTAS = (1, 2, 5, 10, 20, 50, 100, 200)
+    
+    HISTOGRAMAS = {
+        'taller_http_request_duration_seconds': ('Duración de los requests por endpoint', BUCKETS_SEGUNDOS),
+        'taller_db_queries_per_request': ('Consultas a la BD por request', BUCKETS_CONSULTAS),
+        'taller_db_time_per_request_seconds': ('Tiempo en la BD por request', BUCKETS_SEGUNDOS),
+        'taller_correo_envio_duration_seconds': ('Duración del envío SMTP de cada correo', BUCKETS_SEGUNDOS),
+        'taller_password_hash_queue_seconds': ('Tiempo en cola antes de verificar o generar un hash de contraseña', BUCKETS_SEGUNDOS),
+        'taller_password_hash_duration_seconds': ('Duración de la verificación o generación de un hash de contraseña', BUCKETS_SEGUNDOS)
+    }
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histogramas = {nombre: {} for nombre in self.HISTOGRAMAS}  # {nombre: {etiquetas: [cuentas, suma, total]}}
+        self._requests = {}  # {(endpoint, metodo, codigo): total}
+    
+    def _observar(self, nombre, etiquetas, valor):
+        buckets = self.HISTOGRAMAS[nombre][1]
+        serie = self._histogramas[nombre].get(etiquetas)
+        if serie is None:
+            serie = self._histogramas[nombre][etiquetas] = [[0] * len(buckets), 0.0, 0]
+        for i, limite in enumerate(buckets):
+            if valor <= limite:
+                serie[0][i] += 1
+                break
+        serie[1] += valor
+        serie[2] += 1
+    
+    def registrar_request(self, endpoint, metodo, codigo, duracion, consultas, tiempo_db):
+        with self._lock:
+            self._observar('taller_http_request_duration_seconds', (('endpoint', endpoint), ('method', metodo)), duracion)
+            self._observar('taller_db_queries_per_request', (('endpoint', endpoint),), consultas)
+            self._observar('taller_db_time_per_request_seconds', (('endpoint', endpoint),), tiempo_db)
+            llave = (endpoint, metodo, str(codigo))
+            self._requests[llave] = self._requests.get(llave, 0) + 1
+    
+    def registrar_correo(self, tipo, duracion, resultado):
+        with self._lock:
+            self._observar('taller_correo_envio_duration_seconds', (('tipo', tipo), ('resultado', resultado)), duracion)
+    
+    def registrar_hash(self, operacion, espera, duracion):
+        with self._lock:
+            self._observar('taller_password_hash_queue_seconds', (('operacion', operacion),), espera)
+            self._observar('taller_password_hash_duration_seconds', (('operacion', operacion),), duracion)
+    
+    def estado(self):
+        """Copia de los histogramas y contadores que se puede guardar como JSON (ver MetricasCompartidas)."""
+        with self._lock:
+            return {
+                'histogramas': {nombre: [[etiquetas, cuentas[:], suma, total]
+                                         for etiquetas, (cuentas, suma, total) in series.items()]
+                                for nombre, series in self._histogramas.items() if series},
+                'requests': [[*llave, total] for llave, total in self._requests.items()]
+            }
+    
+    def sumar(self, estado):
+        """Agrega a estas métricas las de otro proceso (lo que regresa estado())."""
+        with self._lock:
+            for nombre, series in estado.get('histogramas', {}).items():
+                if nombre not in self._histogramas:
+                    continue  # Métrica que ya no existe
+                buckets = self.HISTOGRAMAS[nombre][1]
+                for etiquetas, cuentas, suma, total in series:
+                    if len(cuentas) != len(buckets):
+                        continue  # Guardada con otros buckets
+                    llave = tuple(tuple(par) for par in etiquetas)
+                    serie = self._histogramas[nombre].get(llave)
+                    if serie is None:
+                        serie = self._histogramas[nombre][llave] = [[0] * len(buckets), 0.0, 0]
+                    serie[0] = [a + b for a, b in zip(serie[0], cuentas)]
+                    serie[1] += suma
+                    serie[2] += total
+            for endpoint, metodo, codigo, total in estado.get('requests', []):
+                llave = (endpoint, metodo, codigo)
+                self._requests[llave] = self._requests.get(llave, 0) + total
+    
+    @staticmethod
+    def _etiquetas(pares):
+        if not pares:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pares) + '}'
+    
+    def exportar(self, extra=None):
+        """Regresa todas las métricas en el formato de texto de Prometheus (0.0.4)."""
+        lineas = []
+        with self._lock:
+            for nombre, (ayuda, buckets) in self.HISTOGRAMAS.items():
+                lineas.append(f'# HELP {nombre} {ayuda}')
+                lineas.append(f'# TYPE {nombre} histogram')
+                for etiquetas, (cuentas, suma, total) in sorted(self._histogramas[nombre].items()):
+                    acumulado = 0
+                    for limite, cuenta in zip(buckets, cuentas):
+                        acumulado += cuenta
+                        lineas.append(f'{nombre}_bucket{self._etiquetas(etiquetas + (("le", limite),))} {acumulado}')
+                    lineas.append(f'{nombre}_bucket{self._etiquetas(etiquetas + (("le", "+Inf"),))} {total}')
+                    lineas.append(f'{nombre}_sum{self._etiquetas(etiquetas)} {suma:.6f}')
+                    lineas.append(f'{nombre}_count{self._etiquetas(etiquetas)} {total}')
+            lineas.append('# HELP taller_http_requests_total Requests atendidos por endpoint, método y código')
+            lineas.append('# TYPE taller_http_requests_total counter')
+            for (endpoint, metodo, codigo), total in sorted(self._requests.items()):
+                etiquetas = (('endpoint', endpoint), ('method', metodo), ('status', codigo))
+                lineas.append(f'taller_http_requests_total{self._etiquetas(etiquetas)} {total}')
+        for nombre, (ayuda, valor) in (extra or {}).items():
+            lineas.append(f'# HELP {nombre} {ayuda}')
+            lineas.append(f'# TYPE {nombre} gauge')
+            lineas.append(f'{nombre} {valor}')
+        return '\n'.join(lineas) + '\n'
+
+metricas = MetricasRendimiento()
+
+class MetricasCompartidas:
+    """
+    Junta las métricas de todos los workers de gunicorn.
+    
+    Cada worker tiene su propio MetricasRendimiento, así que sin esto
+    /admin/metricas regresaría los números de un worker al azar en cada
+    lectura. Con METRICAS_DIR:
+    - Cada proceso guarda su estado en <pid>.json después de un request (a lo
+      más cada METRICAS_INTERVALO segundos) y al terminar.
+    - /admin/metricas suma los archivos de todos los procesos.
+    - Cuando un worker termina, el proceso principal pasa sus números a
+      finalizados.json (hook child_exit de gunicorn.conf.py), así los
+      contadores no bajan cuando gunicorn reinicia un worker.
+    Los gauges (conexiones prestadas, etc.) se suman solo de los workers vivos.
+    """
+    
+    FINALIZADOS = 'finalizados.json'
+    
+    def __init__(self, directorio, intervalo=5):
+        self.directorio = directorio
+        self._intervalo = intervalo
+        self._guardado_en = 0.0
+        self._lock = threading.Lock()
+    
+    @property
+    def activo(self):
+        return bool(self.directorio) and fcntl is not None
+    
+    def _ruta(self, nombre):
+        return os.path.join(self.directorio, nombre)
+    
+    @contextlib.contextmanager
+    def _candado(self, modo):
+        """Candado entre procesos: compartido para leer, exclusivo para mover archivos."""
+        with open(self._ruta('.candado'), 'a') as archivo:
+            fcntl.flock(archivo, modo)
+            try:
+                yield
+            finally:
+                fcntl.flock(archivo, fcntl.LOCK_UN)
+    
+    def _escribir(self, nombre, datos):
+        temporal = self._ruta(f'.{nombre}.{os.getpid()}.tmp')
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            json.dump(datos, archivo)
+        os.replace(temporal, self._ruta(nombre))  # Quien lea ve el archivo anterior o el nuevo, nunca uno a medias
+    
+    def _leer(self, nombre):
+        try:
+            with open(self._ruta(nombre), encoding='utf-8') as archivo:
+                return json.load(archivo)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning("Métricas ilegibles en %s: %s", nombre, e)
+            return None
+    
+    def guardar(self, instantaneas, forzar=False):
+        """Guarda el estado de este proceso (si pasó el intervalo, o siempre con forzar)."""
+        if not self.activo or (not forzar and monotonic() - self._guardado_en < self._intervalo):
+            return
+        if not self._lock.acquire(blocking=forzar):
+            return  # Otro hilo de este proceso lo está guardando
+        try:
+            self._guardado_en = monotonic()
+            estado = metricas.estado()
+            if not estado['histogramas'] and not estado['requests']:
+                return  # Proceso que no atendió nada (por ejemplo, el principal de gunicorn)
+            estado['instantaneas'] = instantaneas
+            os.makedirs(self.directorio, exist_ok=True)
+            self._escribir(f'{os.getpid()}.json', estado)
+        except OSError as e:
+            logger.warning("No se pudieron guardar las métricas en %s: %s", self.directorio, e)
+        finally:
+            self._lock.release()
+    
+    def combinar(self):
+        """Regresa (MetricasRendimiento con la suma de todos, {gauge: suma}, procesos vivos)."""
+        total = MetricasRendimiento()
+        instantaneas = {}
+        vivos = 0
+        with self._candado(fcntl.LOCK_SH):
+            for nombre in sorted(os.listdir(self.directorio)):
+                if not nombre.endswith('.json'):
+                    continue
+                estado = self._leer(nombre)
+                if estado is None:
+                    continue
+                total.sumar(estado)
+                if nombre != self.FINALIZADOS:
+                    vivos += 1
+                    for gauge, valor in estado.get('instantaneas', {}).items():
+                        instantaneas[gauge] = instantaneas.get(gauge, 0) + valor
+        return total, instantaneas, vivos
+    
+    def retirar(self, pid):
+        """Pasa los números de un worker que terminó a finalizados.json (corre en el proceso principal)."""
+        if not self.activo:
+            return
+        try:
+            with self._candado(fcntl.LOCK_EX):
+                estado = self._leer(f'{pid}.json')
+                if estado is None:
+                    return
+                finalizados = MetricasRendimiento()
+                finalizados.sumar(self._leer(self.FINALIZADOS) or {})
+                finalizados.sumar(estado)
+                self._escribir(self.FINALIZADOS, finalizados.estado())
+                os.remove(self._ruta(f'{pid}.json'))
+        except OSError as e:
+            logger.warning("No se pudieron juntar las métricas del worker %s: %s", pid, e)
+    
+    def limpiar(self):
+        """Borra las métricas de una ejecución anterior (al arrancar, como cualquier contador en memoria)."""
+        if not self.activo:
+            return
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            with self._candado(fcntl.LOCK_EX):
+                for nombre in os.listdir(self.directorio):
+                    if nombre.endswith(('.json', '.tmp')):
+                        os.remove(self._ruta(nombre))
+        except OSError as e:
+            logger.warning("No se pudo limpiar %s: %s", self.directorio, e)
+
+metricas_compartidas = MetricasCompartidas(METRICAS_CONFIG['directorio'], METRICAS_CONFIG['intervalo'])
+
+class CursorMedido:
+    """
+    Envoltura del cursor que mide cada execute/executemany.
+    
+    Suma el número de consultas y el tiempo en g (del request, o del
+    app_context de los hilos en segundo plano). Todo lo demás se delega
+    al cursor real, igual que ConexionPool con la conexión.
+    """
+    
+    def __init__(self, cursor):
+        self._cursor = cursor
+    
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def _medir(self, metodo, *args, **kwargs):
+        inicio = perf_counter()
+        try:
+            return metodo(*args, **kwargs)
+        finally:
+            if has_app_context():
+                g.db_consultas = g.get('db_consultas', 0) + 1
+                g.db_tiempo = g.get('db_tiempo', 0.0) + (perf_counter() - inicio)
+    
+    def execute(self, *args, **kwargs):
+        return self._medir(self._cursor.execute, *args, **kwargs)
+    
+    def executemany(self, *args, **kwargs):
+        return self._medir(self._cursor.executemany, *args, **kwargs)
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_request = perf_counter()
+    g.db_consultas = 0
+    g.db_tiempo = 0.0
+
+@app.after_request
+def registrar_medicion(response):
+    """Guarda las métricas del request y agrega el header Server-Timing."""
+    inicio = g.get('inicio_request')
+    if inicio is None:
+        return response
+    duracion = perf_counter() - inicio
+    consultas = g.get('db_consultas', 0)
+    tiempo_db = g.get('db_tiempo', 0.0)
+    endpoint = request.endpoint or 'sin_ruta'
+    metricas.registrar_request(endpoint, request.method, response.status_code, duracion, consultas, tiempo_db)
+    if consultas > METRICAS_CONFIG['umbral_consultas']:
+        logger.warning("%s hizo %s consultas a la BD en un solo request (%.1f ms)", endpoint, consultas, tiempo_db * 1000)
+    if METRICAS_CONFIG['server_timing']:
+        response.headers.add('Server-Timing',
+                             f'db;dur={tiempo_db * 1000:.1f};desc="{consultas} consultas", app;dur={duracion * 1000:.1f}')
+    guardar_metricas_proceso()
+    return response
+
 # ============================================
 # CONFIGURACIÓN DE CORREO ELECTRÓNICO
 # ============================================
@@ -63,20 +546,267 @@ app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', 'cesar
 # Inicializamos el objeto Mail con la configuración de Flask
 mail = Mail(app)
 
+# Configuración de la cola de correos.
+# Los correos no se envían dentro del request (el SMTP puede tardar segundos):
+# se guardan en la tabla correos_pendientes y unos hilos en segundo plano los envían.
+CORREO_CONFIG = {
+    'workers': int(os.environ.get('CORREO_WORKERS', 2)),  # Hilos que envían correos
+    'intentos_max': int(os.environ.get('CORREO_INTENTOS_MAX', 5)),  # Intentos antes de marcarlo como fallido
+    'backoff_base': int(os.environ.get('CORREO_BACKOFF_BASE', 30)),  # Segundos de espera tras el primer fallo (se duplica)
+    'intervalo': float(os.environ.get('CORREO_INTERVALO', 15)),  # Cada cuánto se revisa la tabla si nadie avisa
+    'lote': int(os.environ.get('CORREO_LOTE', 20))  # Correos que toma un hilo en cada vuelta
+}
+
 # ============================================
 # CONFIGURACIÓN DE BASE DE DATOS
 # ============================================
 # Aquí están los datos de conexión a MySQL
 # En producción, esto debería estar en variables de entorno por seguridad
+# (se pueden cambiar con DB_HOST, DB_PORT, DB_NAME, DB_USER y DB_PASSWORD)
 DB_CONFIG = {
-    'host': 'localhost',  # El servidor de MySQL (normalmente localhost)
-    'database': 'servicio_automotriz',  # El nombre de nuestra base de datos
-    'user': 'root',  # Usuario de MySQL
-    'password': 'Baby20150531',  # Contraseña de MySQL
+    'host': os.environ.get('DB_HOST', 'localhost'),  # El servidor de MySQL (normalmente localhost)
+    'port': int(os.environ.get('DB_PORT', 3306)),  # Puerto de MySQL
+    'database': os.environ.get('DB_NAME', 'servicio_automotriz'),  # El nombre de nuestra base de datos
+    'user': os.environ.get('DB_USER', 'root'),  # Usuario de MySQL
+    'password': os.environ.get('DB_PASSWORD', 'Baby20150531'),  # Contraseña de MySQL
     'charset': 'utf8mb4',  # Codificación para soportar emojis y caracteres especiales
     'collation': 'utf8mb4_general_ci'  # Reglas de comparación de caracteres
 }
 
+# Configuración del pool de conexiones.
+# Abrir una conexión nueva (TCP + autenticación) en cada request es lo más lento
+# de todo el sistema, así que reutilizamos conexiones ya abiertas.
+DB_POOL_CONFIG = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),  # Máximo de conexiones abiertas a la vez
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),  # Segundos que se espera por una conexión libre
+    'recycle': int(os.environ.get('DB_POOL_RECYCLE', 3600)),  # Segundos de vida máxima de una conexión
+    'ping_after': int(os.environ.get('DB_POOL_PING_AFTER', 30))  # Si estuvo inactiva más de esto, se verifica con ping
+}
+
+class ConexionPool:
+    """
+    Envoltura de una conexión MySQL que pertenece al pool.
+    
+    Se comporta igual que la conexión normal (cursor, commit, rollback...),
+    pero close() la devuelve al pool en lugar de cerrarla.
+    Si está ligada a un request, close() no hace nada: la conexión se
+    devuelve al pool automáticamente al terminar el request.
+    """
+    
+    def __init__(self, pool, conexion, creada_en, ligada_a_request=False):
+        self._pool = pool
+        self._conexion = conexion
+        self._creada_en = creada_en
+        self._ligada_a_request = ligada_a_request
+        self._liberada = False
+    
+    def __getattr__(self, nombre):
+        # Todo lo que no definimos aquí se delega a la conexión real
+        return getattr(self._conexion, nombre)
+    
+    def close(self):
+        if not self._ligada_a_request:
+            self._liberar()
+    
+    def _liberar(self):
+        if not self._liberada:
+            self._liberada = True
+            self._pool.devolver(self._conexion, self._creada_en)
+    
+    def descartar(self):
+        """Cierra la conexión sin devolverla al pool, aunque tenga filas sin leer (ver PoolConexiones.cortar)."""
+        if not self._liberada:
+            self._liberada = True
+            self._pool.cortar(self._conexion)
+
+class PoolConexiones:
+    """
+    Pool de conexiones MySQL compartido por todos los hilos del servidor.
+    
+    - Nunca hay más de pool_size conexiones prestadas; si no hay libres,
+      se espera hasta timeout segundos.
+    - Las conexiones que llevan mucho tiempo abiertas se reciclan y las que
+      estuvieron inactivas se verifican con ping antes de prestarlas.
+    - Lleva métricas (prestadas, en espera, tiempo de espera) para monitoreo.
+    """
+    
+    def __init__(self, config, pool_size=10, timeout=10, recycle=3600, ping_after=30):
+        self._config = config
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._recycle = recycle
+        self._ping_after = ping_after
+        # LIFO para reutilizar primero las conexiones usadas más recientemente
+        self._libres = queue.LifoQueue()
+        self._cupos = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._heredadas = []  # Colas de conexiones del proceso padre (ver reiniciar_tras_fork)
+        self._metricas = {
+            'prestadas': 0,
+            'en_espera': 0,
+            'creadas': 0,
+            'recicladas': 0,
+            'esperas_agotadas': 0,
+            'total_prestamos': 0,
+            'tiempo_espera_total_ms': 0.0,
+            'tiempo_espera_max_ms': 0.0
+        }
+    
+    def _crear(self):
+        conexion = mysql.connector.connect(**self._config)
+        with self._lock:
+            self._metricas['creadas'] += 1
+        return conexion, monotonic()
+    
+    def _descartar(self, conexion):
+        with self._lock:
+            self._metricas['recicladas'] += 1
+        try:
+            conexion.close()
+        except Exception:
+            pass
+    
+    def _tomar_libre(self):
+        """Saca una conexión libre y sana del pool, o None si no hay."""
+        while True:
+            try:
+                conexion, creada_en, usada_en = self._libres.get_nowait()
+            except queue.Empty:
+                return None
+            ahora = monotonic()
+            if ahora - creada_en > self._recycle:
+                # Demasiado vieja: el servidor pudo haberla cerrado (wait_timeout)
+                self._descartar(conexion)
+                continue
+            if ahora - usada_en > self._ping_after:
+                try:
+                    conexion.ping(reconnect=False)
+                except Exception:
+                    self._descartar(conexion)
+                    continue
+            return conexion, creada_en
+    
+    def obtener(self, ligada_a_request=False):
+        """
+        Presta una conexión del pool.
+        
+        Lanza mysql.connector.errors.PoolError si no se libera ninguna
+        conexión antes del timeout.
+        """
+        inicio = monotonic()
+        with self._lock:
+            self._metricas['en_espera'] += 1
+        obtuvo_cupo = self._cupos.acquire(timeout=self._timeout)
+        espera_ms = (monotonic() - inicio) * 1000
+        with self._lock:
+            self._metricas['en_espera'] -= 1
+            self._metricas['tiempo_espera_total_ms'] += espera_ms
+            self._metricas['tiempo_espera_max_ms'] = max(self._metricas['tiempo_espera_max_ms'], espera_ms)
+            if not obtuvo_cupo:
+                self._metricas['esperas_agotadas'] += 1
+        if not obtuvo_cupo:
+            raise mysql.connector.errors.PoolError(
+                f"No hay conexiones libres en el pool después de {self._timeout} segundos")
+        
+        try:
+            libre = self._tomar_libre()
+            conexion, creada_en = libre if libre else self._crear()
+        except Exception:
+            self._cupos.release()
+            raise
+        
+        with self._lock:
+            self._metricas['prestadas'] += 1
+            self._metricas['total_prestamos'] += 1
+        return ConexionPool(self, conexion, creada_en, ligada_a_request)
+    
+    def devolver(self, conexion, creada_en):
+        """Regresa una conexión al pool, descartando la transacción pendiente."""
+        try:
+            # Si quedó algo sin commit (por un error), lo deshacemos para que
+            # el siguiente request empiece limpio y sin snapshot viejo
+            conexion.rollback()
+            self._libres.put((conexion, creada_en, monotonic()))
+        except Exception:
+            self._descartar(conexion)
+        finally:
+            with self._lock:
+                self._metricas['prestadas'] -= 1
+            self._cupos.release()
+    
+    def cortar(self, conexion):
+        """
+        Cierra una conexión prestada sin leer lo que el servidor aún tenga por
+        mandar (una consulta sin buffer que se dejó a medias) y libera su cupo.
+        
+        rollback() y close() de mysql-connector primero leen todas las filas
+        pendientes (el conector en Python puro además las junta en memoria).
+        En su lugar se cierra el socket con shutdown(); la extensión en C no
+        lo tiene, así que se le pide al servidor que termine esa conexión con
+        KILL (desde una conexión aparte) antes de cerrarla.
+        """
+        try:
+            if hasattr(conexion, 'shutdown'):
+                conexion.shutdown()
+            else:
+                verdugo = mysql.connector.connect(**self._config)
+                try:
+                    cursor = verdugo.cursor()
+                    cursor.execute("KILL %s", (conexion.connection_id,))
+                    cursor.close()
+                finally:
+                    verdugo.close()
+                conexion.close()
+        except Exception as e:
+            logger.warning("Error cortando una conexión con filas sin leer: %s", e)
+        finally:
+            with self._lock:
+                self._metricas['recicladas'] += 1
+                self._metricas['prestadas'] -= 1
+            self._cupos.release()
+    
+    def cerrar(self):
+        """Cierra las conexiones libres (al apagar, o antes de hacer fork de los workers)."""
+        while True:
+            try:
+                conexion, _, _ = self._libres.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conexion.close()
+            except Exception:
+                pass
+    
+    def reiniciar_tras_fork(self):
+        """
+        En el proceso hijo de un fork: empieza con un pool vacío.
+        
+        Las conexiones heredadas no se cierran (close() mandaría QUIT por un
+        socket que sigue siendo del padre); solo se guardan para que nunca
+        se usen ni las recolecte el garbage collector.
+        """
+        self._heredadas.append(self._libres)
+        self._libres = queue.LifoQueue()
+        self._cupos = threading.BoundedSemaphore(self._pool_size)
+        self._lock = threading.Lock()
+        self._metricas['prestadas'] = 0
+        self._metricas['en_espera'] = 0
+    
+    def metricas(self):
+        """Retorna una copia de las métricas actuales del pool."""
+        with self._lock:
+            datos = dict(self._metricas)
+        datos['pool_size'] = self._pool_size
+        datos['libres'] = self._libres.qsize()
+        prestamos = datos['total_prestamos'] + datos['esperas_agotadas']
+        datos['tiempo_espera_promedio_ms'] = round(datos['tiempo_espera_total_ms'] / prestamos, 3) if prestamos else 0.0
+        datos['tiempo_espera_total_ms'] = round(datos['tiempo_espera_total_ms'], 3)
+        datos['tiempo_espera_max_ms'] = round(datos['tiempo_espera_max_ms'], 3)
+        return datos
+
+# Pool global. No abre ninguna conexión hasta que se necesita la primera.
+db_pool = PoolConexiones(DB_CONFIG, **DB_POOL_CONFIG)
+
 def get_db_connection():
     """
     Función helper para obtener una conexión a la base de datos.
@@ -84,14 +814,32 @@ def get_db_connection():
     Básicamente, cada vez que necesitamos hacer algo en la BD,
     llamamos a esta función para obtener una conexión.
     Si hay un error, retorna None en lugar de crashear.
+    
+    Las conexiones salen del pool. Dentro de un request siempre se
+    devuelve la misma conexión (guardada en g), así que llamar a esta
+    función varias veces en un request no abre conexiones nuevas.
+    La conexión regresa al pool cuando termina el request.
     """
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
+        if has_request_context():
+            conn = g.get('db_conn')
+            if conn is None:
+                conn = db_pool.obtener(ligada_a_request=True)
+                g.db_conn = conn
+            return conn
+        # Fuera de un request (scripts, hilos en segundo plano): close() la devuelve al pool
+        return db_pool.obtener()
     except Error as e:
-        print(f"Error conectando a MySQL: {e}")
+        logger.error("Error conectando a MySQL: %s", e)
         return None
 
+@app.teardown_appcontext
+def liberar_conexion_db(exception=None):
+    """Devuelve al pool la conexión del request (si se usó alguna)."""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn._liberar()
+
 def get_cursor(conn):
     """
     Función helper para obtener un cursor de la base de datos.
@@ -101,17 +849,54 @@ def get_cursor(conn):
     en lugar de tuplas, lo cual es más fácil de trabajar.
     buffered=True evita el error "Unread result found" cuando hacemos
     múltiples queries seguidos.
+    El cursor va envuelto en CursorMedido para contar consultas y tiempo de BD.
     """
     try:
         cursor = conn.cursor(dictionary=True, buffered=True)
-        return cursor
+        return CursorMedido(cursor)
     except Exception as e:
-        print(f"[ERROR] Error creando cursor: {e}")
+        logger.error("Error creando cursor: %s", e)
         raise
 
+# Datos del usuario con sesión iniciada que necesitan las páginas de citas y
+# cotizaciones. La misma consulta confirma que el usuario sigue existiendo,
+# así que no se guarda entre requests (otro proceso pudo eliminarlo y el
+# usuario_id iría a parar a un INSERT); dentro del request se guarda en g.
+CONSULTA_PERFIL_USUARIO = """SELECT u.usuario_id, u.username, u.nombre, u.email, u.telefono, u.activo,
+                                    r.nombre AS rol_nombre
+                             FROM usuarios u
+                             INNER JOIN roles r ON u.rol_id = r.rol_id
+                             WHERE u.usuario_id = %s"""
+
+def perfil_usuario_actual(cursor):
+    """
+    Perfil del usuario con sesión iniciada, o None si no hay sesión o el
+    usuario ya no existe. Se consulta a lo más una vez por request.
+    """
+    if 'perfil_usuario' in g:
+        return g.perfil_usuario
+    perfil = None
+    try:
+        usuario_id = int(session['usuario_id']) if session.get('usuario_id') else None
+    except (ValueError, TypeError):
+        logger.warning("usuario_id inválido en la sesión: %r", session.get('usuario_id'))
+        usuario_id = None
+    if usuario_id:
+        try:
+            cursor.execute(CONSULTA_PERFIL_USUARIO, (usuario_id,))
+            perfil = cursor.fetchone()
+        except Error as e:
+            # Sin perfil las páginas siguen funcionando con los datos de la sesión
+            logger.error("Error obteniendo el perfil del usuario %s: %s", usuario_id, e)
+            return None
+        if perfil is None:
+            logger.warning("Usuario ID %s de la sesión no existe en la BD", usuario_id)
+    g.perfil_usuario = perfil
+    return perfil
+
 def obtener_datos_usuario_logueado(cursor, session):
     """
-    Obtiene los datos del usuario logueado desde la sesión y la base de datos.
+    Obtiene los datos del usuario logueado desde la sesión y su perfil en la BD.
     
     Returns:
         dict: Diccionario con id, nombre, email y telefono del usuario, o None si no está logueado
@@ -120,96 +905,462 @@ def obtener_datos_usuario_logueado(cursor, session):
     if not usuario_id:
         return None
     
-    usuario_logueado = {
+    perfil = perfil_usuario_actual(cursor) or {}
+    return {
         'usuario_id': usuario_id,
         'id': usuario_id,  # Compatibilidad con templates antiguos
-        'nombre': session.get('nombre', ''),
-        'email': session.get('email', ''),
-        'telefono': None
+        'nombre': perfil.get('nombre') or session.get('nombre', ''),
+        'email': perfil.get('email') or session.get('email', ''),
+        'telefono': perfil.get('telefono')
     }
-    
-    # Obtener teléfono de la BD
-    try:
-        cursor.execute("SELECT telefono FROM usuarios WHERE usuario_id = %s", (usuario_id,))
-        usuario_data = cursor.fetchone()
-        if usuario_data:
-            usuario_logueado['telefono'] = usuario_data.get('telefono', '')
-    except Error:
-        pass
-    
-    return usuario_logueado
 
-def obtener_o_crear_cliente(cursor, conn, nombre, telefono=None, email=None):
+def obtener_o_crear_cliente(cursor, nombre, telefono=None, email=None):
     """
     Función helper para obtener un cliente existente o crear uno nuevo.
     
-    Busca un cliente por email (si se proporciona) o por nombre y teléfono.
-    Si no existe, lo crea. Retorna el ID del cliente.
+    Con email, el cliente se resuelve en una sola sentencia:
+    INSERT ... ON DUPLICATE KEY UPDATE sobre la llave única del correo.
+    Si ya existe se actualizan su nombre y teléfono (el teléfono solo si
+    viene uno), y LAST_INSERT_ID(cliente_id) hace que cursor.lastrowid
+    traiga el id tanto del cliente nuevo como del existente. Como decide
+    la llave única, dos envíos simultáneos con el mismo correo terminan
+    en el mismo cliente en lugar de fallar por duplicado.
+    
+    Si el correo es nuevo pero ya hay un cliente con el mismo nombre y
+    teléfono y sin correo (alguien que antes vino solo con su teléfono),
+    se le agrega el correo a ese cliente en lugar de dejar uno nuevo, así
+    su historial no se parte en dos.
+    
+    Sin email se busca por nombre y teléfono (índice
+    idx_clientes_nombre_telefono) y, si no hay, se crea.
+    
+    No hace commit: el cliente queda en la transacción del llamador.
     
     Args:
         cursor: Cursor de la base de datos
-        conn: Conexión a la base de datos
         nombre: Nombre del cliente
         telefono: Teléfono del cliente (opcional)
         email: Email del cliente (opcional)
     
     Returns:
-        int: ID del cliente (existente o recién creado)
+        int: ID del cliente (existente o recién creado), o None si hubo error
     """
-    cliente_id = None
-    
-    # Intentar buscar por email primero (más confiable)
-    if email:
-        try:
-            cursor.execute("SELECT cliente_id FROM clientes WHERE correo = %s", (email,))
+    telefono = telefono or None
+    email = email or None
+    try:
+        if email:
+            cursor.execute("""INSERT INTO clientes (nombre, telefono, correo) VALUES (%s, %s, %s)
+                              ON DUPLICATE KEY UPDATE cliente_id = LAST_INSERT_ID(cliente_id),
+                                                      nombre = VALUES(nombre),
+                                                      telefono = COALESCE(VALUES(telefono), telefono)""",
+                           (nombre, telefono, email))
+            cliente_id = cursor.lastrowid
+            # rowcount 1 = se insertó (2 o 0 = el correo ya existía; sin CLIENT_FOUND_ROWS)
+            if cursor.rowcount == 1 and telefono:
+                cursor.execute("""SELECT cliente_id FROM clientes 
+                                  WHERE nombre = %s AND telefono = %s AND correo IS NULL 
+                                  ORDER BY cliente_id LIMIT 1 FOR UPDATE""", (nombre, telefono))
+                cliente_existente = cursor.fetchone()
+                if cliente_existente:
+                    # El cliente recién insertado aún no lo usa nadie (es de esta transacción)
+                    cursor.execute("DELETE FROM clientes WHERE cliente_id = %s", (cliente_id,))
+                    cliente_id = cliente_existente['cliente_id']
+                    cursor.execute("UPDATE clientes SET correo = %s WHERE cliente_id = %s", (email, cliente_id))
+            return cliente_id
+        
+        if telefono:
+            cursor.execute("""SELECT cliente_id FROM clientes 
+                              WHERE nombre = %s AND telefono = %s 
+                              ORDER BY cliente_id LIMIT 1""", (nombre, telefono))
             cliente_existente = cursor.fetchone()
             if cliente_existente:
-                cliente_id = cliente_existente['cliente_id']
-                # Actualizar datos si han cambiado
-                cursor.execute("UPDATE clientes SET nombre = %s, telefono = %s WHERE cliente_id = %s",
-                             (nombre, telefono, cliente_id))
+                return cliente_existente['cliente_id']
+        
+        cursor.execute("INSERT INTO clientes (nombre, telefono, correo) VALUES (%s, %s, NULL)",
+                       (nombre, telefono))
+        return cursor.lastrowid
+    except Error as e:
+        logger.error("Error obteniendo o creando cliente: %s", e)
+        return None
+
+# Consultas para cargar los servicios de muchas citas/cotizaciones a la vez.
+# {ids} se reemplaza por los placeholders (%s, %s, ...) del IN.
+CONSULTAS_SERVICIOS_RELACIONADOS = {
+    'citas': """SELECT cs.cita_id AS padre_id, s.servicio_id, s.nombre 
+                FROM citas_servicios cs
+                JOIN servicios s ON cs.servicio_id = s.servicio_id
+                WHERE cs.cita_id IN ({ids})
+                ORDER BY s.nombre""",
+    'cotizaciones': """SELECT cs.cotizacion_id AS padre_id, s.servicio_id, s.nombre, cs.precio_calculado as precio_servicio
+                       FROM cotizaciones_servicios cs
+                       JOIN servicios s ON cs.servicio_id = s.servicio_id
+                       WHERE cs.cotizacion_id IN ({ids})
+                       ORDER BY s.nombre"""
+}
+MAX_IDS_POR_CONSULTA = 500  # Para no armar un IN (...) gigante
+
+def cargar_servicios_relacionados(cursor, relacion, ids):
+    """
+    Obtiene los servicios relacionados de varias citas o cotizaciones con
+    una sola consulta IN (...) (o unas pocas si hay muchísimos ids),
+    en lugar de una consulta por cada registro.
+    
+    Args:
+        cursor: Cursor de la base de datos
+        relacion: 'citas' o 'cotizaciones'
+        ids: Lista de cita_id o cotizacion_id
+    
+    Returns:
+        dict: {id: [servicios ordenados por nombre]}; los ids sin servicios traen lista vacía
+    """
+    ids_unicos = list(dict.fromkeys(ids))
+    servicios_por_id = {padre_id: [] for padre_id in ids_unicos}
+    for i in range(0, len(ids_unicos), MAX_IDS_POR_CONSULTA):
+        lote = ids_unicos[i:i + MAX_IDS_POR_CONSULTA]
+        sql = CONSULTAS_SERVICIOS_RELACIONADOS[relacion].format(ids=', '.join(['%s'] * len(lote)))
+        cursor.execute(sql, tuple(lote))
+        for fila in cursor.fetchall():
+            servicios_por_id[fila.pop('padre_id')].append(fila)
+    return servicios_por_id
+
+def agregar_servicios_relacionados(cursor, relacion, registros, campo_id):
+    """
+    Agrega la llave 'servicios_relacionados' a cada registro (cita o cotización)
+    usando cargar_servicios_relacionados(). Si falla la consulta, deja listas vacías.
+    """
+    if not registros:
+        return registros
+    try:
+        servicios_por_id = cargar_servicios_relacionados(cursor, relacion, [r[campo_id] for r in registros])
+    except Error as e:
+        logger.error("Error obteniendo servicios relacionados de %s: %s", relacion, e)
+        servicios_por_id = {}
+    for registro in registros:
+        registro['servicios_relacionados'] = servicios_por_id.get(registro[campo_id], [])
+    return registros
+
+# ============================================
+# PROPIETARIO DE CITAS Y COTIZACIONES
+# ============================================
+# Cada cita y cotización guarda en propietario_id el usuario al que pertenece.
+# Así las páginas del usuario filtran con una sola columna indexada en lugar de
+# "usuario_id = ? OR correo del cliente = ? OR email = ?", que obliga a MySQL
+# a recorrer toda la tabla.
+#
+# - Al crear una cita/cotización: es del usuario que inició sesión, o del
+#   usuario que tenga ese correo (si agendó como invitado).
+# - Al crear un usuario o cambiarle el correo: se le asignan las citas y
+#   cotizaciones sin propietario hechas con su correo.
+# - Los registros anteriores a este cambio se asignan con el comando
+#   "flask vincular-propietarios" (por lotes, se puede interrumpir y continuar).
+
+# Tablas con propietario y su llave primaria
+TABLAS_PROPIETARIO = {
+    'citas': 'cita_id',
+    'cotizaciones': 'cotizacion_id'
+}
+
+def resolver_propietario(cursor, usuario_id=None, email=None):
+    """
+    Decide a qué usuario pertenece una cita o cotización nueva.
+    
+    Si quien la hace inició sesión, es suya; si no, se busca un usuario con
+    ese correo (el de menor id si hubiera varios). Retorna el usuario_id o None.
+    """
+    if usuario_id:
+        return usuario_id
+    if not email:
+        return None
+    cursor.execute("SELECT usuario_id FROM usuarios WHERE email = %s ORDER BY usuario_id LIMIT 1", (email,))
+    fila = cursor.fetchone()
+    return fila['usuario_id'] if fila else None
+
+def vincular_registros_usuario(cursor, usuario_id, email):
+    """
+    Asigna al usuario las citas y cotizaciones sin propietario hechas con su
+    correo (por ejemplo, las que agendó como invitado antes de tener cuenta).
+    No hace commit: se llama en la misma transacción que crea o edita al usuario.
+    """
+    if not email:
+        return
+    for tabla in TABLAS_PROPIETARIO:
+        cursor.execute(f"""UPDATE {tabla} SET propietario_id = %s 
+                           WHERE propietario_id IS NULL AND email = %s""", (usuario_id, email))
+        cursor.execute(f"""UPDATE {tabla} t 
+                           INNER JOIN clientes cl ON t.cliente_id = cl.cliente_id 
+                           SET t.propietario_id = %s 
+                           WHERE t.propietario_id IS NULL AND cl.correo = %s""", (usuario_id, email))
+
+def _llave_correo(email):
+    """Normaliza un correo para compararlo como lo hace MySQL (sin distinguir mayúsculas)."""
+    return email.strip().lower() if email else None
+
+def vincular_propietarios(lote=1000, pausa=0.0, reiniciar=False):
+    """
+    Trabajo de relleno: asigna propietario_id a las citas y cotizaciones existentes.
+    
+    Recorre cada tabla en orden de llave primaria, en lotes de `lote`
+    registros. Cada lote se guarda con su propio commit junto con el último
+    id procesado (tabla trabajos_progreso), así las filas se bloquean poco
+    tiempo, se puede correr con la aplicación en uso y, si se interrumpe,
+    la siguiente ejecución continúa donde se quedó. Solo toca registros que
+    todavía no tienen propietario.
+    
+    Args:
+        lote: Registros por lote
+        pausa: Segundos de espera entre lotes (para no cargar la BD)
+        reiniciar: Si es True, empieza desde el principio
+    
+    Returns:
+        dict: {tabla: registros vinculados en esta ejecución}
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise Error("No hay conexión para vincular propietarios")
+    
+    vinculados = {}
+    try:
+        cursor = get_cursor(conn)
+        
+        # Los usuarios son pocos: se cargan una vez (el de menor id gana si repiten correo)
+        cursor.execute("""SELECT usuario_id, email FROM usuarios 
+                          WHERE email IS NOT NULL AND email <> '' 
+                          ORDER BY usuario_id DESC""")
+        usuarios_por_correo = {_llave_correo(u['email']): u['usuario_id'] for u in cursor.fetchall()}
+        conn.commit()
+        
+        for tabla, llave in TABLAS_PROPIETARIO.items():
+            trabajo = f"vincular_propietarios:{tabla}"
+            if reiniciar:
+                cursor.execute("DELETE FROM trabajos_progreso WHERE trabajo = %s", (trabajo,))
                 conn.commit()
-                return cliente_id
-        except Error as e:
-            print(f"[ERROR] Error buscando cliente por email: {e}")
+            cursor.execute("SELECT ultimo_id FROM trabajos_progreso WHERE trabajo = %s", (trabajo,))
+            progreso = cursor.fetchone()
+            ultimo_id = progreso['ultimo_id'] if progreso else 0
+            vinculados[tabla] = 0
+            logger.info("Vinculando propietarios de %s desde el id %s", tabla, ultimo_id)
+            
+            while True:
+                cursor.execute(f"""SELECT t.{llave} AS id, t.propietario_id, t.email, 
+                                          u.usuario_id, cl.correo AS cliente_correo 
+                                   FROM {tabla} t 
+                                   LEFT JOIN usuarios u ON t.usuario_id = u.usuario_id 
+                                   LEFT JOIN clientes cl ON t.cliente_id = cl.cliente_id 
+                                   WHERE t.{llave} > %s 
+                                   ORDER BY t.{llave} 
+                                   LIMIT %s""", (ultimo_id, lote))
+                filas = cursor.fetchall()
+                if not filas:
+                    break
+                
+                cambios = []
+                for fila in filas:
+                    if fila['propietario_id'] is not None:
+                        continue
+                    propietario = (fila['usuario_id']
+                                   or usuarios_por_correo.get(_llave_correo(fila['email']))
+                                   or usuarios_por_correo.get(_llave_correo(fila['cliente_correo'])))
+                    if propietario:
+                        cambios.append((propietario, fila['id']))
+                
+                if cambios:
+                    cursor.executemany(f"""UPDATE {tabla} SET propietario_id = %s 
+                                           WHERE {llave} = %s AND propietario_id IS NULL""", cambios)
+                ultimo_id = filas[-1]['id']
+                cursor.execute("""INSERT INTO trabajos_progreso (trabajo, ultimo_id) VALUES (%s, %s) 
+                                  ON DUPLICATE KEY UPDATE ultimo_id = VALUES(ultimo_id)""", (trabajo, ultimo_id))
+                conn.commit()
+                
+                vinculados[tabla] += len(cambios)
+                logger.info("%s: vinculados %s registros hasta el id %s", tabla, vinculados[tabla], ultimo_id)
+                if pausa:
+                    sleep(pausa)
+        
+        return vinculados
+    except Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+@app.cli.command('vincular-propietarios')
+@click.option('--lote', default=1000, show_default=True, help='Registros por lote.')
+@click.option('--pausa', default=0.0, show_default=True, help='Segundos de espera entre lotes.')
+@click.option('--reiniciar', is_flag=True, help='Empezar desde el principio en lugar de continuar.')
+def comando_vincular_propietarios(lote, pausa, reiniciar):
+    """Asigna propietario a las citas y cotizaciones existentes (se puede interrumpir y continuar)."""
+    vinculados = vincular_propietarios(lote=lote, pausa=pausa, reiniciar=reiniciar)
+    for tabla, total in vinculados.items():
+        click.echo(f"{tabla}: {total} registros vinculados")
+
+# ============================================
+# MIGRACIONES DE LA BASE DE DATOS
+# ============================================
+# "base de datos/servicio_automotriz.sql" instala la base desde cero. Para
+# actualizar una base que ya está en uso, cada cambio de esquema va además
+# en un archivo de "base de datos/migraciones" (NNNN_descripcion.sql) y se
+# aplica con "flask migrar". Las versiones aplicadas se guardan en la tabla
+# schema_migraciones, así cada archivo corre una sola vez.
+#
+# MySQL no tiene "ADD KEY IF NOT EXISTS", así que si una sentencia falla
+# porque la tabla, columna, índice o llave foránea ya existe (por ejemplo,
+# en una base instalada con el script ya actualizado) se toma como aplicada.
+
+CARPETA_MIGRACIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'base de datos', 'migraciones')
+
+# Errores que indican que la sentencia ya estaba aplicada
+ERRORES_YA_APLICADA = (errorcode.ER_TABLE_EXISTS_ERROR, errorcode.ER_DUP_FIELDNAME, errorcode.ER_DUP_KEYNAME,
+                       errorcode.ER_FK_DUP_NAME, errorcode.ER_DUP_KEY)
+
+def dividir_sentencias_sql(script):
+    """Separa un script SQL en sentencias (sin comentarios; respeta ';' dentro de textos)."""
+    sentencias = []
+    actual = []
+    en_texto = False
+    for linea in script.splitlines():
+        if not en_texto and (linea.strip().startswith('--') or not linea.strip()):
+            continue
+        for c in linea:
+            if c == "'":
+                en_texto = not en_texto  # '' dentro de un texto cambia dos veces: queda igual
+            if c == ';' and not en_texto:
+                sentencia = ''.join(actual).strip()
+                if sentencia:
+                    sentencias.append(sentencia)
+                actual = []
+            else:
+                actual.append(c)
+        actual.append('\n')
+    sentencia = ''.join(actual).strip()
+    if sentencia:
+        sentencias.append(sentencia)
+    return sentencias
+
+def listar_migraciones(carpeta=CARPETA_MIGRACIONES):
+    """
+    Lee los archivos de migración en orden de versión.
     
-    # Si no se encontró por email, buscar por nombre y teléfono
-    if not cliente_id and nombre and telefono:
-        try:
-            cursor.execute("SELECT cliente_id FROM clientes WHERE nombre = %s AND telefono = %s",
-                         (nombre, telefono))
-            cliente_existente = cursor.fetchone()
-            if cliente_existente:
-                cliente_id = cliente_existente['cliente_id']
-                # Actualizar email si se proporciona y no existe
-                if email:
-                    cursor.execute("UPDATE clientes SET correo = %s WHERE cliente_id = %s",
-                                 (email, cliente_id))
-                    conn.commit()
-                return cliente_id
-        except Error as e:
-            print(f"[ERROR] Error buscando cliente por nombre/teléfono: {e}")
+    Returns:
+        list: [{'version', 'nombre', 'sentencias', 'checksum'}, ...]
+    """
+    migraciones = []
+    for archivo in sorted(os.listdir(carpeta)):
+        partes = archivo[:-4].split('_', 1) if archivo.endswith('.sql') else None
+        if not partes or not partes[0].isdigit():
+            continue
+        with open(os.path.join(carpeta, archivo), encoding='utf-8') as f:
+            contenido = f.read()
+        migraciones.append({
+            'version': int(partes[0]),
+            'nombre': partes[1] if len(partes) > 1 else archivo,
+            'sentencias': dividir_sentencias_sql(contenido),
+            'checksum': hashlib.sha1(contenido.encode('utf-8')).hexdigest()
+        })
+    versiones = [m['version'] for m in migraciones]
+    if len(versiones) != len(set(versiones)):
+        raise ValueError("Hay dos migraciones con el mismo número de versión")
+    return migraciones
+
+def migraciones_aplicadas(cursor):
+    """Regresa {version: fila} de schema_migraciones (crea la tabla si no existe)."""
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migraciones (
+                        version INT(11) NOT NULL,
+                        nombre VARCHAR(100) NOT NULL,
+                        checksum CHAR(40) NOT NULL,
+                        fecha_aplicacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (version)
+                      ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci""")
+    cursor.execute("SELECT version, nombre, checksum, fecha_aplicacion FROM schema_migraciones ORDER BY version")
+    return {fila['version']: fila for fila in cursor.fetchall()}
+
+def aplicar_migraciones(hasta=None, simular=False, carpeta=CARPETA_MIGRACIONES):
+    """
+    Aplica, en orden, las migraciones que faltan.
     
-    # Si no existe, crear nuevo cliente
-    if not cliente_id:
-        try:
-            cursor.execute("INSERT INTO clientes (nombre, telefono, correo) VALUES (%s, %s, %s)",
-                         (nombre, telefono, email))
-            cliente_id = cursor.lastrowid
-            conn.commit()
-        except Error as e:
-            print(f"[ERROR] Error creando cliente: {e}")
-            # Si falla por email duplicado, intentar obtener el existente
-            if email:
-                try:
-                    cursor.execute("SELECT cliente_id FROM clientes WHERE correo = %s", (email,))
-                    cliente_existente = cursor.fetchone()
-                    if cliente_existente:
-                        cliente_id = cliente_existente['cliente_id']
-                except Error:
-                    pass
+    Las sentencias DDL de MySQL hacen commit solas, así que una migración no
+    es atómica: si una sentencia falla, la migración no se marca como
+    aplicada y se puede volver a correr (lo ya hecho se salta por
+    ERRORES_YA_APLICADA). Un candado con GET_LOCK evita que dos procesos
+    migren a la vez.
+    
+    Args:
+        hasta: Última versión a aplicar (None = todas)
+        simular: Si es True solo regresa lo que se aplicaría
+    
+    Returns:
+        list: Migraciones aplicadas (o por aplicar, si simular=True)
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise Error("No hay conexión para aplicar migraciones")
     
-    return cliente_id
+    try:
+        cursor = get_cursor(conn)
+        cursor.execute("SELECT GET_LOCK('taller_migraciones', 30) AS candado")
+        if not cursor.fetchone()['candado']:
+            raise Error("Otro proceso está aplicando migraciones")
+        try:
+            aplicadas = migraciones_aplicadas(cursor)
+            pendientes = [m for m in listar_migraciones(carpeta)
+                          if m['version'] not in aplicadas and (hasta is None or m['version'] <= hasta)]
+            if simular:
+                return pendientes
+            
+            for migracion in pendientes:
+                logger.info("Aplicando migración %04d_%s", migracion['version'], migracion['nombre'])
+                for sentencia in migracion['sentencias']:
+                    try:
+                        cursor.execute(sentencia)
+                    except Error as e:
+                        if e.errno not in ERRORES_YA_APLICADA:
+                            conn.rollback()
+                            raise
+                        logger.info("  ya estaba aplicada: %s", e.msg)
+                cursor.execute("""INSERT INTO schema_migraciones (version, nombre, checksum) 
+                                  VALUES (%s, %s, %s)""",
+                               (migracion['version'], migracion['nombre'], migracion['checksum']))
+                conn.commit()
+            return pendientes
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('taller_migraciones')")
+            cursor.fetchall()
+    finally:
+        conn.close()
+
+def estado_migraciones(carpeta=CARPETA_MIGRACIONES):
+    """Regresa [(migracion, fila aplicada o None), ...] para todas las migraciones."""
+    conn = get_db_connection()
+    if not conn:
+        raise Error("No hay conexión para revisar las migraciones")
+    try:
+        aplicadas = migraciones_aplicadas(get_cursor(conn))
+        conn.commit()
+    finally:
+        conn.close()
+    return [(m, aplicadas.get(m['version'])) for m in listar_migraciones(carpeta)]
+
+@app.cli.command('migrar')
+@click.option('--hasta', type=int, help='Última versión a aplicar.')
+@click.option('--simular', is_flag=True, help='Solo mostrar las migraciones que se aplicarían.')
+@click.option('--estado', is_flag=True, help='Mostrar qué migraciones están aplicadas.')
+def comando_migrar(hasta, simular, estado):
+    """Aplica a la base de datos las migraciones pendientes de "base de datos/migraciones"."""
+    if estado:
+        for migracion, aplicada in estado_migraciones():
+            if aplicada is None:
+                marca = 'pendiente'
+            elif aplicada['checksum'] != migracion['checksum']:
+                marca = f"aplicada {aplicada['fecha_aplicacion']} (⚠️ el archivo cambió después)"
+            else:
+                marca = f"aplicada {aplicada['fecha_aplicacion']}"
+            click.echo(f"{migracion['version']:04d}_{migracion['nombre']}: {marca}")
+        return
+    migraciones = aplicar_migraciones(hasta=hasta, simular=simular)
+    if not migraciones:
+        click.echo("La base de datos ya está al día")
+    for migracion in migraciones:
+        verbo = 'Por aplicar' if simular else 'Aplicada'
+        click.echo(f"{verbo}: {migracion['version']:04d}_{migracion['nombre']} ({len(migracion['sentencias'])} sentencias)")
 
 # ============================================
 # DECORADORES DE AUTENTICACIÓN
@@ -255,19 +1406,231 @@ def admin_required(f):
             # Esta función solo se ejecuta si el usuario es admin
             ...
     """
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        # Primero verificamos que esté logueado
-        if 'usuario_id' not in session:
-            flash('Por favor inicia sesión para acceder a esta página', 'warning')
-            return redirect(url_for('login'))
-        # Luego verificamos que sea admin
-        if session.get('rol') != 'admin':
-            flash('No tienes permisos para acceder a esta página', 'danger')
-            return redirect(url_for('index'))
-        # Si es admin, dejamos pasar
-        return f(*args, **kwargs)
-    return decorated_function
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # Primero verificamos que esté logueado
+        if 'usuario_id' not in session:
+            flash('Por favor inicia sesión para acceder a esta página', 'warning')
+            return redirect(url_for('login'))
+        # Luego verificamos que sea admin
+        if session.get('rol') != 'admin':
+            flash('No tienes permisos para acceder a esta página', 'danger')
+            return redirect(url_for('index'))
+        # Si es admin, dejamos pasar
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ============================================
+# ARCHIVOS ESTÁTICOS
+# ============================================
+# herramientas/compilar_estaticos.py copia static/ a static/dist/ con una
+# huella del contenido en cada nombre, los CSS/JS ya comprimidos (.gz/.br) y
+# las imágenes en WebP y en tamaños reducidos, y lo describe en
+# static/dist/manifest.json. Si ese manifiesto existe:
+# - url_for('static', filename='css/estilo.css') da la ruta con huella.
+# - Los archivos con huella se sirven con caché de un año ("immutable"):
+#   si el archivo cambia, cambia su nombre.
+# - Si el navegador acepta br o gzip se manda la versión ya comprimida.
+# Sin manifiesto (desarrollo) todo funciona como siempre con los originales.
+ESTATICOS_CONFIG = {
+    # Usar static/dist si existe (en desarrollo conviene False para ver los cambios sin recompilar)
+    'versionados': os.environ.get('ESTATICOS_VERSIONADOS', 'True').lower() in ['true', '1', 'yes'],
+    'manifiesto': os.environ.get('ESTATICOS_MANIFIESTO', os.path.join(app.static_folder, 'dist', 'manifest.json')),
+    'max_age': int(os.environ.get('ESTATICOS_MAX_AGE', 365 * 24 * 3600))  # Segundos de caché de los archivos con huella
+}
+
+class ManifiestoEstaticos:
+    """Lo que generó compilar_estaticos.py: nombres con huella, imágenes y versiones comprimidas."""
+    
+    EXTENSIONES = {'br': '.br', 'gzip': '.gz'}
+    
+    def __init__(self, ruta=None):
+        self.archivos = {}  # {'css/estilo.css': 'dist/css/estilo.<huella>.css'}
+        self.imagenes = {}  # {'imagenes/x.png': {ancho, alto, original, webp, variantes}}
+        self.comprimidos = {}  # {'dist/css/estilo.<huella>.css': ['br', 'gzip']}
+        self.versionados = set()  # Todo lo que está en dist/ y se puede cachear para siempre
+        if ruta:
+            self.cargar(ruta)
+    
+    def cargar(self, ruta):
+        try:
+            with open(ruta, encoding='utf-8') as archivo:
+                datos = json.load(archivo)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("No se pudo leer el manifiesto de estáticos %s: %s", ruta, e)
+            return
+        self.archivos = datos.get('archivos', {})
+        self.imagenes = datos.get('imagenes', {})
+        self.comprimidos = datos.get('comprimidos', {})
+        self.versionados = set(self.archivos.values())
+        for info in self.imagenes.values():
+            if info['webp']:
+                self.versionados.add(info['webp'])
+            for variante in info['variantes']:
+                self.versionados.update((variante['original'], variante['webp']))
+        logger.info("Estáticos versionados: %s archivos (%s)", len(self.archivos), ruta)
+    
+    def codificacion(self, filename, aceptadas):
+        """'br', 'gzip' o None según lo que hay precomprimido y lo que acepta el navegador."""
+        for codificacion in self.comprimidos.get(filename, ()):
+            if codificacion in aceptadas:
+                return codificacion
+        return None
+
+manifiesto_estaticos = ManifiestoEstaticos(ESTATICOS_CONFIG['manifiesto'] if ESTATICOS_CONFIG['versionados'] else None)
+
+@app.url_defaults
+def versionar_estaticos(endpoint, values):
+    """url_for('static', filename='css/estilo.css') -> /static/dist/css/estilo.<huella>.css"""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = manifiesto_estaticos.archivos.get(values['filename'], values['filename'])
+
+def servir_estatico(filename):
+    """Reemplaza la vista 'static' de Flask para los archivos con huella."""
+    if filename not in manifiesto_estaticos.versionados:
+        return app.send_static_file(filename)
+    codificacion = manifiesto_estaticos.codificacion(filename, request.accept_encodings)
+    archivo = filename + ManifiestoEstaticos.EXTENSIONES[codificacion] if codificacion else filename
+    respuesta = send_from_directory(app.static_folder, archivo, mimetype=mimetypes.guess_type(filename)[0],
+                                    max_age=ESTATICOS_CONFIG['max_age'])
+    if codificacion:
+        respuesta.content_encoding = codificacion
+    if filename in manifiesto_estaticos.comprimidos:
+        respuesta.vary.add('Accept-Encoding')
+    respuesta.cache_control.public = True
+    respuesta.cache_control.immutable = True
+    return respuesta
+
+app.view_functions['static'] = servir_estatico
+
+@app.template_global()
+def imagen_responsiva(filename, alt, sizes='(max-width: 600px) 100vw, 320px'):
+    """
+    <picture> con WebP y los tamaños reducidos de una imagen de static/, para
+    que cada navegador baje la más chica que le sirve. Sin manifiesto es un
+    <img> normal.
+    """
+    info = manifiesto_estaticos.imagenes.get(filename)
+    if info is None:
+        return Markup('<img src="%s" alt="%s">') % (url_for('static', filename=filename), alt)
+    
+    def srcset(clave, completa):
+        partes = [f"{url_for('static', filename=variante[clave])} {variante['ancho']}w" for variante in info['variantes']]
+        partes.append(f"{url_for('static', filename=completa)} {info['ancho']}w")
+        return ', '.join(partes)
+    
+    html = Markup('<picture>')
+    if info['webp']:
+        html += Markup('<source type="image/webp" srcset="%s" sizes="%s">') % (srcset('webp', info['webp']), sizes)
+    html += Markup('<img src="%s" srcset="%s" sizes="%s" width="%s" height="%s" alt="%s" loading="lazy" decoding="async">') % (
+        url_for('static', filename=info['original']), srcset('original', info['original']), sizes,
+        info['ancho'], info['alto'], alt)
+    return html + Markup('</picture>')
+
+# ============================================
+# CACHE DE PÁGINAS PÚBLICAS
+# ============================================
+# Inicio, servicios y contacto son iguales para todos los visitantes: solo
+# cambian con el menú (invitado, usuario o admin) y, en servicios, cuando se
+# edita el catálogo. Así que el HTML se genera una vez por combinación y se
+# guarda en memoria, con un ETag para que el navegador reciba un 304 si ya
+# tiene la versión actual.
+# Si hay mensajes flash pendientes la página se genera normal (cada visita es
+# distinta). Además las plantillas compiladas se guardan en disco, así un
+# worker nuevo no vuelve a compilar templates/*.html al arrancar.
+PAGINAS_CONFIG = {
+    'cache': os.environ.get('PAGINAS_CACHE', 'True').lower() in ['true', '1', 'yes'],  # Guardar el HTML de las páginas públicas
+    'max_entradas': int(os.environ.get('PAGINAS_CACHE_MAX', 200)),
+    # Carpeta del cache de plantillas compiladas ('' lo desactiva)
+    'bytecode_dir': os.environ.get('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+}
+
+if PAGINAS_CONFIG['bytecode_dir']:
+    try:
+        os.makedirs(PAGINAS_CONFIG['bytecode_dir'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(PAGINAS_CONFIG['bytecode_dir'])
+    except OSError as e:
+        logger.warning("Sin cache de plantillas compiladas (%s): %s", PAGINAS_CONFIG['bytecode_dir'], e)
+
+class CachePaginas:
+    """
+    HTML ya generado de las páginas públicas, por (endpoint, menú, versión).
+    
+    La versión es la de los datos que usa la página (por ejemplo
+    catalogos.version('servicios')). Esa versión sale del catálogo en
+    memoria de cada proceso, así que no cambia sola en los demás: admin_servicios
+    llama a invalidar() en su proceso y los demás workers lo hacen cuando
+    avisos_cambios les avisa que cambió 'servicios' (a lo más CACHE_REVISION
+    segundos después; sin la tabla cache_versiones, hasta CATALOGOS_TTL).
+    """
+    
+    def __init__(self, max_entradas=200):
+        self._max_entradas = max_entradas
+        self._paginas = {}  # {llave: (html, etag, generada_en)}
+        self._lock = threading.Lock()
+    
+    def obtener(self, llave):
+        return self._paginas.get(llave)
+    
+    def guardar(self, llave, html):
+        etag = hashlib.sha1(html.encode('utf-8')).hexdigest()[:20]
+        entrada = (html, etag, datetime.now(timezone.utc).replace(microsecond=0))
+        with self._lock:
+            if len(self._paginas) >= self._max_entradas:
+                self._paginas.clear()
+            self._paginas[llave] = entrada
+        return entrada
+    
+    def invalidar(self):
+        with self._lock:
+            self._paginas.clear()
+
+cache_paginas = CachePaginas(PAGINAS_CONFIG['max_entradas'])
+
+def menu_actual():
+    """Qué menú muestra base.html: 'invitado', 'usuario' o 'admin'."""
+    if 'usuario_id' not in session:
+        return 'invitado'
+    return 'admin' if session.get('rol') == 'admin' else 'usuario'
+
+def pagina_en_cache(version=None):
+    """
+    Decorador para páginas públicas que se pueden guardar ya generadas.
+    
+    version: función que regresa la versión de los datos de la página
+    (None si la página no depende de la BD). Si lanza Error, la vista se
+    ejecuta normal (y muestra su propio mensaje de error).
+    """
+    def decorador(f):
+        @wraps(f)
+        def vista(*args, **kwargs):
+            if not PAGINAS_CONFIG['cache'] or '_flashes' in session:
+                return f(*args, **kwargs)
+            try:
+                llave = (request.endpoint, menu_actual(), version() if version else '')
+            except Error:
+                return f(*args, **kwargs)
+            
+            entrada = cache_paginas.obtener(llave)
+            if entrada is None:
+                html = f(*args, **kwargs)
+                if not isinstance(html, str) or '_flashes' in session:
+                    return html  # Hubo un error (con su mensaje flash): no se guarda
+                entrada = cache_paginas.guardar(llave, html)
+            
+            html, etag, generada_en = entrada
+            respuesta = make_response(html)
+            respuesta.set_etag(etag)
+            respuesta.last_modified = generada_en
+            # Siempre se revalida (el menú depende de la sesión); si no cambió, es un 304 sin cuerpo
+            respuesta.cache_control.no_cache = True
+            if llave[1] != 'invitado':
+                respuesta.cache_control.private = True
+            return respuesta.make_conditional(request)
+        return vista
+    return decorador
 
 # ============================================
 # RUTAS PÚBLICAS
@@ -276,6 +1639,7 @@ def admin_required(f):
 # La página principal, servicios, contacto, etc.
 
 @app.route('/')
+@pagina_en_cache()
 def index():
     """
     Página principal del sitio.
@@ -287,13 +1651,12 @@ def index():
         return render_template('index.html')
     except Exception as e:
         # Si algo sale mal, lo capturamos y mostramos un mensaje amigable
-        print(f"[ERROR] Error al cargar página principal: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error al cargar página principal: %s", e)
         flash('Error al cargar la página. Por favor intenta más tarde.', 'danger')
         return render_template('index.html')  # Intentar renderizar de nuevo
 
 @app.route('/servicios')
+@pagina_en_cache(version=lambda: catalogos.version('servicios'))
 def servicios():
     """
     Página que muestra todos los servicios disponibles.
@@ -302,25 +1665,17 @@ def servicios():
     en una página pública para que los clientes vean qué servicios ofrecemos.
     """
     try:
-        conn = get_db_connection()
         servicios = []  # Lista vacía por defecto
-        if conn:
-            try:
-                cursor = get_cursor(conn)
-                # Obtenemos todos los servicios ordenados por nombre
-                cursor.execute("SELECT * FROM servicios ORDER BY nombre")
-                servicios = cursor.fetchall()  # Traemos todos los resultados
-            except Error as e:
-                print(f"[ERROR] Error al obtener servicios: {e}")
-                flash('Error al cargar servicios', 'warning')
-            finally:
-                # Siempre cerramos la conexión, incluso si hay error
-                conn.close()
+        try:
+            # Todos los servicios ordenados por nombre (del cache de catálogos;
+            # solo va a la base de datos si el cache está vencido)
+            servicios = catalogos.obtener('servicios')
+        except Error as e:
+            logger.error("Error al obtener servicios: %s", e)
+            flash('Error al cargar servicios', 'warning')
         return render_template('servicios.html', servicios=servicios)
     except Exception as e:
-        print(f"[ERROR] Error en página de servicios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error en página de servicios: %s", e)
         flash('Error al cargar la página de servicios.', 'danger')
         # Retornamos con lista vacía para que la página al menos cargue
         return render_template('servicios.html', servicios=[])
@@ -348,22 +1703,19 @@ def cotizaciones():
     try:
         cursor = get_cursor(conn)
         
-        # Obtener servicios disponibles para el dropdown
-        cursor.execute("SELECT * FROM servicios ORDER BY nombre")
-        servicios = cursor.fetchall()
+        # Obtener servicios disponibles para el dropdown (del cache de catálogos)
+        servicios = catalogos.obtener('servicios', cursor)
         
         # Obtener marcas disponibles (si la tabla existe)
         try:
-            cursor.execute("SELECT * FROM marcas_vehiculos WHERE activo = 1 ORDER BY nombre")
-            marcas = cursor.fetchall()
+            marcas = catalogos.obtener('marcas', cursor)
         except Error:
             # Si la tabla no existe, simplemente usamos lista vacía
             marcas = []
         
         # Obtener años disponibles (si la tabla existe)
         try:
-            cursor.execute("SELECT * FROM años_vehiculos WHERE activo = 1 ORDER BY año DESC")
-            años = cursor.fetchall()
+            años = catalogos.obtener('años', cursor)
         except Error:
             # Si la tabla no existe, simplemente usamos lista vacía
             años = []
@@ -371,17 +1723,17 @@ def cotizaciones():
         # Si el usuario está enviando el formulario (POST)
         if request.method == 'POST':
             # Si el usuario está logueado, usar datos de la sesión
+            usuario_id = None
             if 'usuario_id' in session:
-                nombre = session.get('nombre', '')
-                email = session.get('email', '')
-                # Obtener teléfono del usuario desde la BD si está disponible
-                usuario_id = session.get('usuario_id')
-                try:
-                    cursor.execute("SELECT telefono FROM usuarios WHERE usuario_id = %s", (usuario_id,))
-                    usuario_data = cursor.fetchone()
-                    telefono = usuario_data['telefono'] if usuario_data and usuario_data.get('telefono') else ''
-                except Error:
-                    telefono = ''
+                # Datos del perfil del usuario (si el usuario_id de la sesión ya
+                # no existe, la cotización se guarda con usuario_id NULL)
+                usuario_logueado = obtener_datos_usuario_logueado(cursor, session)
+                nombre = usuario_logueado['nombre']
+                email = usuario_logueado['email']
+                telefono = usuario_logueado['telefono'] or ''
+                perfil = perfil_usuario_actual(cursor)
+                if perfil:
+                    usuario_id = perfil['usuario_id']
             else:
                 # Si no está logueado, obtener datos del formulario
                 nombre = request.form.get('nombre', '').strip()
@@ -429,57 +1781,52 @@ def cotizaciones():
                 try:
                     cilindros_int = int(cilindros)
                     
-                    # Obtener año del vehículo
-                    cursor.execute("SELECT año FROM años_vehiculos WHERE año_id = %s", (año_id,))
-                    año_data = cursor.fetchone()
-                    año = año_data['año'] if año_data else 0
+                    # Todo lo que se necesita para guardar la cotización se resuelve
+                    # antes de escribir: año, marca y servicios salen de los catálogos
+                    # ya cargados arriba y los precios del motor en memoria. Solo lo
+                    # que no esté en el cache (p. ej. un año o marca inactivos) se
+                    # consulta, y los servicios faltantes en una sola consulta.
+                    año = next((a['año'] for a in años if a['año_id'] == año_id), None)
+                    if año is None:
+                        cursor.execute("SELECT año FROM años_vehiculos WHERE año_id = %s", (año_id,))
+                        año_data = cursor.fetchone()
+                        año = año_data['año'] if año_data else 0
                     
                     # Obtener marca_id si existe (opcional)
-                    marca_id = None
-                    try:
-                        cursor.execute("SELECT marca_id FROM marcas_vehiculos WHERE nombre = %s", (marca_vehiculo,))
-                        marca_data = cursor.fetchone()
-                        if marca_data:
-                            marca_id = marca_data['marca_id']
-                    except Error:
-                        marca_id = None
+                    marca_id = next((m['marca_id'] for m in marcas if m['nombre'] == marca_vehiculo), None)
+                    if marca_id is None and marcas:
+                        try:
+                            cursor.execute("SELECT marca_id FROM marcas_vehiculos WHERE nombre = %s", (marca_vehiculo,))
+                            marca_data = cursor.fetchone()
+                            if marca_data:
+                                marca_id = marca_data['marca_id']
+                        except Error:
+                            marca_id = None
+                    
+                    # Nombres de los servicios seleccionados (en el orden del formulario)
+                    nombres_por_id = {s['servicio_id']: s['nombre'] for s in servicios}
+                    faltantes = [sid for sid in servicios_ids_int if sid not in nombres_por_id]
+                    if faltantes:
+                        placeholders = ', '.join(['%s'] * len(faltantes))
+                        cursor.execute(f"SELECT servicio_id, nombre FROM servicios WHERE servicio_id IN ({placeholders})",
+                                       tuple(faltantes))
+                        nombres_por_id.update((fila['servicio_id'], fila['nombre']) for fila in cursor.fetchall())
                     
-                    # Obtener nombres de servicios seleccionados
+                    # Un precio por servicio; se reutiliza para la cotización y sus renglones
                     servicios_nombres = []
-                    precio_total = 0.0
+                    precios_servicios = {}
                     for servicio_id in servicios_ids_int:
-                        cursor.execute("SELECT nombre FROM servicios WHERE servicio_id = %s", (servicio_id,))
-                        servicio_data = cursor.fetchone()
-                        if servicio_data:
-                            servicios_nombres.append(servicio_data['nombre'])
-                            # Calcular precio para cada servicio
-                            precio_servicio = calcular_precio_servicio(cursor, servicio_id, cilindros_int, año)
-                            precio_total += precio_servicio
+                        if servicio_id in nombres_por_id and servicio_id not in precios_servicios:
+                            servicios_nombres.append(nombres_por_id[servicio_id])
+                            precios_servicios[servicio_id] = calcular_precio_servicio(cursor, servicio_id, cilindros_int, año)
+                    precio_total = sum(precios_servicios.values())
                     
                     servicio_nombre = ', '.join(servicios_nombres) if servicios_nombres else 'Servicios'
                     
-                    # Obtener o crear cliente
-                    cliente_id = obtener_o_crear_cliente(cursor, conn, nombre, telefono, email)
-                    
-                    # Obtener usuario_id si está logueado y verificar que existe en la BD
-                    usuario_id_session = session.get('usuario_id', None)
-                    usuario_id = None
-                    if usuario_id_session:
-                        try:
-                            # Convertir a entero si es necesario
-                            usuario_id_int = int(usuario_id_session) if usuario_id_session else None
-                            if usuario_id_int:
-                                # Verificar que el usuario existe en la base de datos
-                                cursor.execute("SELECT usuario_id FROM usuarios WHERE usuario_id = %s", (usuario_id_int,))
-                                usuario_existe = cursor.fetchone()
-                                if usuario_existe:
-                                    usuario_id = usuario_id_int
-                                else:
-                                    print(f"[WARNING] Usuario ID {usuario_id_int} de la sesión no existe en la BD, usando NULL")
-                                    usuario_id = None
-                        except (ValueError, TypeError, Exception) as e:
-                            print(f"[ERROR] Error verificando usuario_id: {e}")
-                            usuario_id = None
+                    # A partir de aquí todo va en una sola transacción: cliente,
+                    # cotización, renglones, estadística y correo se confirman juntos
+                    # con un único commit (o no se guarda nada).
+                    cliente_id = obtener_o_crear_cliente(cursor, nombre, telefono, email)
                     
                     # Insertar cotización con relación a cliente y usuario
                     # Usar el primer servicio_id para compatibilidad con campos antiguos
@@ -487,64 +1834,52 @@ def cotizaciones():
                     sql = """INSERT INTO cotizaciones 
                              (nombre, telefono, email, cliente_id, servicio, servicio_id, 
                               marca_vehiculo, marca_id, modelo_vehiculo, 
-                              anio_vehiculo, año_id, cilindros, mensaje, precio_calculado, usuario_id) 
-                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+                              anio_vehiculo, año_id, cilindros, mensaje, precio_calculado, usuario_id, propietario_id) 
+                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
                     cursor.execute(sql, (
                         nombre, telefono, email, cliente_id, servicio_nombre, primer_servicio_id,
                         marca_vehiculo, marca_id, modelo_vehiculo,
-                        año, año_id, cilindros_int, mensaje, precio_total, usuario_id
+                        año, año_id, cilindros_int, mensaje, precio_total, usuario_id,
+                        resolver_propietario(cursor, usuario_id, email)
                     ))
                     cotizacion_id = cursor.lastrowid
                     
-                    # Insertar relaciones muchos-a-muchos en cotizaciones_servicios
-                    for servicio_id in servicios_ids_int:
-                        # Calcular precio para este servicio específico
-                        precio_servicio = calcular_precio_servicio(cursor, servicio_id, cilindros_int, año)
-                        cursor.execute("""INSERT INTO cotizaciones_servicios 
+                    # Relaciones muchos-a-muchos en cotizaciones_servicios en un solo
+                    # INSERT de varias filas (executemany lo agrupa)
+                    cursor.executemany("""INSERT INTO cotizaciones_servicios 
                                          (cotizacion_id, servicio_id, precio_calculado) 
                                          VALUES (%s, %s, %s)""",
-                                     (cotizacion_id, servicio_id, precio_servicio))
+                                       [(cotizacion_id, servicio_id, precio)
+                                        for servicio_id, precio in precios_servicios.items()])
+                    
+                    sumar_estadistica(cursor, 'cotizaciones')
+                    
+                    # El correo con los detalles se guarda junto con la cotización
+                    if email:
+                        encolar_correo(cursor, 'cotizacion', cotizacion_id, email)
                     
                     conn.commit()
+                    cola_correos.despertar()
                     
-                    # Enviar correo automáticamente al cliente
-                    try:
-                        if enviar_cotizacion_por_correo(cotizacion_id):
-                            flash(f'✅ Cotización enviada correctamente. Precio total estimado: ${precio_total:.2f} ({len(servicios_ids_int)} servicio(s)). Se ha enviado un correo con los detalles.', 'success')
-                        else:
-                            flash(f'✅ Cotización guardada correctamente. Precio total estimado: ${precio_total:.2f} ({len(servicios_ids_int)} servicio(s)). No se pudo enviar el correo.', 'warning')
-                    except Exception as e:
-                        print(f"Error al enviar correo automático: {e}")
-                        flash(f'✅ Cotización guardada correctamente. Precio total estimado: ${precio_total:.2f} ({len(servicios_ids_int)} servicio(s)). Error al enviar correo: {str(e)}', 'warning')
+                    flash(f'✅ Cotización enviada correctamente. Precio total estimado: ${precio_total:.2f} ({len(servicios_ids_int)} servicio(s)). En unos momentos recibirás un correo con los detalles.', 'success')
                     
                     return redirect(url_for('cotizaciones'))
                     
                 except ValueError:
+                    conn.rollback()
                     flash('❌ Los datos deben ser válidos', 'danger')
                 except Error as e:
+                    conn.rollback()
                     flash(f'❌ Error al enviar cotización: {str(e)}', 'danger')
             else:
                 if 'usuario_id' not in session:
                     flash('Por favor complete todos los campos requeridos', 'warning')
         
         # Pasar información del usuario logueado al template
-        usuario_logueado = {
-            'id': session.get('usuario_id'),
-            'nombre': session.get('nombre', ''),
-            'email': session.get('email', ''),
-            'telefono': None
+        usuario_logueado = obtener_datos_usuario_logueado(cursor, session) or {
+            'id': None, 'nombre': '', 'email': '', 'telefono': None
         }
         
-        # Si está logueado, obtener teléfono de la BD
-        if usuario_logueado.get('usuario_id'):
-            try:
-                cursor.execute("SELECT telefono FROM usuarios WHERE usuario_id = %s", (usuario_logueado['usuario_id'],))
-                usuario_data = cursor.fetchone()
-                if usuario_data:
-                    usuario_logueado['telefono'] = usuario_data.get('telefono', '')
-            except Error:
-                pass
-        
         return render_template('cotizaciones.html', servicios=servicios, marcas=marcas, años=años, usuario=usuario_logueado)
     
     except Error as e:
@@ -553,6 +1888,292 @@ def cotizaciones():
     finally:
         conn.close()
 
+class CatalogosReferencia:
+    """
+    Cache en memoria de los catálogos que casi nunca cambian:
+    servicios, marcas_vehiculos y años_vehiculos.
+    
+    Cada catálogo se lee una vez y se comparte entre todos los hilos. Se
+    vuelve a leer cuando tiene más de CATALOGOS_TTL segundos o cuando se
+    llama a invalidar() (admin_servicios lo hace después de cada cambio, y
+    los demás procesos al enterarse por avisos_cambios).
+    
+    Cada catálogo tiene una versión (un hash de su contenido). Como depende
+    solo de los datos, todos los procesos calculan la misma versión, así que
+    sirve para armar ETags.
+    """
+    
+    CONSULTAS = {
+        'servicios': "SELECT * FROM servicios ORDER BY nombre",
+        'marcas': "SELECT * FROM marcas_vehiculos WHERE activo = 1 ORDER BY nombre",
+        'años': "SELECT * FROM años_vehiculos WHERE activo = 1 ORDER BY año DESC"
+    }
+    
+    def __init__(self, ttl=300):
+        self._ttl = ttl
+        self._catalogos = {}  # {nombre: (filas, version, cargado_en)}
+        self._lock = threading.Lock()
+        self._carga = threading.Lock()
+    
+    @staticmethod
+    def _calcular_version(filas):
+        contenido = json.dumps(filas, default=str, sort_keys=True)
+        return hashlib.sha1(contenido.encode('utf-8')).hexdigest()[:16]
+    
+    def _vigente(self, nombre):
+        entrada = self._catalogos.get(nombre)
+        if entrada is None or monotonic() - entrada[2] > self._ttl:
+            return None
+        return entrada
+    
+    def recargar(self, nombre, cursor=None):
+        """Vuelve a leer un catálogo de la base de datos y reemplaza el anterior."""
+        conn = None
+        if cursor is None:
+            conn = get_db_connection()
+            if not conn:
+                raise Error("No hay conexión para cargar el catálogo")
+            cursor = get_cursor(conn)
+        try:
+            cursor.execute(self.CONSULTAS[nombre])
+            filas = tuple(cursor.fetchall())
+        finally:
+            if conn:
+                conn.close()
+        entrada = (filas, self._calcular_version(filas), monotonic())
+        with self._lock:
+            self._catalogos[nombre] = entrada
+        return entrada
+    
+    def _entrada(self, nombre, cursor=None):
+        entrada = self._vigente(nombre)
+        if entrada is None:
+            # Solo un hilo recarga; los demás esperan y usan lo que cargó
+            with self._carga:
+                entrada = self._vigente(nombre)
+                if entrada is None:
+                    entrada = self.recargar(nombre, cursor)
+        return entrada
+    
+    def obtener(self, nombre, cursor=None):
+        """
+        Retorna las filas de un catálogo ('servicios', 'marcas' o 'años').
+        
+        La lista es nueva en cada llamada, pero los dicts de cada fila son
+        compartidos entre hilos: no se deben modificar.
+        Lanza Error si el catálogo no se puede leer (por ejemplo, si la tabla no existe).
+        """
+        return list(self._entrada(nombre, cursor)[0])
+    
+    def version(self, *nombres, cursor=None):
+        """Versión combinada de uno o varios catálogos (para ETags)."""
+        return '-'.join(self._entrada(nombre, cursor)[1] for nombre in nombres)
+    
+    def invalidar(self, *nombres):
+        """Descarta los catálogos indicados (o todos); se recargan en el siguiente uso."""
+        with self._lock:
+            for nombre in nombres or list(self._catalogos):
+                self._catalogos.pop(nombre, None)
+
+# Catálogos globales (cada uno se carga la primera vez que se pide)
+catalogos = CatalogosReferencia(ttl=int(os.environ.get('CATALOGOS_TTL', 300)))
+
+class MotorPrecios:
+    """
+    Motor de precios en memoria.
+    
+    Carga una sola vez todas las filas activas de servicio_precios y las
+    agrupa por servicio_id, ordenadas por precio_base (igual que el
+    ORDER BY precio_base ASC de la consulta original). Así cada cálculo
+    de precio se resuelve sin ir a la base de datos.
+    
+    Cuando admin_precios crea, edita o elimina un precio se llama a
+    recargar(), que arma un índice nuevo y lo reemplaza de una sola vez,
+    así que ningún hilo ve un índice a medio construir.
+    Los demás procesos se enteran por avisos_cambios (AvisosCambios); como
+    respaldo el índice también se recarga si tiene más de PRECIOS_TTL segundos.
+    """
+    
+    PRECIO_DEFAULT = 500.00
+    
+    def __init__(self, ttl=300):
+        self._ttl = ttl
+        self._indice = None  # {servicio_id: (fila, fila, ...)}
+        self._cargado_en = 0.0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _construir_indice(filas):
+        indice = {}
+        for fila in filas:
+            indice.setdefault(fila['servicio_id'], []).append((
+                fila['cilindros_min'],
+                fila['cilindros_max'],
+                fila['anio_min'],
+                fila['anio_max'],
+                float(fila['precio_base']),
+                float(fila['precio_por_cilindro'] or 0),
+                float(fila['precio_por_anio'] or 0)
+            ))
+        # La consulta ya viene ordenada; sort estable por precio_base por si acaso
+        return {sid: tuple(sorted(rangos, key=lambda r: r[4])) for sid, rangos in indice.items()}
+    
+    def recargar(self, cursor=None):
+        """Vuelve a leer servicio_precios y reemplaza el índice completo."""
+        conn = None
+        if cursor is None:
+            conn = get_db_connection()
+            if not conn:
+                raise Error("No hay conexión para cargar los precios")
+            cursor = get_cursor(conn)
+        try:
+            cursor.execute("""SELECT servicio_id, cilindros_min, cilindros_max, anio_min, anio_max,
+                                     precio_base, precio_por_cilindro, precio_por_anio
+                              FROM servicio_precios
+                              WHERE activo = 1
+                              ORDER BY servicio_id, precio_base, servicio_precio_id""")
+            indice = self._construir_indice(cursor.fetchall())
+        finally:
+            if conn:
+                conn.close()
+        with self._lock:
+            self._indice = indice
+            self._cargado_en = monotonic()
+        return indice
+    
+    def invalidar(self):
+        """Marca el índice como vencido; se recarga en el siguiente cálculo."""
+        with self._lock:
+            self._indice = None
+    
+    def vencido(self):
+        """True si el siguiente cálculo tendrá que recargar el índice (ir a la BD)."""
+        return self._indice is None or monotonic() - self._cargado_en > self._ttl
+    
+    def _indice_vigente(self, cursor=None):
+        indice = self._indice
+        if self.vencido():
+            indice = self.recargar(cursor)
+        return indice
+    
+    def calcular(self, servicio_id, cilindros, anio, cursor=None):
+        """
+        Calcula el precio con las mismas reglas que las consultas SQL originales:
+        1. Primer rango (por precio_base) que coincida con cilindros y año.
+        2. Si no hay, primer rango que coincida solo con cilindros (sin sumar el año).
+        3. Si tampoco hay, el precio por defecto de $500.00.
+        """
+        rangos = self._indice_vigente(cursor).get(servicio_id, ())
+        solo_cilindros = None
+        for cil_min, cil_max, anio_min, anio_max, base, por_cilindro, por_anio in rangos:
+            if not (cil_min <= cilindros <= cil_max):
+                continue
+            if (anio_min is None or anio_min <= anio) and (anio_max is None or anio_max >= anio):
+                return round(base + (por_cilindro * cilindros) + (por_anio * anio), 2)
+            if solo_cilindros is None:
+                solo_cilindros = round(base + (por_cilindro * cilindros), 2)
+        if solo_cilindros is not None:
+            return solo_cilindros
+        return self.PRECIO_DEFAULT
+
+# Motor de precios global (se carga en el primer cálculo)
+motor_precios = MotorPrecios(ttl=int(os.environ.get('PRECIOS_TTL', 300)))
+
+# ============================================
+# AVISOS DE CAMBIOS ENTRE PROCESOS
+# ============================================
+# Los catálogos, el motor de precios y las páginas en cache viven en la
+# memoria de cada proceso. Con varios workers, el invalidar() que hace
+# admin_servicios o admin_precios solo llega al worker que atendió el
+# cambio; los demás se enteran por la tabla cache_versiones.
+
+# Nueva versión de un área (va en la misma transacción que el cambio)
+SQL_PUBLICAR_CAMBIO = """INSERT INTO cache_versiones (area, version) VALUES (%s, 1)
+                         ON DUPLICATE KEY UPDATE version = version + 1"""
+
+class AvisosCambios:
+    """
+    Avisa a los demás procesos que cambió un área ('precios', 'servicios').
+    
+    - publicar() sube la versión del área en cache_versiones, dentro de la
+      transacción del cambio (si se hace rollback, no hay aviso).
+    - revisar() lee la tabla (unas pocas filas) a lo más cada CACHE_REVISION
+      segundos por proceso; si la versión de un área cambió, llama a las
+      funciones registradas con al_cambiar() (los invalidar() de cada cache).
+    
+    Así otro worker tarda como mucho CACHE_REVISION segundos en ver un
+    cambio. Los TTL (CATALOGOS_TTL, PRECIOS_TTL) quedan como respaldo para
+    los cambios hechos directamente en la BD o si falta la tabla.
+    """
+    
+    def __init__(self, intervalo=2):
+        self._intervalo = intervalo
+        self._versiones = None  # {area: version} que ya vio este proceso (None: aún no se lee)
+        self._revisado_en = 0.0
+        self._oyentes = {}  # {area: [funcion, ...]}
+        self._lock = threading.Lock()
+        self._sin_tabla = False
+    
+    def al_cambiar(self, area, funcion):
+        self._oyentes.setdefault(area, []).append(funcion)
+    
+    def publicar(self, cursor, *areas):
+        """Anota el cambio de las áreas. No hace commit: va con el commit del cambio."""
+        try:
+            for area in areas:
+                cursor.execute(SQL_PUBLICAR_CAMBIO, (area,))
+        except Error as e:
+            # Solo falla esta sentencia; el cambio se guarda y los demás procesos lo ven al vencer su TTL
+            logger.warning("No se pudo avisar el cambio de %s a los demás procesos: %s", ', '.join(areas), e)
+    
+    def toca_revisar(self):
+        return self._intervalo > 0 and monotonic() - self._revisado_en >= self._intervalo
+    
+    def revisar(self):
+        """Lee cache_versiones (si ya pasó el intervalo) e invalida lo que cambió en otro proceso."""
+        if not self.toca_revisar() or not self._lock.acquire(blocking=False):
+            return  # Todavía no toca, u otro hilo ya está revisando
+        try:
+            self._revisado_en = monotonic()
+            conn = get_db_connection()
+            if not conn:
+                return
+            try:
+                cursor = get_cursor(conn)
+                cursor.execute("SELECT area, version FROM cache_versiones")
+                versiones = {fila['area']: fila['version'] for fila in cursor.fetchall()}
+                conn.commit()  # No dejar abierta la transacción (ni su snapshot) de esta lectura
+            finally:
+                conn.close()
+            anteriores, self._versiones = self._versiones, versiones
+            self._sin_tabla = False
+            if anteriores is None:
+                return  # Primera lectura: solo se toma como referencia
+            for area, version in versiones.items():
+                if anteriores.get(area) != version:
+                    logger.info("El área %s cambió en otro proceso; se descarta su cache", area)
+                    for funcion in self._oyentes.get(area, ()):
+                        funcion()
+        except Error as e:
+            if not self._sin_tabla:
+                logger.warning("No se pudo leer cache_versiones (¿falta la migración 0008?): %s", e)
+                self._sin_tabla = True
+        finally:
+            self._lock.release()
+    
+    def reiniciar_tras_fork(self):
+        """En el proceso hijo de un fork: lock nuevo (las versiones vistas se heredan)."""
+        self._lock = threading.Lock()
+
+avisos_cambios = AvisosCambios(intervalo=float(os.environ.get('CACHE_REVISION', 2)))
+avisos_cambios.al_cambiar('precios', motor_precios.invalidar)
+avisos_cambios.al_cambiar('servicios', lambda: catalogos.invalidar('servicios'))
+avisos_cambios.al_cambiar('servicios', cache_paginas.invalidar)
+
+@app.before_request
+def revisar_avisos_cambios():
+    avisos_cambios.revisar()
+
 def calcular_precio_servicio(cursor, servicio_id, cilindros, anio):
     """
     Calcula el precio de un servicio basado en cilindros y año del vehículo.
@@ -568,67 +2189,41 @@ def calcular_precio_servicio(cursor, servicio_id, cilindros, anio):
     
     Si no encuentra una configuración exacta, intenta buscar solo por cilindros.
     Si tampoco encuentra nada, retorna un precio por defecto de $500.00.
+    
+    La búsqueda se hace en el motor de precios en memoria (MotorPrecios);
+    el cursor solo se usa si hace falta cargar el índice.
     """
     try:
-        # Primero intentamos buscar un precio que coincida con servicio, cilindros Y año
-        sql = """SELECT precio_base, precio_por_cilindro, precio_por_anio 
-                 FROM servicio_precios 
-                 WHERE servicio_id = %s 
-                   AND cilindros_min <= %s 
-                   AND cilindros_max >= %s
-                   AND (anio_min IS NULL OR anio_min <= %s)
-                   AND (anio_max IS NULL OR anio_max >= %s)
-                   AND activo = 1
-                 ORDER BY precio_base ASC
-                 LIMIT 1"""
-        cursor.execute(sql, (servicio_id, cilindros, cilindros, anio, anio))
-        precio_data = cursor.fetchone()
-        
-        if precio_data:
-            # Si encontramos una configuración, calculamos el precio
-            precio_base = float(precio_data['precio_base'])
-            precio_por_cilindro = float(precio_data['precio_por_cilindro'] or 0)
-            precio_por_anio = float(precio_data['precio_por_anio'] or 0)
-            
-            # Fórmula del precio: base + (cilindros * precio_por_cilindro) + (año * precio_por_año)
-            precio_total = precio_base + (precio_por_cilindro * cilindros) + (precio_por_anio * anio)
-            return round(precio_total, 2)
-        else:
-            # Si no hay precio que considere el año, buscamos solo por cilindros
-            sql = """SELECT precio_base, precio_por_cilindro 
-                     FROM servicio_precios 
-                     WHERE servicio_id = %s 
-                       AND cilindros_min <= %s 
-                       AND cilindros_max >= %s
-                       AND activo = 1
-                     ORDER BY precio_base ASC
-                     LIMIT 1"""
-            cursor.execute(sql, (servicio_id, cilindros, cilindros))
-            precio_data = cursor.fetchone()
-            
-            if precio_data:
-                # Si encontramos algo solo por cilindros, calculamos sin el año
-                precio_base = float(precio_data['precio_base'])
-                precio_por_cilindro = float(precio_data['precio_por_cilindro'] or 0)
-                return round(precio_base + (precio_por_cilindro * cilindros), 2)
-            else:
-                # Si no hay ninguna configuración, usamos un precio por defecto
-                return 500.00
-                
+        return motor_precios.calcular(servicio_id, cilindros, anio, cursor)
     except ValueError as e:
-        print(f"[ERROR] Error de validación calculando precio: {e}")
+        logger.error("Error de validación calculando precio: %s", e)
         raise  # Re-lanzar para que la función llamadora lo maneje
     except Error as e:
-        print(f"[ERROR] Error de BD calculando precio: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD calculando precio: %s", e)
         return 500.00
     except Exception as e:
-        print(f"[ERROR] Error inesperado calculando precio: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado calculando precio: %s", e)
         return 500.00
 
+def ids_servicios_unicos(valores):
+    """Convierte los servicio_id[] del formulario a enteros, sin repetidos ni valores inválidos."""
+    ids = []
+    for valor in valores:
+        try:
+            servicio_id = int(valor)
+        except ValueError:
+            continue
+        if servicio_id and servicio_id not in ids:
+            ids.append(servicio_id)
+    return ids
+
+def respuesta_precios(servicios_ids, cilindros, anio):
+    """Cuerpo JSON de /calcular_precios: precio de cada servicio y el total."""
+    precios = {}
+    for servicio_id in servicios_ids:
+        precios[str(servicio_id)] = calcular_precio_servicio(None, servicio_id, cilindros, anio)
+    return {'precios': precios, 'total': round(sum(precios.values()), 2), 'success': True}
+
 @app.route('/calcular_precio', methods=['POST'])
 def calcular_precio():
     """
@@ -657,12 +2252,10 @@ def calcular_precio():
                     # Retornamos el resultado en formato JSON
                     return jsonify({'precio': precio, 'success': True})
                 except Error as e:
-                    print(f"[ERROR] Error en cálculo de precio (BD): {e}")
+                    logger.error("Error en cálculo de precio (BD): %s", e)
                     return jsonify({'precio': 0, 'success': False, 'error': 'Error de base de datos'})
                 except Exception as e:
-                    print(f"[ERROR] Error en cálculo de precio: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception("Error en cálculo de precio: %s", e)
                     return jsonify({'precio': 0, 'success': False, 'error': 'Error al calcular precio'})
                 finally:
                     if conn:
@@ -671,26 +2264,169 @@ def calcular_precio():
         # Si faltan datos, retornamos error
         return jsonify({'precio': 0, 'success': False, 'error': 'Datos incompletos'})
     except ValueError as e:
-        print(f"[ERROR] Error de validación en calcular_precio: {e}")
+        logger.error("Error de validación en calcular_precio: %s", e)
         return jsonify({'precio': 0, 'success': False, 'error': 'Datos inválidos'})
     except Exception as e:
-        print(f"[ERROR] Error inesperado en calcular_precio: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en calcular_precio: %s", e)
         return jsonify({'precio': 0, 'success': False, 'error': 'Error inesperado'})
 
+@app.route('/calcular_precios', methods=['POST'])
+def calcular_precios():
+    """
+    API endpoint para calcular el precio de varios servicios a la vez.
+    
+    Recibe la lista de servicios seleccionados (servicio_id[]), el año y
+    los cilindros, y retorna el precio de cada servicio y el total en una
+    sola respuesta. Así el formulario de cotizaciones hace una petición
+    en lugar de una por cada servicio seleccionado.
+    
+    Los precios salen del motor de precios en memoria, así que normalmente
+    no se toca la base de datos.
+    """
+    try:
+        servicios_ids_int = ids_servicios_unicos(request.form.getlist('servicio_id[]'))
+        anio = int(request.form.get('anio', 0))
+        cilindros = int(request.form.get('cilindros', 0))
+        
+        if not (servicios_ids_int and anio and cilindros):
+            return jsonify({'precios': {}, 'total': 0, 'success': False, 'error': 'Datos incompletos'})
+        
+        return jsonify(respuesta_precios(servicios_ids_int, cilindros, anio))
+    except ValueError as e:
+        logger.error("Error de validación en calcular_precios: %s", e)
+        return jsonify({'precios': {}, 'total': 0, 'success': False, 'error': 'Datos inválidos'})
+    except Exception as e:
+        logger.exception("Error inesperado en calcular_precios: %s", e)
+        return jsonify({'precios': {}, 'total': 0, 'success': False, 'error': 'Error inesperado'})
+
 @app.route('/contacto')
+@pagina_en_cache()
 def contacto():
     """Página de contacto"""
     try:
         return render_template('contacto.html')
     except Exception as e:
-        print(f"[ERROR] Error al cargar página de contacto: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error al cargar página de contacto: %s", e)
         flash('Error al cargar la página de contacto.', 'danger')
         return render_template('contacto.html')
 
+# ============================================
+# MOTOR DE DISPONIBILIDAD DE HORARIOS
+# ============================================
+# Un día se representa como un entero donde cada bit es un horario de
+# media hora (bit 0 = 7:00, bit 1 = 7:30, ..., bit 19 = 16:30).
+# Un bit en 1 significa que ese horario está ocupado.
+# La misma regla (mínimo 1 hora entre citas) la usan la API de horarios
+# y la validación al agendar en citas().
+
+HORA_APERTURA_MIN = 7 * 60  # 7:00 AM en minutos desde medianoche
+MINUTOS_POR_SLOT = 30
+MINUTOS_ENTRE_CITAS = 60
+# Horario de atención: 7:00 AM a 4:30 PM (la última cita termina a las 5 PM)
+HORARIOS_SLOTS = tuple(
+    f"{(HORA_APERTURA_MIN + i * MINUTOS_POR_SLOT) // 60:02d}:{(HORA_APERTURA_MIN + i * MINUTOS_POR_SLOT) % 60:02d}"
+    for i in range(20)
+)
+MAX_DIAS_DISPONIBILIDAD = 62  # Máximo de días que se pueden pedir en una sola consulta
+
+def minutos_de_hora(valor):
+    """
+    Convierte la hora de una cita a minutos desde medianoche.
+    
+    MySQL puede regresar la hora como timedelta, time o string
+    (HH:MM o HH:MM:SS). Retorna None si no se puede interpretar.
+    """
+    if isinstance(valor, timedelta):
+        return int(valor.total_seconds()) // 60
+    if isinstance(valor, str):
+        partes = valor.strip().split(':')
+        if len(partes) < 2:
+            return None
+        try:
+            return int(partes[0]) * 60 + int(partes[1].split('.')[0])
+        except ValueError:
+            return None
+    if hasattr(valor, 'hour'):
+        return valor.hour * 60 + valor.minute
+    return None
+
+def hay_conflicto(minutos_nueva, minutos_existente):
+    """Regla única de choque: dos citas deben estar separadas al menos 1 hora."""
+    return abs(minutos_nueva - minutos_existente) < MINUTOS_ENTRE_CITAS
+
+@lru_cache(maxsize=None)
+def mascara_ocupada(minutos_cita):
+    """Bits de los horarios que quedan bloqueados por una cita a esa hora."""
+    mascara = 0
+    for i in range(len(HORARIOS_SLOTS)):
+        if hay_conflicto(HORA_APERTURA_MIN + i * MINUTOS_POR_SLOT, minutos_cita):
+            mascara |= 1 << i
+    return mascara
+
+def horarios_libres(mascara):
+    """Lista de horarios ('HH:MM') cuyo bit no está ocupado."""
+    return [h for i, h in enumerate(HORARIOS_SLOTS) if not (mascara >> i) & 1]
+
+def horarios_ocupados(mascara):
+    """Lista de horarios ('HH:MM') cuyo bit está ocupado."""
+    return [h for i, h in enumerate(HORARIOS_SLOTS) if (mascara >> i) & 1]
+
+CONSULTA_DISPONIBILIDAD = "SELECT fecha, hora FROM citas WHERE fecha BETWEEN %s AND %s"
+
+def mascaras_por_dia(fecha_inicio, fecha_fin, citas):
+    """
+    Arma {date: mascara} con una entrada por cada día del rango a partir de
+    las citas (filas con fecha y hora) de CONSULTA_DISPONIBILIDAD.
+    """
+    dias = {}
+    dia = fecha_inicio
+    while dia <= fecha_fin:
+        dias[dia] = 0
+        dia += timedelta(days=1)
+    
+    for cita in citas:
+        minutos = minutos_de_hora(cita['hora'])
+        if minutos is None or cita['fecha'] not in dias:
+            continue
+        dias[cita['fecha']] |= mascara_ocupada(minutos)
+    return dias
+
+def disponibilidad_rango(cursor, fecha_inicio, fecha_fin):
+    """
+    Calcula la máscara de horarios ocupados de cada día en un rango de fechas.
+    
+    Hace una sola consulta para todo el rango.
+    
+    Returns:
+        dict: {date: mascara} con una entrada por cada día del rango
+    """
+    cursor.execute(CONSULTA_DISPONIBILIDAD, (fecha_inicio, fecha_fin))
+    return mascaras_por_dia(fecha_inicio, fecha_fin, cursor.fetchall())
+
+def leer_rango_disponibilidad(desde_param, hasta_param):
+    """
+    Valida el rango de /api/disponibilidad (hasta es opcional: una semana).
+    Retorna (desde, hasta) o lanza ValueError con el mensaje para el usuario.
+    """
+    try:
+        desde = datetime.strptime(desde_param or '', '%Y-%m-%d').date()
+        hasta = datetime.strptime(hasta_param, '%Y-%m-%d').date() if hasta_param else desde + timedelta(days=6)
+    except ValueError:
+        raise ValueError('Formato de fecha inválido')
+    if hasta < desde:
+        raise ValueError('El rango de fechas es inválido')
+    if (hasta - desde).days + 1 > MAX_DIAS_DISPONIBILIDAD:
+        raise ValueError(f'El rango no puede ser mayor a {MAX_DIAS_DISPONIBILIDAD} días')
+    return desde, hasta
+
+def respuesta_disponibilidad(dias):
+    """Cuerpo JSON de /api/disponibilidad a partir de {date: mascara}."""
+    return {
+        'dias': {dia.isoformat(): {'horarios': horarios_libres(mascara), 'mascara': mascara}
+                 for dia, mascara in dias.items()},
+        'slots': list(HORARIOS_SLOTS)
+    }
+
 @app.route('/api/horarios_disponibles/<fecha>')
 def api_horarios_disponibles(fecha):
     """
@@ -708,6 +2444,10 @@ def api_horarios_disponibles(fecha):
         # Validar formato de fecha
         if not fecha or len(fecha) != 10:
             return jsonify({'error': 'Formato de fecha inválido', 'horarios': []}), 400
+        try:
+            dia = datetime.strptime(fecha, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Formato de fecha inválido', 'horarios': []}), 400
         
         conn = get_db_connection()
         if not conn:
@@ -715,116 +2455,137 @@ def api_horarios_disponibles(fecha):
         
         try:
             cursor = get_cursor(conn)
-            
-            # Obtener citas existentes para esa fecha
-            cursor.execute("SELECT hora FROM citas WHERE fecha = %s ORDER BY hora", (fecha,))
-            citas_existentes = cursor.fetchall()
-            
-            # Horario de atención: 7:00 AM a 5:00 PM
-            horarios_todos = []
-            for hora in range(7, 17):  # 7 AM a 4 PM (última cita a las 4 PM para terminar a las 5 PM)
-                horarios_todos.append(f"{hora:02d}:00")
-                horarios_todos.append(f"{hora:02d}:30")
-            
-            print(f"[DEBUG] Total horarios generados: {len(horarios_todos)}")
-            print(f"[DEBUG] Horarios: {horarios_todos[:5]}...")
-            
-            # Obtener horas ocupadas
-            horas_ocupadas = set()
-            print(f"[DEBUG] Citas existentes para {fecha}: {len(citas_existentes)}")
-            
-            for cita in citas_existentes:
-                hora_cita = cita['hora']
-                print(f"[DEBUG] Procesando cita con hora: {hora_cita} (tipo: {type(hora_cita)})")
-                
-                # Manejar diferentes formatos de hora
-                hora_int = None
-                minuto = None
-                
-                if isinstance(hora_cita, timedelta):
-                    # Convertir timedelta a time
-                    total_seconds = int(hora_cita.total_seconds())
-                    hora_int = total_seconds // 3600
-                    minuto = (total_seconds % 3600) // 60
-                    print(f"[DEBUG] Hora convertida de timedelta: {hora_int:02d}:{minuto:02d}")
-                elif isinstance(hora_cita, str):
-                    # Si es string, parsear
-                    if ':' in hora_cita:
-                        hora_parts = hora_cita.split(':')
-                        hora_int = int(hora_parts[0])
-                        # Manejar formato HH:MM:SS o HH:MM
-                        minuto_str = hora_parts[1] if len(hora_parts) > 1 else '0'
-                        minuto = int(minuto_str.split('.')[0])  # Ignorar microsegundos si existen
-                    else:
-                        print(f"[DEBUG] Hora sin formato válido: {hora_cita}")
-                        continue
-                elif isinstance(hora_cita, time):
-                    # Si es time object
-                    hora_int = hora_cita.hour
-                    minuto = hora_cita.minute
-                elif hasattr(hora_cita, 'hour'):
-                    # Otro tipo de objeto con atributo hour
-                    hora_int = hora_cita.hour
-                    minuto = hora_cita.minute
-                else:
-                    print(f"[DEBUG] Tipo de hora no reconocido: {type(hora_cita)}")
-                    continue
-                
-                if hora_int is None or minuto is None:
-                    print(f"[DEBUG] No se pudo extraer hora y minuto, saltando...")
-                    continue
-                
-                # Formatear hora (ej: 07:00, 14:30)
-                hora_simple = f"{hora_int:02d}:{minuto:02d}"
-                print(f"[DEBUG] Hora formateada: {hora_simple}")
-                horas_ocupadas.add(hora_simple)
-                
-                # Bloquear la hora siguiente (mínimo 1 hora entre citas)
-                # Si hay una cita a las 10:00, bloquear 10:00, 10:30, 11:00 (pero NO 11:30)
-                # Si hay una cita a las 10:30, bloquear 10:30, 11:00, 11:30 (pero NO 12:00)
-                if minuto == 0:
-                    # Hora en punto: bloquear esta hora, media hora después, y 1 hora después
-                    horas_ocupadas.add(f"{hora_int:02d}:30")  # Media hora después
-                    if hora_int < 16:
-                        horas_ocupadas.add(f"{hora_int + 1:02d}:00")  # 1 hora después
-                else:
-                    # Media hora: bloquear esta hora, media hora después, y 1 hora después
-                    if hora_int < 16:
-                        horas_ocupadas.add(f"{hora_int + 1:02d}:00")  # Media hora después
-                        horas_ocupadas.add(f"{hora_int + 1:02d}:30")  # 1 hora después
-            
-            print(f"[DEBUG] Horas ocupadas: {sorted(horas_ocupadas)}")
-            
-            # Filtrar horarios disponibles
-            horarios_disponibles = [h for h in horarios_todos if h not in horas_ocupadas]
-            
-            print(f"[DEBUG] Horarios disponibles: {len(horarios_disponibles)}")
-            print(f"[DEBUG] Primeros 5 disponibles: {horarios_disponibles[:5]}")
-            
-            return jsonify({'horarios': horarios_disponibles, 'ocupados': list(horas_ocupadas)})
+            mascara = disponibilidad_rango(cursor, dia, dia)[dia]
+            return jsonify({'horarios': horarios_libres(mascara), 'ocupados': horarios_ocupados(mascara)})
         except Error as e:
-            print(f"[ERROR] Error de BD obteniendo horarios: {e}")
+            logger.error("Error de BD obteniendo horarios: %s", e)
             return jsonify({'error': 'Error de base de datos', 'horarios': []}), 500
-        except ValueError as e:
-            print(f"[ERROR] Error de formato obteniendo horarios: {e}")
-            return jsonify({'error': 'Error de formato de datos', 'horarios': []}), 400
         except Exception as e:
-            print(f"[ERROR] Error inesperado obteniendo horarios: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error inesperado obteniendo horarios: %s", e)
             return jsonify({'error': 'Error inesperado', 'horarios': []}), 500
         finally:
             if conn:
                 try:
                     conn.close()
                 except Exception as e:
-                    print(f"[ERROR] Error cerrando conexión: {e}")
+                    logger.error("Error cerrando conexión: %s", e)
     except Exception as e:
-        print(f"[ERROR] Error crítico en api_horarios_disponibles: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error crítico en api_horarios_disponibles: %s", e)
         return jsonify({'error': 'Error crítico', 'horarios': []}), 500
 
+@app.route('/api/disponibilidad')
+def api_disponibilidad():
+    """
+    API para obtener los horarios disponibles de varios días en una sola llamada.
+    
+    Recibe ?desde=YYYY-MM-DD&hasta=YYYY-MM-DD (hasta es opcional, por defecto
+    una semana) y retorna los horarios libres de cada día del rango.
+    Así la página de citas puede cargar la semana o el mes completo de una vez.
+    """
+    try:
+        desde, hasta = leer_rango_disponibilidad(request.args.get('desde', ''), request.args.get('hasta', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e), 'dias': {}}), 400
+    
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Error de conexión', 'dias': {}}), 500
+    
+    try:
+        cursor = get_cursor(conn)
+        return jsonify(respuesta_disponibilidad(disponibilidad_rango(cursor, desde, hasta)))
+    except Error as e:
+        logger.error("Error de BD obteniendo disponibilidad: %s", e)
+        return jsonify({'error': 'Error de base de datos', 'dias': {}}), 500
+    except Exception as e:
+        logger.exception("Error inesperado obteniendo disponibilidad: %s", e)
+        return jsonify({'error': 'Error inesperado', 'dias': {}}), 500
+    finally:
+        conn.close()
+
+# Errores de MySQL que indican que otra transacción ganó la carrera; se reintenta
+ERRORES_REINTENTABLES = (errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT)
+INTENTOS_RESERVA = 3
+
+def buscar_conflicto_cita(cursor, fecha, minutos, bloquear=False):
+    """
+    Busca una cita que choque con la hora indicada (a menos de 1 hora).
+    
+    Solo trae las citas de esa fecha dentro de ±60 minutos, usando el índice
+    idx_citas_fecha_hora (fecha, hora). Con bloquear=True la consulta es
+    SELECT ... FOR UPDATE: InnoDB bloquea ese rango del índice (incluyendo
+    los huecos) hasta el commit, así que otra transacción no puede insertar
+    una cita en el mismo rango mientras tanto.
+    
+    Returns:
+        dict: La cita en conflicto (cita_id, hora) o None si el horario está libre
+    """
+    sql = """SELECT cita_id, hora FROM citas
+             WHERE fecha = %s AND hora > %s AND hora < %s
+             ORDER BY hora
+             LIMIT 1"""
+    if bloquear:
+        sql += " FOR UPDATE"
+    cursor.execute(sql, (fecha,
+                         timedelta(minutes=minutos - MINUTOS_ENTRE_CITAS),
+                         timedelta(minutes=minutos + MINUTOS_ENTRE_CITAS)))
+    return cursor.fetchone()
+
+def reservar_cita(conn, cursor, cita, minutos, servicios_ids):
+    """
+    Guarda una cita sin riesgo de que dos personas reserven el mismo horario.
+    
+    En una sola transacción REPEATABLE READ: bloquea el rango de ±60 minutos
+    con buscar_conflicto_cita(bloquear=True), y si está libre inserta la cita
+    y sus servicios (y encola el correo de confirmación). Si dos requests compiten por el mismo rango, MySQL hace
+    esperar a uno (o lo aborta por deadlock); en ese caso se reintenta y el
+    reintento ya ve la cita del otro y reporta el conflicto.
+    
+    Returns:
+        tuple: (cita_id, None) si se guardó, o (None, cita_en_conflicto) si el horario está ocupado
+    """
+    primer_servicio_id = servicios_ids[0] if servicios_ids else None
+    for intento in range(INTENTOS_RESERVA):
+        try:
+            # Cerrar la transacción implícita de las lecturas anteriores
+            if conn.in_transaction:
+                conn.commit()
+            conn.start_transaction(isolation_level='REPEATABLE READ')
+            
+            conflicto = buscar_conflicto_cita(cursor, cita['fecha'], minutos, bloquear=True)
+            if conflicto:
+                conn.rollback()
+                return None, conflicto
+            
+            # Insertar cita con relaciones (usar primer servicio_id para compatibilidad)
+            sql = """INSERT INTO citas (nombre, telefono, email, cliente_id, fecha, hora, servicio, servicio_id, usuario_id, propietario_id, cotizacion_id, estatus) 
+                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'Pendiente')"""
+            cursor.execute(sql, (cita['nombre'], cita['telefono'], cita['email'], cita['cliente_id'],
+                                 cita['fecha'], cita['hora'], cita['servicio'], primer_servicio_id,
+                                 cita['usuario_id'], cita['propietario_id'], cita['cotizacion_id']))
+            cita_id = cursor.lastrowid
+            
+            # Insertar relaciones muchos-a-muchos en citas_servicios
+            if servicios_ids:
+                cursor.executemany("""INSERT INTO citas_servicios (cita_id, servicio_id) 
+                                      VALUES (%s, %s)""",
+                                   [(cita_id, servicio_id) for servicio_id in servicios_ids])
+            
+            sumar_estadistica(cursor, 'citas')
+            
+            # El correo de confirmación se guarda junto con la cita
+            if cita['email']:
+                encolar_correo(cursor, 'confirmacion_cita', cita_id, cita['email'])
+            
+            conn.commit()
+            return cita_id, None
+        except Error as e:
+            conn.rollback()
+            if e.errno in ERRORES_REINTENTABLES and intento < INTENTOS_RESERVA - 1:
+                logger.warning("Conflicto de bloqueo al reservar cita (intento %s): %s", intento + 1, e)
+                continue
+            raise
+
 @app.route('/citas', methods=['GET', 'POST'])
 def citas():
     """
@@ -834,7 +2595,7 @@ def citas():
     el agendamiento (POST). Cuando se envía el formulario:
     1. Valida que el horario esté disponible (no haya otra cita muy cerca)
     2. Guarda la cita en la base de datos
-    3. Envía un correo de confirmación automáticamente
+    3. Deja en cola el correo de confirmación (se envía en segundo plano)
     
     El sistema previene que se agenden dos citas con menos de 1 hora de diferencia.
     """
@@ -846,9 +2607,8 @@ def citas():
     try:
         cursor = get_cursor(conn)
         
-        # Obtener servicios disponibles desde la base de datos
-        cursor.execute("SELECT * FROM servicios ORDER BY nombre")
-        servicios = cursor.fetchall()
+        # Obtener servicios disponibles (del cache de catálogos)
+        servicios = catalogos.obtener('servicios', cursor)
         
         # Si viene desde una cotización, obtener datos de la cotización
         cotizacion_id = request.args.get('cotizacion_id', type=int)
@@ -858,31 +2618,23 @@ def citas():
                 # Si el usuario está logueado, verificar que la cotización sea suya
                 if 'usuario_id' in session:
                     usuario_id = session.get('usuario_id')
-                    usuario_email = session.get('email', '')
-                    cursor.execute("""SELECT c.* FROM cotizaciones c 
-                                   LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                                   WHERE c.cotizacion_id = %s AND (c.usuario_id = %s OR cl.correo = %s OR c.email = %s)""",
-                                (cotizacion_id, usuario_id, usuario_email, usuario_email))
+                    cursor.execute("""SELECT * FROM cotizaciones 
+                                      WHERE cotizacion_id = %s AND propietario_id = %s""",
+                                   (cotizacion_id, usuario_id))
                 else:
                     cursor.execute("SELECT * FROM cotizaciones WHERE cotizacion_id = %s", (cotizacion_id,))
                 cotizacion_data = cursor.fetchone()
             except Error as e:
-                print(f"[ERROR] Error obteniendo cotización: {e}")
+                logger.error("Error obteniendo cotización: %s", e)
                 cotizacion_data = None
         
         if request.method == 'POST':
             # Si el usuario está logueado, usar datos de la sesión
             if 'usuario_id' in session:
-                nombre = session.get('nombre', '')
-                email = session.get('email', '')
-                # Obtener teléfono del usuario desde la BD si está disponible
-                usuario_id = session.get('usuario_id')
-                try:
-                    cursor.execute("SELECT telefono FROM usuarios WHERE usuario_id = %s", (usuario_id,))
-                    usuario_data = cursor.fetchone()
-                    telefono = usuario_data['telefono'] if usuario_data and usuario_data.get('telefono') else ''
-                except Error:
-                    telefono = ''
+                usuario_logueado = obtener_datos_usuario_logueado(cursor, session)
+                nombre = usuario_logueado['nombre']
+                email = usuario_logueado['email']
+                telefono = usuario_logueado['telefono'] or ''
             else:
                 # Si no está logueado, obtener datos del formulario
                 nombre = request.form.get('nombre', '').strip()
@@ -900,10 +2652,8 @@ def citas():
                 if servicio_id_single:
                     servicios_ids = [servicio_id_single]
             
-            # Debug: imprimir qué se recibió
-            print(f"[DEBUG] Servicios recibidos (raw): {servicios_ids}")
-            print(f"[DEBUG] Nombre: {nombre}, Email: {email}, Fecha: {fecha}, Hora: {hora}")
-            print(f"[DEBUG] Usuario logueado: {'usuario_id' in session}")
+            logger.debug("Solicitud de cita: fecha=%s hora=%s servicios=%s logueado=%s",
+                         fecha, hora, servicios_ids, 'usuario_id' in session)
             
             # Validación: verificar que haya al menos un servicio seleccionado
             servicios_ids_int = []
@@ -913,15 +2663,13 @@ def citas():
                 except ValueError:
                     continue
             
-            print(f"[DEBUG] Servicios IDs convertidos: {servicios_ids_int}")
-            
             # Validación: si está logueado, solo validar que tenga email y nombre en sesión
             if 'usuario_id' in session:
                 if nombre and email and fecha and hora and len(servicios_ids_int) > 0:
                     validacion_ok = True
                 else:
                     validacion_ok = False
-                    print(f"[DEBUG] Validación fallida - nombre: {bool(nombre)}, email: {bool(email)}, fecha: {bool(fecha)}, hora: {bool(hora)}, servicios: {len(servicios_ids_int)}")
+                    logger.debug("Validación fallida - nombre: %s, email: %s, fecha: %s, hora: %s, servicios: %s", bool(nombre), bool(email), bool(fecha), bool(hora), len(servicios_ids_int))
                     if len(servicios_ids_int) == 0:
                         flash('Por favor seleccione al menos un servicio', 'warning')
                     else:
@@ -939,135 +2687,37 @@ def citas():
             
             if validacion_ok:
                 try:
-                    # Validar que el horario esté disponible
-                    print(f"[DEBUG] ========== VALIDANDO CITA ==========")
-                    print(f"[DEBUG] Fecha: {fecha}, Hora: {hora}")
-                    
                     # Verificar si el horario está ocupado o muy cerca de otra cita
                     try:
                         hora_seleccionada = datetime.strptime(hora, '%H:%M').time()
-                        print(f"[DEBUG] Hora seleccionada parseada: {hora_seleccionada}")
                     except ValueError:
                         flash('❌ Formato de hora inválido', 'danger')
                         usuario_logueado = obtener_datos_usuario_logueado(cursor, session)
                         return render_template('citas.html', servicios=servicios, cotizacion=cotizacion_data, usuario=usuario_logueado)
-                    
-                    # Consultar citas existentes para esa fecha
-                    cursor.execute("SELECT cita_id, hora FROM citas WHERE fecha = %s", (fecha,))
-                    citas_existentes = cursor.fetchall()
-                    print(f"[DEBUG] Citas existentes encontradas: {len(citas_existentes)}")
-                    
-                    hora_ocupada = False
-                    conflicto_info = None
-                    
-                    for cita in citas_existentes:
-                        hora_existente = cita['hora']
-                        cita_id = cita['cita_id']
-                        print(f"[DEBUG] --- Comparando con cita ID {cita_id} ---")
-                        print(f"[DEBUG] Hora existente (raw): {hora_existente}, tipo: {type(hora_existente)}")
-                        
-                        # Manejar diferentes formatos de hora
-                        hora_existente_parsed = None
-                        if isinstance(hora_existente, timedelta):
-                            # Convertir timedelta a time
-                            total_seconds = int(hora_existente.total_seconds())
-                            hours = total_seconds // 3600
-                            minutes = (total_seconds % 3600) // 60
-                            hora_existente_parsed = time(hours, minutes)
-                            print(f"[DEBUG] Hora convertida de timedelta a time: {hora_existente_parsed}")
-                        elif isinstance(hora_existente, str):
-                            # Intentar diferentes formatos
-                            try:
-                                # Limpiar la cadena (puede tener espacios o caracteres extra)
-                                hora_limpia = hora_existente.strip()
-                                if len(hora_limpia.split(':')) == 3:
-                                    hora_existente_parsed = datetime.strptime(hora_limpia, '%H:%M:%S').time()
-                                elif len(hora_limpia.split(':')) == 2:
-                                    hora_existente_parsed = datetime.strptime(hora_limpia, '%H:%M').time()
-                                else:
-                                    print(f"[DEBUG] Formato de hora no reconocido: {hora_limpia}")
-                                    continue
-                            except ValueError as e:
-                                print(f"[DEBUG] Error parseando hora existente '{hora_existente}': {e}")
-                                continue
-                        elif isinstance(hora_existente, time):
-                            # Ya es un objeto time
-                            hora_existente_parsed = hora_existente
-                        elif hasattr(hora_existente, 'hour'):
-                            # Otro tipo de objeto con atributo hour
-                            hora_existente_parsed = hora_existente
-                        else:
-                            print(f"[DEBUG] Tipo de hora no reconocido: {type(hora_existente)}")
-                            continue
-                        
-                        if hora_existente_parsed is None:
-                            print(f"[DEBUG] No se pudo parsear la hora, saltando...")
-                            continue
-                        
-                        print(f"[DEBUG] Hora existente parseada: {hora_existente_parsed}")
-                        
-                        # Calcular diferencia en minutos
-                        minutos_seleccionada = hora_seleccionada.hour * 60 + hora_seleccionada.minute
-                        minutos_existente = hora_existente_parsed.hour * 60 + hora_existente_parsed.minute
-                        diff_minutos = abs(minutos_seleccionada - minutos_existente)
-                        
-                        print(f"[DEBUG] Diferencia: {diff_minutos} minutos")
-                        print(f"[DEBUG] Seleccionada: {minutos_seleccionada} min, Existente: {minutos_existente} min")
-                        
-                        # Si hay menos de 60 minutos de diferencia, está ocupado
-                        if diff_minutos < 60:
-                            hora_ocupada = True
-                            conflicto_info = f"Cita ID {cita_id} a las {hora_existente_parsed.strftime('%I:%M %p')}"
-                            print(f"[DEBUG] ❌❌❌ CONFLICTO DETECTADO: {conflicto_info} ❌❌❌")
-                            break
-                        else:
-                            print(f"[DEBUG] ✅ Sin conflicto (diferencia >= 60 min)")
-                    
-                    print(f"[DEBUG] ========== RESULTADO VALIDACIÓN ==========")
-                    print(f"[DEBUG] Hora ocupada: {hora_ocupada}")
-                    
-                    if hora_ocupada:
-                        mensaje = f'❌ El horario seleccionado ({hora_seleccionada.strftime("%I:%M %p")}) no está disponible. Ya existe una cita {conflicto_info if conflicto_info else "en ese horario"}. Por favor seleccione otro horario.'
-                        print(f"[DEBUG] {mensaje}")
-                        flash(mensaje, 'danger')
-                        # NO continuar, retornar para que el usuario vea el error
-                        usuario_logueado = obtener_datos_usuario_logueado(cursor, session)
-                        return render_template('citas.html', servicios=servicios, cotizacion=cotizacion_data, usuario=usuario_logueado)
-                    else:
-                        print(f"[DEBUG] ✅ Horario disponible, procediendo a guardar la cita")
+                    
+                    minutos_seleccionada = hora_seleccionada.hour * 60 + hora_seleccionada.minute
+                    
+                    # Revisión rápida (sin bloqueo) para no hacer trabajo de más si ya está ocupado.
+                    # La revisión definitiva se hace dentro de reservar_cita() con bloqueo.
+                    conflicto = buscar_conflicto_cita(cursor, fecha, minutos_seleccionada)
+                    
+                    if not conflicto:
+                        logger.debug("Horario disponible, procediendo a guardar la cita")
                         
-                        # Obtener nombres de servicios seleccionados
-                        servicios_nombres = []
-                        for servicio_id in servicios_ids_int:
-                            cursor.execute("SELECT nombre FROM servicios WHERE servicio_id = %s", (servicio_id,))
-                            servicio_data = cursor.fetchone()
-                            if servicio_data:
-                                servicios_nombres.append(servicio_data['nombre'])
+                        # Obtener nombres de servicios seleccionados (del catálogo ya cargado)
+                        nombres_por_id = {s['servicio_id']: s['nombre'] for s in servicios}
+                        servicios_nombres = [nombres_por_id[servicio_id] for servicio_id in servicios_ids_int
+                                             if servicio_id in nombres_por_id]
                         
                         servicio_nombre = ', '.join(servicios_nombres) if servicios_nombres else 'Servicios'
                         
                         # Obtener o crear cliente
-                        cliente_id = obtener_o_crear_cliente(cursor, conn, nombre, telefono, email)
+                        cliente_id = obtener_o_crear_cliente(cursor, nombre, telefono, email)
                         
-                        # Obtener usuario_id si está logueado y verificar que existe en la BD
-                        usuario_id_session = session.get('usuario_id', None)
-                        usuario_id = None
-                        if usuario_id_session:
-                            try:
-                                # Convertir a entero si es necesario
-                                usuario_id_int = int(usuario_id_session) if usuario_id_session else None
-                                if usuario_id_int:
-                                    # Verificar que el usuario existe en la base de datos
-                                    cursor.execute("SELECT usuario_id FROM usuarios WHERE usuario_id = %s", (usuario_id_int,))
-                                    usuario_existe = cursor.fetchone()
-                                    if usuario_existe:
-                                        usuario_id = usuario_id_int
-                                    else:
-                                        print(f"[WARNING] Usuario ID {usuario_id_int} de la sesión no existe en la BD, usando NULL")
-                                        usuario_id = None
-                            except (ValueError, TypeError, Exception) as e:
-                                print(f"[ERROR] Error verificando usuario_id: {e}")
-                                usuario_id = None
+                        # usuario_id solo si está logueado y el usuario sigue existiendo
+                        # (el perfil ya se leyó en este request; no se vuelve a consultar)
+                        perfil = perfil_usuario_actual(cursor)
+                        usuario_id = perfil['usuario_id'] if perfil else None
                         
                         # Obtener cotizacion_id si viene desde una cotización
                         cotizacion_id_param = request.form.get('cotizacion_id', None)
@@ -1078,50 +2728,55 @@ def citas():
                                 # Verificar que la cotización existe
                                 cursor.execute("SELECT cotizacion_id FROM cotizaciones WHERE cotizacion_id = %s", (cotizacion_id,))
                                 if not cursor.fetchone():
-                                    print(f"[WARNING] Cotización ID {cotizacion_id} no existe, usando NULL")
+                                    logger.warning("Cotización ID %s no existe, usando NULL", cotizacion_id)
                                     cotizacion_id = None
                             except (ValueError, Exception) as e:
-                                print(f"[ERROR] Error procesando cotizacion_id: {e}")
+                                logger.error("Error procesando cotizacion_id: %s", e)
                                 cotizacion_id = None
                         
-                        # Insertar cita con relaciones (usar primer servicio_id para compatibilidad)
-                        primer_servicio_id = servicios_ids_int[0] if servicios_ids_int else None
-                        sql = """INSERT INTO citas (nombre, telefono, email, cliente_id, fecha, hora, servicio, servicio_id, usuario_id, cotizacion_id, estatus) 
-                                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'Pendiente')"""
-                        cursor.execute(sql, (nombre, telefono, email, cliente_id, fecha, hora, servicio_nombre, primer_servicio_id, usuario_id, cotizacion_id))
-                        cita_id = cursor.lastrowid
-                        
-                        # Insertar relaciones muchos-a-muchos en citas_servicios
-                        for servicio_id in servicios_ids_int:
-                            cursor.execute("""INSERT INTO citas_servicios (cita_id, servicio_id) 
-                                             VALUES (%s, %s)""",
-                                         (cita_id, servicio_id))
-                        
-                        conn.commit()
-                        
-                        # Enviar correo de confirmación automáticamente
-                        try:
-                            if enviar_confirmacion_cita(cita_id):
-                                flash('✅ ¡Tu cita ha sido registrada con éxito! Se ha enviado un correo de confirmación.', 'success')
-                            else:
-                                flash('✅ ¡Tu cita ha sido registrada con éxito! No se pudo enviar el correo de confirmación.', 'warning')
-                        except Exception as e:
-                            print(f"Error al enviar correo de confirmación: {e}")
-                            flash(f'✅ ¡Tu cita ha sido registrada con éxito! Error al enviar correo: {str(e)}', 'warning')
+                        # Guardar la cita (revisión con bloqueo + INSERT en una sola transacción)
+                        cita = {
+                            'nombre': nombre,
+                            'telefono': telefono,
+                            'email': email,
+                            'cliente_id': cliente_id,
+                            'fecha': fecha,
+                            'hora': hora,
+                            'servicio': servicio_nombre,
+                            'usuario_id': usuario_id,
+                            'propietario_id': resolver_propietario(cursor, usuario_id, email),
+                            'cotizacion_id': cotizacion_id
+                        }
+                        cita_id, conflicto = reservar_cita(conn, cursor, cita, minutos_seleccionada, servicios_ids_int)
+                    
+                    if conflicto:
+                        minutos_existente = minutos_de_hora(conflicto['hora'])
+                        hora_existente = time(minutos_existente // 60, minutos_existente % 60)
+                        conflicto_info = f"Cita ID {conflicto['cita_id']} a las {hora_existente.strftime('%I:%M %p')}"
+                        mensaje = f'❌ El horario seleccionado ({hora_seleccionada.strftime("%I:%M %p")}) no está disponible. Ya existe una cita {conflicto_info}. Por favor seleccione otro horario.'
+                        logger.info("Horario %s %s no disponible: choca con la cita %s", fecha, hora, conflicto['cita_id'])
+                        flash(mensaje, 'danger')
+                        # NO continuar, retornar para que el usuario vea el error
+                        usuario_logueado = obtener_datos_usuario_logueado(cursor, session)
+                        return render_template('citas.html', servicios=servicios, cotizacion=cotizacion_data, usuario=usuario_logueado)
+                    else:
+                        logger.info("Cita %s registrada para %s %s", cita_id, fecha, hora)
+                        # El correo de confirmación ya quedó en la cola; avisar a los hilos de envío
+                        cola_correos.despertar()
+                        if email:
+                            flash('✅ ¡Tu cita ha sido registrada con éxito! En unos momentos recibirás un correo de confirmación.', 'success')
+                        else:
+                            flash('✅ ¡Tu cita ha sido registrada con éxito!', 'success')
                         
                         return redirect(url_for('index'))
                 except Error as e:
-                    print(f"[ERROR] Error de BD al guardar cita: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception("Error de BD al guardar cita: %s", e)
                     flash(f'❌ Error al guardar la cita: {str(e)}', 'danger')
                 except ValueError as e:
-                    print(f"[ERROR] Error de validación al guardar cita: {e}")
+                    logger.error("Error de validación al guardar cita: %s", e)
                     flash(f'❌ Error en los datos: {str(e)}', 'danger')
                 except Exception as e:
-                    print(f"[ERROR] Error inesperado al guardar cita: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception("Error inesperado al guardar cita: %s", e)
                     flash('❌ Error inesperado al guardar la cita. Por favor intenta más tarde.', 'danger')
             else:
                 flash('Por favor complete todos los campos requeridos', 'warning')
@@ -1132,15 +2787,11 @@ def citas():
         return render_template('citas.html', servicios=servicios, cotizacion=cotizacion_data, usuario=usuario_logueado)
     
     except Error as e:
-        print(f"[ERROR] Error de BD en citas: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en citas: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return render_template('citas.html', servicios=[], cotizacion=None, usuario=None)
     except Exception as e:
-        print(f"[ERROR] Error inesperado en citas: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en citas: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return render_template('citas.html', servicios=[], cotizacion=None, usuario=None)
     finally:
@@ -1148,8 +2799,142 @@ def citas():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en citas: {e}")
+                logger.error("Error cerrando conexión en citas: %s", e)
+
+
+# ============================================
+# VERIFICACIÓN DE CONTRASEÑAS
+# ============================================
+# Verificar un hash de contraseña es a propósito lento (decenas o cientos de
+# milisegundos de CPU). Si se hace en el hilo del request, una ráfaga de
+# logins ocupa todos los hilos del servidor. Por eso se hace en un pool
+# aparte de pocos hilos: el resto de los requests sigue atendiéndose, y si
+# la cola se llena el login responde "intenta de nuevo" en lugar de esperar.
+HASH_CONFIG = {
+    # Hilos que calculan hashes a la vez (hashlib y bcrypt liberan el GIL)
+    'workers': int(os.environ.get('HASH_WORKERS', min(4, os.cpu_count() or 1))),
+    # Máximo de verificaciones esperando o en proceso; más allá se rechazan
+    'max_pendientes': int(os.environ.get('HASH_MAX_PENDIENTES', 32)),
+    # Segundos que un login espera su turno antes de rendirse
+    'timeout': float(os.environ.get('HASH_TIMEOUT', 10)),
+    # Método de Werkzeug para las contraseñas nuevas; las que tengan otro
+    # (p. ej. bcrypt de PHP) se vuelven a hashear con este al iniciar sesión
+    'metodo': os.environ.get('PASSWORD_HASH_METODO', 'scrypt:32768:8:1')
+}
+
+class VerificacionSaturada(Exception):
+    """Hay demasiadas verificaciones de contraseña en cola."""
+
+class VerificadorPasswords:
+    """
+    Pool acotado para verificar y generar hashes de contraseñas.
+    
+    Soporta los hashes de Werkzeug (scrypt:..., pbkdf2:...) y los bcrypt
+    ($2y$/$2b$/$2a$) que venían del sistema en PHP.
+    """
+    
+    def __init__(self, workers=4, max_pendientes=32, timeout=10, metodo='scrypt:32768:8:1'):
+        self._workers = workers
+        self._max_pendientes = max_pendientes
+        self._timeout = timeout
+        self.metodo = metodo
+        self._ejecutor = None
+        self._lock = threading.Lock()
+        self._pendientes = 0
+        self._hash_ficticio = None
+    
+    @property
+    def pendientes(self):
+        return self._pendientes
+    
+    def _obtener_ejecutor(self):
+        with self._lock:
+            if self._ejecutor is None:
+                self._ejecutor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='hash')
+            return self._ejecutor
+    
+    def _ejecutar(self, operacion, funcion, *args):
+        """Corre funcion(*args) en el pool y espera el resultado (con límite de cola y de tiempo)."""
+        with self._lock:
+            if self._pendientes >= self._max_pendientes:
+                raise VerificacionSaturada()
+            self._pendientes += 1
+        encolado = perf_counter()
+        
+        def tarea():
+            inicio = perf_counter()
+            try:
+                return funcion(*args)
+            finally:
+                metricas.registrar_hash(operacion, inicio - encolado, perf_counter() - inicio)
+        
+        try:
+            futuro = self._obtener_ejecutor().submit(tarea)
+            try:
+                return futuro.result(timeout=self._timeout)
+            except TiempoAgotado:
+                futuro.cancel()
+                raise VerificacionSaturada()
+        finally:
+            with self._lock:
+                self._pendientes -= 1
+    
+    @staticmethod
+    def _es_bcrypt(password_hash):
+        return password_hash.startswith(('$2y$', '$2b$', '$2a$'))
+    
+    @classmethod
+    def _comparar(cls, password, password_hash):
+        if cls._es_bcrypt(password_hash):
+            if bcrypt is None:
+                logger.error("Hay un hash bcrypt pero el paquete bcrypt no está instalado")
+                return False
+            # bcrypt de Python usa $2b$; $2y$ (PHP) es el mismo algoritmo
+            hash_bcrypt = '$2b$' + password_hash[4:]
+            try:
+                return bcrypt.checkpw(password.encode('utf-8'), hash_bcrypt.encode('utf-8'))
+            except ValueError:
+                return False
+        try:
+            return check_password_hash(password_hash, password)
+        except (ValueError, TypeError):
+            return False
+    
+    def verificar(self, password, password_hash):
+        """
+        Regresa True si la contraseña corresponde al hash.
+        Con password_hash=None (usuario inexistente) igual se hace una
+        verificación, para que tarde lo mismo y no revele qué usuarios existen.
+        """
+        if not password_hash:
+            if self._hash_ficticio is None:
+                self._hash_ficticio = self.hashear(uuid.uuid4().hex)
+            self._ejecutar('verificar', self._comparar, password, self._hash_ficticio)
+            return False
+        return self._ejecutar('verificar', self._comparar, password, password_hash)
+    
+    def hashear(self, password):
+        """Genera el hash de una contraseña con el método configurado."""
+        return self._ejecutar('hashear', generate_password_hash, password, self.metodo)
+    
+    def necesita_rehash(self, password_hash):
+        """True si el hash no es del método configurado (bcrypt, pbkdf2, otros parámetros...)."""
+        return not password_hash.startswith(self.metodo + '$')
+    
+    def cerrar(self):
+        """Termina los hilos del pool (las verificaciones en curso terminan, las que esperan se cancelan)."""
+        with self._lock:
+            ejecutor, self._ejecutor = self._ejecutor, None
+        if ejecutor is not None:
+            ejecutor.shutdown(wait=True, cancel_futures=True)
+    
+    def reiniciar_tras_fork(self):
+        """En el proceso hijo de un fork: los hilos del padre no existen, se crean de nuevo al usarlos."""
+        self._ejecutor = None
+        self._lock = threading.Lock()
+        self._pendientes = 0
 
+verificador_passwords = VerificadorPasswords(**HASH_CONFIG)
 
 # ============================================
 # RUTAS DE AUTENTICACIÓN
@@ -1165,6 +2950,7 @@ def login():
     Si es POST, verifica las credenciales:
     - Busca el usuario en la BD
     - Verifica la contraseña (soporta tanto hashes de Werkzeug como bcrypt de PHP)
+      en el pool de verificación, y actualiza los hashes antiguos al método actual
     - Si es correcto, crea la sesión y redirige al dashboard apropiado (admin o usuario)
     - Si es incorrecto, muestra un mensaje de error
     
@@ -1186,26 +2972,23 @@ def login():
                     cursor.execute(sql, (username,))
                     usuario = cursor.fetchone()
                     
-                    # Verificar contraseña
-                    if usuario and usuario['password']:
-                        password_valid = False
-                        stored_hash = usuario['password']
-                        
-                        # Intentar verificar con Werkzeug (formato pbkdf2:sha256:...)
-                        try:
-                            password_valid = check_password_hash(stored_hash, password)
-                        except (ValueError, TypeError):
-                            # Si falla, puede ser un hash de PHP ($2y$...) o formato antiguo
-                            # Intentar verificar con bcrypt directamente
+                    # Verificar contraseña (en el pool de verificación, no en este hilo).
+                    # Si el usuario no existe también se verifica contra un hash
+                    # ficticio, así la respuesta tarda lo mismo en ambos casos.
+                    stored_hash = usuario['password'] if usuario else None
+                    password_valid = verificador_passwords.verificar(password, stored_hash)
+                    if usuario and stored_hash:
+                        if password_valid and verificador_passwords.necesita_rehash(stored_hash):
+                            # Hash antiguo (bcrypt de PHP u otro método): se reemplaza por
+                            # uno del método actual; si falla, el login sigue igual
                             try:
-                                import bcrypt
-                                # Si el hash empieza con $2y$ o $2b$, es bcrypt de PHP
-                                if stored_hash.startswith('$2y$') or stored_hash.startswith('$2b$'):
-                                    # Convertir $2y$ a $2b$ si es necesario (bcrypt de Python usa $2b$)
-                                    hash_to_check = stored_hash.replace('$2y$', '$2b$', 1)
-                                    password_valid = bcrypt.checkpw(password.encode('utf-8'), hash_to_check.encode('utf-8'))
-                            except (ImportError, ValueError, TypeError):
-                                password_valid = False
+                                cursor.execute("UPDATE usuarios SET password = %s WHERE usuario_id = %s",
+                                               (verificador_passwords.hashear(password), usuario['usuario_id']))
+                                conn.commit()
+                                logger.info("Contraseña del usuario %s migrada a %s", usuario['usuario_id'],
+                                            verificador_passwords.metodo.split(':')[0])
+                            except (Error, VerificacionSaturada) as e:
+                                logger.warning("No se pudo actualizar el hash del usuario %s: %s", usuario['usuario_id'], e)
                         
                         if password_valid:
                             session['usuario_id'] = usuario['usuario_id']
@@ -1224,6 +3007,8 @@ def login():
                             flash('Usuario o contraseña incorrectos', 'danger')
                     else:
                         flash('Usuario o contraseña incorrectos', 'danger')
+                except VerificacionSaturada:
+                    flash('Hay muchos inicios de sesión en este momento, intenta de nuevo en unos segundos', 'warning')
                 except Error as e:
                     flash(f'Error al verificar credenciales: {str(e)}', 'danger')
                 finally:
@@ -1247,6 +3032,89 @@ def logout():
     flash('Sesión cerrada correctamente', 'info')
     return redirect(url_for('index'))
 
+# Enlaces para elegir contraseña (correo de bienvenida de un admin nuevo).
+# La contraseña nunca viaja en el correo ni se guarda en correos_pendientes:
+# el correo lleva un enlace firmado con el usuario_id y una huella del hash
+# actual. Al guardar la contraseña nueva el hash cambia, así el enlace sirve
+# una sola vez; además vence a las CORREO_ENLACE_HORAS.
+ENLACES_CONFIG = {
+    # Dirección pública de la aplicación (los correos se arman fuera de un request)
+    'url_publica': os.environ.get('URL_PUBLICA', 'http://localhost:5000').rstrip('/'),
+    'horas': int(os.environ.get('CORREO_ENLACE_HORAS', 72))  # Vigencia del enlace
+}
+
+enlaces_password = URLSafeTimedSerializer(app.secret_key, salt='establecer-password')
+
+def huella_password(password_hash):
+    return hashlib.sha256((password_hash or '').encode('utf-8')).hexdigest()[:16]
+
+def enlace_establecer_password(usuario):
+    """URL absoluta (con URL_PUBLICA) para que el usuario elija su contraseña."""
+    token = enlaces_password.dumps({'u': usuario['usuario_id'], 'h': huella_password(usuario['password'])})
+    # Se arma sin request (lo llaman los hilos de la cola de correos)
+    ruta = app.url_map.bind('').build('establecer_password', {'token': token})
+    return ENLACES_CONFIG['url_publica'] + ruta
+
+def usuario_de_enlace(cursor, token):
+    """Regresa el usuario del enlace, o None si es inválido, venció o ya se usó."""
+    try:
+        datos = enlaces_password.loads(token, max_age=ENLACES_CONFIG['horas'] * 3600)
+    except (SignatureExpired, BadSignature):
+        return None
+    cursor.execute("SELECT usuario_id, username, nombre, password FROM usuarios WHERE usuario_id = %s AND activo = 1",
+                   (datos.get('u'),))
+    usuario = cursor.fetchone()
+    if not usuario or not hmac.compare_digest(huella_password(usuario['password']), str(datos.get('h'))):
+        return None
+    return usuario
+
+@app.route('/establecer_password/<token>', methods=['GET', 'POST'])
+def establecer_password(token):
+    """
+    Página donde un usuario nuevo elige su contraseña con el enlace del correo.
+
+    Si el enlace es inválido, venció o ya se usó, se manda al login con un aviso.
+    """
+    conn = get_db_connection()
+    if not conn:
+        flash('Error de conexión a la base de datos', 'danger')
+        return redirect(url_for('login'))
+    try:
+        cursor = get_cursor(conn)
+        usuario = usuario_de_enlace(cursor, token)
+        if not usuario:
+            flash('El enlace no es válido o ya venció. Pide a un administrador que te asigne una contraseña.', 'warning')
+            return redirect(url_for('login'))
+
+        if request.method == 'POST':
+            password = request.form.get('password', '').strip()
+            confirmacion = request.form.get('confirmacion', '').strip()
+            if not password:
+                flash('Escribe la contraseña nueva', 'warning')
+            elif password != confirmacion:
+                flash('Las contraseñas no coinciden', 'warning')
+            else:
+                cursor.execute("UPDATE usuarios SET password = %s WHERE usuario_id = %s AND password = %s",
+                               (verificador_passwords.hashear(password), usuario['usuario_id'], usuario['password']))
+                conn.commit()
+                if cursor.rowcount:
+                    flash('Contraseña guardada. Ya puedes iniciar sesión.', 'success')
+                else:
+                    # Otro request usó el mismo enlace al mismo tiempo
+                    flash('El enlace ya se usó.', 'warning')
+                return redirect(url_for('login'))
+
+        return render_template('establecer_password.html', usuario=usuario, token=token)
+    except VerificacionSaturada:
+        flash('Hay muchos inicios de sesión en este momento, intenta de nuevo en unos segundos', 'warning')
+        return redirect(url_for('establecer_password', token=token))
+    except Error as e:
+        logger.exception("Error de BD en establecer_password: %s", e)
+        flash('Error de base de datos. Por favor intenta más tarde.', 'danger')
+        return redirect(url_for('login'))
+    finally:
+        conn.close()
+
 # ============================================
 # RUTAS DE USUARIO
 # ============================================
@@ -1265,10 +3133,9 @@ def user_dashboard():
     - Últimas 5 citas
     - Últimas 5 cotizaciones
     
-    Todo esto basado en el email del usuario en sesión.
+    Todo esto basado en el propietario_id de cada cita y cotización.
     """
     usuario_id = session.get('usuario_id')
-    usuario_email = session.get('email', '')
     
     conn = get_db_connection()
     if not conn:
@@ -1285,25 +3152,21 @@ def user_dashboard():
         ultimas_cotizaciones = []
         
         try:
-            # Contar citas del usuario (por email)
-            cursor.execute("""SELECT COUNT(*) as total FROM citas c
-                             LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                             WHERE cl.correo = %s OR c.email = %s""", (usuario_email, usuario_email))
+            # Contar citas del usuario
+            cursor.execute("SELECT COUNT(*) as total FROM citas WHERE propietario_id = %s", (usuario_id,))
             result = cursor.fetchone()
             total_citas = result['total'] if result else 0
         except Error as e:
-            print(f"[ERROR] Error contando citas del usuario: {e}")
+            logger.error("Error contando citas del usuario: %s", e)
             total_citas = 0
         
         try:
-            # Contar cotizaciones del usuario (por email)
-            cursor.execute("""SELECT COUNT(*) as total FROM cotizaciones c
-                             LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                             WHERE cl.correo = %s OR c.email = %s""", (usuario_email, usuario_email))
+            # Contar cotizaciones del usuario
+            cursor.execute("SELECT COUNT(*) as total FROM cotizaciones WHERE propietario_id = %s", (usuario_id,))
             result = cursor.fetchone()
             total_cotizaciones = result['total'] if result else 0
         except Error as e:
-            print(f"[ERROR] Error contando cotizaciones del usuario: {e}")
+            logger.error("Error contando cotizaciones del usuario: %s", e)
             total_cotizaciones = 0
         
         try:
@@ -1316,9 +3179,9 @@ def user_dashboard():
                              LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
                              LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
                              LEFT JOIN cotizaciones cot ON c.cotizacion_id = cot.cotizacion_id
-                             WHERE c.usuario_id = %s OR cl.correo = %s OR c.email = %s
+                             WHERE c.propietario_id = %s
                              ORDER BY c.fecha DESC, c.hora DESC 
-                             LIMIT 5""", (usuario_id, usuario_email, usuario_email))
+                             LIMIT 5""", (usuario_id,))
             ultimas_citas = cursor.fetchall()
             
             # Convertir horas de timedelta a time
@@ -1330,9 +3193,9 @@ def user_dashboard():
                         minutes = (total_seconds % 3600) // 60
                         cita['hora'] = time(hours, minutes)
                 except Exception as e:
-                    print(f"[ERROR] Error convirtiendo hora de cita: {e}")
+                    logger.error("Error convirtiendo hora de cita: %s", e)
         except Error as e:
-            print(f"[ERROR] Error obteniendo últimas citas: {e}")
+            logger.error("Error obteniendo últimas citas: %s", e)
             ultimas_citas = []
         
         try:
@@ -1343,25 +3206,15 @@ def user_dashboard():
                              FROM cotizaciones c 
                              LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
                              LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                             WHERE c.usuario_id = %s OR cl.correo = %s OR c.email = %s 
+                             WHERE c.propietario_id = %s 
                              ORDER BY c.fecha_envio DESC 
-                             LIMIT 5""", (usuario_id, usuario_email, usuario_email))
+                             LIMIT 5""", (usuario_id,))
             ultimas_cotizaciones = cursor.fetchall()
             
-            # Obtener servicios relacionados para cada cotización
-            for cotizacion in ultimas_cotizaciones:
-                try:
-                    cursor.execute("""SELECT s.servicio_id, s.nombre, cs.precio_calculado as precio_servicio
-                                     FROM cotizaciones_servicios cs
-                                     JOIN servicios s ON cs.servicio_id = s.servicio_id
-                                     WHERE cs.cotizacion_id = %s
-                                     ORDER BY s.nombre""", (cotizacion['cotizacion_id'],))
-                    servicios_relacionados = cursor.fetchall()
-                    cotizacion['servicios_relacionados'] = servicios_relacionados
-                except Error:
-                    cotizacion['servicios_relacionados'] = []
+            # Obtener servicios relacionados de todas las cotizaciones en una sola consulta
+            agregar_servicios_relacionados(cursor, 'cotizaciones', ultimas_cotizaciones, 'cotizacion_id')
         except Error as e:
-            print(f"[ERROR] Error obteniendo últimas cotizaciones: {e}")
+            logger.error("Error obteniendo últimas cotizaciones: %s", e)
             ultimas_cotizaciones = []
         
         return render_template('usuario/dashboard.html', 
@@ -1371,15 +3224,11 @@ def user_dashboard():
                              ultimas_cotizaciones=ultimas_cotizaciones)
     
     except Error as e:
-        print(f"[ERROR] Error de BD en user_dashboard: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en user_dashboard: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('index'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en user_dashboard: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en user_dashboard: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('index'))
     finally:
@@ -1387,7 +3236,7 @@ def user_dashboard():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en user_dashboard: {e}")
+                logger.error("Error cerrando conexión en user_dashboard: %s", e)
 
 @app.route('/usuario/citas')
 @login_required
@@ -1397,10 +3246,9 @@ def user_citas():
     
     Muestra todas las citas del usuario ordenadas por fecha y hora (más recientes primero).
     También muestra el estatus de cada cita (Pendiente, Confirmada, etc.).
-    Las citas se identifican por usuario_id o email del usuario en sesión.
+    Las citas del usuario son las que tienen su usuario_id como propietario_id.
     """
     usuario_id = session.get('usuario_id')
-    usuario_email = session.get('email', '')
     
     conn = get_db_connection()
     if not conn:
@@ -1409,7 +3257,7 @@ def user_citas():
     
     try:
         cursor = get_cursor(conn)
-        # Filtrar por usuario_id (prioritario) o por email (compatibilidad con citas antiguas)
+        # Las citas del usuario son las que tienen su propietario_id (ver vincular_propietarios)
         cursor.execute("""SELECT c.*, cl.nombre as cliente_nombre, cl.telefono as cliente_telefono, 
                          cl.correo as cliente_correo, s.nombre as servicio_nombre_completo,
                          cot.cotizacion_id, cot.precio_calculado as cotizacion_precio,
@@ -1419,23 +3267,12 @@ def user_citas():
                          LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
                          LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
                          LEFT JOIN cotizaciones cot ON c.cotizacion_id = cot.cotizacion_id
-                         WHERE c.usuario_id = %s OR cl.correo = %s OR c.email = %s
-                         ORDER BY c.fecha DESC, c.hora DESC""", (usuario_id, usuario_email, usuario_email))
+                         WHERE c.propietario_id = %s
+                         ORDER BY c.fecha DESC, c.hora DESC""", (usuario_id,))
         citas = cursor.fetchall()
         
-        # Obtener servicios relacionados para cada cita
-        for cita in citas:
-            try:
-                cursor.execute("""SELECT s.servicio_id, s.nombre 
-                                 FROM citas_servicios cs
-                                 JOIN servicios s ON cs.servicio_id = s.servicio_id
-                                 WHERE cs.cita_id = %s
-                                 ORDER BY s.nombre""", (cita['cita_id'],))
-                servicios_relacionados = cursor.fetchall()
-                cita['servicios_relacionados'] = servicios_relacionados
-            except Error as e:
-                print(f"[ERROR] Error obteniendo servicios relacionados para cita {cita['cita_id']}: {e}")
-                cita['servicios_relacionados'] = []
+        # Obtener servicios relacionados de todas las citas en una sola consulta
+        agregar_servicios_relacionados(cursor, 'citas', citas, 'cita_id')
         
         # Convertir horas de timedelta a time
         for cita in citas:
@@ -1454,21 +3291,17 @@ def user_citas():
                     except ValueError:
                         pass
             except Exception as e:
-                print(f"[ERROR] Error convirtiendo hora en user_citas: {e}")
+                logger.error("Error convirtiendo hora en user_citas: %s", e)
                 continue
         
         return render_template('usuario/citas.html', citas=citas)
     
     except Error as e:
-        print(f"[ERROR] Error de BD en user_citas: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en user_citas: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('user_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en user_citas: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en user_citas: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('user_dashboard'))
     finally:
@@ -1476,7 +3309,7 @@ def user_citas():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en user_citas: {e}")
+                logger.error("Error cerrando conexión en user_citas: %s", e)
 
 @app.route('/usuario/cotizaciones')
 @login_required
@@ -1487,10 +3320,9 @@ def user_cotizaciones():
     Muestra todas las cotizaciones que el usuario ha solicitado,
     ordenadas por fecha (más recientes primero).
     Incluye el servicio, vehículo, precio calculado y fecha.
-    Las cotizaciones se identifican por usuario_id o email del usuario en sesión.
+    Las cotizaciones del usuario son las que tienen su usuario_id como propietario_id.
     """
     usuario_id = session.get('usuario_id')
-    usuario_email = session.get('email', '')
     
     conn = get_db_connection()
     if not conn:
@@ -1499,42 +3331,27 @@ def user_cotizaciones():
     
     try:
         cursor = get_cursor(conn)
-        # Filtrar por usuario_id (prioritario) o por email (compatibilidad con cotizaciones antiguas)
+        # Las cotizaciones del usuario son las que tienen su propietario_id (ver vincular_propietarios)
         cursor.execute("""SELECT c.*, s.nombre as servicio_nombre, 
                          cl.nombre as cliente_nombre, cl.telefono as cliente_telefono, cl.correo as cliente_correo
                          FROM cotizaciones c 
                          LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
                          LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                         WHERE c.usuario_id = %s OR cl.correo = %s OR c.email = %s 
-                         ORDER BY c.fecha_envio DESC""", (usuario_id, usuario_email, usuario_email))
+                         WHERE c.propietario_id = %s 
+                         ORDER BY c.fecha_envio DESC""", (usuario_id,))
         cotizaciones = cursor.fetchall()
         
-        # Obtener servicios relacionados para cada cotización
-        for cotizacion in cotizaciones:
-            try:
-                cursor.execute("""SELECT s.servicio_id, s.nombre, cs.precio_calculado as precio_servicio
-                                 FROM cotizaciones_servicios cs
-                                 JOIN servicios s ON cs.servicio_id = s.servicio_id
-                                 WHERE cs.cotizacion_id = %s
-                                 ORDER BY s.nombre""", (cotizacion['cotizacion_id'],))
-                servicios_relacionados = cursor.fetchall()
-                cotizacion['servicios_relacionados'] = servicios_relacionados
-            except Error as e:
-                print(f"[ERROR] Error obteniendo servicios relacionados para cotización {cotizacion['cotizacion_id']}: {e}")
-                cotizacion['servicios_relacionados'] = []
+        # Obtener servicios relacionados de todas las cotizaciones en una sola consulta
+        agregar_servicios_relacionados(cursor, 'cotizaciones', cotizaciones, 'cotizacion_id')
         
         return render_template('usuario/cotizaciones.html', cotizaciones=cotizaciones)
     
     except Error as e:
-        print(f"[ERROR] Error de BD en user_cotizaciones: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en user_cotizaciones: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('user_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en user_cotizaciones: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en user_cotizaciones: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('user_dashboard'))
     finally:
@@ -1542,7 +3359,27 @@ def user_cotizaciones():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en user_cotizaciones: {e}")
+                logger.error("Error cerrando conexión en user_cotizaciones: %s", e)
+
+CONSULTA_DETALLE_COTIZACION = """SELECT c.*, s.nombre as servicio_nombre 
+                                 FROM cotizaciones c 
+                                 LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
+                                 WHERE c.cotizacion_id = %s AND c.propietario_id = %s"""
+
+def detalle_cotizacion_json(cotizacion):
+    """Convierte la fila de CONSULTA_DETALLE_COTIZACION a un diccionario serializable."""
+    return {
+        'id': cotizacion['cotizacion_id'],
+        'servicio': cotizacion.get('servicio', ''),
+        'servicio_nombre': cotizacion.get('servicio_nombre', ''),
+        'marca_vehiculo': cotizacion.get('marca_vehiculo', ''),
+        'modelo_vehiculo': cotizacion.get('modelo_vehiculo', ''),
+        'anio_vehiculo': cotizacion.get('anio_vehiculo'),
+        'cilindros': cotizacion.get('cilindros'),
+        'precio_calculado': float(cotizacion.get('precio_calculado', 0)) if cotizacion.get('precio_calculado') else 0,
+        'fecha_envio': cotizacion.get('fecha_envio').isoformat() if cotizacion.get('fecha_envio') else None,
+        'mensaje': cotizacion.get('mensaje', '')
+    }
 
 @app.route('/usuario/cotizaciones/<int:cotizacion_id>/detalles')
 @login_required
@@ -1551,7 +3388,6 @@ def user_cotizacion_detalles(cotizacion_id):
     Obtiene los detalles de una cotización específica para mostrarla en un modal.
     """
     usuario_id = session.get('usuario_id')
-    usuario_email = session.get('email', '')
     
     conn = get_db_connection()
     if not conn:
@@ -1560,35 +3396,16 @@ def user_cotizacion_detalles(cotizacion_id):
     try:
         cursor = get_cursor(conn)
         # Verificar que la cotización pertenece al usuario
-        cursor.execute("""SELECT c.*, s.nombre as servicio_nombre 
-                         FROM cotizaciones c 
-                         LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
-                         LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                         WHERE c.cotizacion_id = %s AND (c.usuario_id = %s OR cl.correo = %s OR c.email = %s)""",
-                      (cotizacion_id, usuario_id, usuario_email, usuario_email))
+        cursor.execute(CONSULTA_DETALLE_COTIZACION, (cotizacion_id, usuario_id))
         cotizacion = cursor.fetchone()
         
         if not cotizacion:
             return jsonify({'success': False, 'error': 'Cotización no encontrada o no tienes permisos'})
         
-        # Convertir a diccionario serializable
-        cotizacion_dict = {
-            'id': cotizacion['cotizacion_id'],
-            'servicio': cotizacion.get('servicio', ''),
-            'servicio_nombre': cotizacion.get('servicio_nombre', ''),
-            'marca_vehiculo': cotizacion.get('marca_vehiculo', ''),
-            'modelo_vehiculo': cotizacion.get('modelo_vehiculo', ''),
-            'anio_vehiculo': cotizacion.get('anio_vehiculo'),
-            'cilindros': cotizacion.get('cilindros'),
-            'precio_calculado': float(cotizacion.get('precio_calculado', 0)) if cotizacion.get('precio_calculado') else 0,
-            'fecha_envio': cotizacion.get('fecha_envio').isoformat() if cotizacion.get('fecha_envio') else None,
-            'mensaje': cotizacion.get('mensaje', '')
-        }
-        
-        return jsonify({'success': True, 'cotizacion': cotizacion_dict})
+        return jsonify({'success': True, 'cotizacion': detalle_cotizacion_json(cotizacion)})
     
     except Exception as e:
-        print(f"[ERROR] Error obteniendo detalles de cotización: {e}")
+        logger.error("Error obteniendo detalles de cotización: %s", e)
         return jsonify({'success': False, 'error': str(e)})
     finally:
         if conn:
@@ -1613,35 +3430,157 @@ def user_reenviar_cotizacion():
     try:
         cursor = get_cursor(conn)
         # Verificar que la cotización pertenece al usuario
-        cursor.execute("""SELECT c.* FROM cotizaciones c 
-                         LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                         WHERE c.cotizacion_id = %s AND (c.usuario_id = %s OR cl.correo = %s OR c.email = %s)""",
-                      (cotizacion_id, usuario_id, session.get('email', ''), session.get('email', '')))
+        cursor.execute("""SELECT cotizacion_id FROM cotizaciones 
+                         WHERE cotizacion_id = %s AND propietario_id = %s""",
+                      (cotizacion_id, usuario_id))
         cotizacion = cursor.fetchone()
         
         if not cotizacion:
             return jsonify({'success': False, 'error': 'Cotización no encontrada o no tienes permisos'})
         
-        # Reenviar correo
+        # Reenviar correo (se pone en la cola y se envía en segundo plano)
         if enviar_cotizacion_por_correo(cotizacion_id):
-            return jsonify({'success': True, 'message': 'Cotización reenviada correctamente'})
+            return jsonify({'success': True, 'message': 'La cotización se reenviará a tu correo en unos momentos'})
         else:
-            return jsonify({'success': False, 'error': 'Error al enviar el correo'})
+            return jsonify({'success': False, 'error': 'No se pudo reenviar el correo'})
     
     except Exception as e:
-        print(f"[ERROR] Error reenviando cotización: {e}")
+        logger.error("Error reenviando cotización: %s", e)
         return jsonify({'success': False, 'error': str(e)})
     finally:
         if conn:
             conn.close()
 
+# ============================================
+# ESTADÍSTICAS DEL PANEL ADMIN
+# ============================================
+# Contar filas con COUNT(*) recorre toda la tabla, así que el dashboard lee
+# contadores ya calculados:
+# - estadisticas_totales: un renglón por estadística (usuarios, servicios, citas, cotizaciones)
+# - estadisticas_diarias: citas y cotizaciones registradas por día
+# Las rutas que crean o eliminan registros actualizan los contadores en la misma
+# transacción. Si algo se descuadra, el botón "Recalcular" del dashboard los
+# reconstruye desde las tablas originales.
+
+ESTADISTICAS = ('usuarios', 'servicios', 'citas', 'cotizaciones')
+ESTADISTICAS_DIARIAS = ('citas', 'cotizaciones')
+DIAS_ESTADISTICAS = 14  # Días que se muestran en el desglose diario
+SEMANAS_ESTADISTICAS = 8  # Semanas que se muestran en el desglose semanal
+
+# Cómo se cuenta cada estadística desde su tabla (solo para recalcular)
+CONTEOS_ESTADISTICAS = {
+    'usuarios': "SELECT COUNT(*) FROM usuarios WHERE activo = 1",
+    'servicios': "SELECT COUNT(*) FROM servicios",
+    'citas': "SELECT COUNT(*) FROM citas",
+    'cotizaciones': "SELECT COUNT(*) FROM cotizaciones"
+}
+
+# Columna con la fecha de registro de cada tabla (para el desglose por día)
+FECHAS_ESTADISTICAS = {
+    'citas': ('citas', 'fecha_registro'),
+    'cotizaciones': ('cotizaciones', 'fecha_envio')
+}
+
+def sumar_estadistica(cursor, nombre, cantidad=1, fecha=None):
+    """
+    Suma (o resta, con cantidad negativa) a un contador del dashboard.
+    
+    No hace commit: se llama dentro de la transacción que crea o elimina el
+    registro. Para citas y cotizaciones también suma al día indicado (hoy
+    si no se indica).
+    """
+    cursor.execute("""INSERT INTO estadisticas_totales (nombre, total) VALUES (%s, %s) 
+                      ON DUPLICATE KEY UPDATE total = total + VALUES(total)""", (nombre, cantidad))
+    if nombre in ESTADISTICAS_DIARIAS:
+        cursor.execute("""INSERT INTO estadisticas_diarias (fecha, nombre, total) 
+                          VALUES (COALESCE(%s, CURDATE()), %s, %s) 
+                          ON DUPLICATE KEY UPDATE total = total + VALUES(total)""", (fecha, nombre, cantidad))
+
+def recontar_estadistica(cursor, nombre):
+    """
+    Vuelve a contar una estadística desde su tabla (no hace commit).
+    
+    Se usa para usuarios y servicios: cambian pocas veces y desde el panel
+    admin, así que es más simple recontar que llevar la cuenta de cada caso
+    (por ejemplo, un usuario que pasa de activo a inactivo).
+    """
+    cursor.execute(f"REPLACE INTO estadisticas_totales (nombre, total) SELECT %s, ({CONTEOS_ESTADISTICAS[nombre]})",
+                   (nombre,))
+
+def recalcular_estadisticas(cursor):
+    """Reconstruye todos los contadores y el desglose por día desde las tablas originales (no hace commit)."""
+    for nombre in ESTADISTICAS:
+        recontar_estadistica(cursor, nombre)
+    cursor.execute("DELETE FROM estadisticas_diarias")
+    for nombre, (tabla, columna) in FECHAS_ESTADISTICAS.items():
+        cursor.execute(f"""INSERT INTO estadisticas_diarias (fecha, nombre, total) 
+                           SELECT DATE({columna}), %s, COUNT(*) FROM {tabla} 
+                           GROUP BY DATE({columna})""", (nombre,))
+
+def contar_estadisticas_directo(cursor):
+    """Cuenta las estadísticas desde las tablas originales en una consulta (sin desglose por día)."""
+    columnas = ', '.join(f"({sql}) AS {nombre}" for nombre, sql in CONTEOS_ESTADISTICAS.items())
+    cursor.execute(f"SELECT {columnas}")
+    fila = cursor.fetchone()
+    return {nombre: int(fila[nombre] or 0) for nombre in ESTADISTICAS}, [], []
+
+def leer_estadisticas(cursor):
+    """
+    Lee los contadores y el desglose por día en una sola consulta.
+    
+    Returns:
+        tuple: (stats, por_dia, por_semana), o None si todavía no hay contadores.
+               por_dia tiene los últimos DIAS_ESTADISTICAS días y por_semana las
+               últimas SEMANAS_ESTADISTICAS semanas (de lunes a domingo), ambos
+               del más reciente al más antiguo.
+    """
+    hoy = datetime.now().date()
+    inicio_semanas = hoy - timedelta(days=hoy.weekday() + 7 * (SEMANAS_ESTADISTICAS - 1))
+    desde = min(inicio_semanas, hoy - timedelta(days=DIAS_ESTADISTICAS - 1))
+    cursor.execute("""SELECT nombre, NULL AS fecha, total FROM estadisticas_totales 
+                      UNION ALL 
+                      SELECT nombre, fecha, total FROM estadisticas_diarias WHERE fecha BETWEEN %s AND %s""",
+                   (desde, hoy))
+    filas = cursor.fetchall()
+    
+    stats = {nombre: 0 for nombre in ESTADISTICAS}
+    totales_encontrados = False
+    por_fecha = {}
+    for fila in filas:
+        if fila['fecha'] is None:
+            stats[fila['nombre']] = int(fila['total'])
+            totales_encontrados = True
+        else:
+            fecha = fila['fecha'].date() if isinstance(fila['fecha'], datetime) else fila['fecha']
+            por_fecha.setdefault(fecha, {})[fila['nombre']] = int(fila['total'])
+    if not totales_encontrados:
+        return None
+    
+    por_dia = []
+    for i in range(DIAS_ESTADISTICAS):
+        fecha = hoy - timedelta(days=i)
+        dia = {'fecha': fecha}
+        for nombre in ESTADISTICAS_DIARIAS:
+            dia[nombre] = por_fecha.get(fecha, {}).get(nombre, 0)
+        por_dia.append(dia)
+    
+    por_semana = []
+    for i in range(SEMANAS_ESTADISTICAS):
+        lunes = inicio_semanas + timedelta(days=7 * (SEMANAS_ESTADISTICAS - 1 - i))
+        semana = {'inicio': lunes, 'fin': lunes + timedelta(days=6)}
+        for nombre in ESTADISTICAS_DIARIAS:
+            semana[nombre] = sum(por_fecha.get(lunes + timedelta(days=d), {}).get(nombre, 0) for d in range(7))
+        por_semana.append(semana)
+    
+    return stats, por_dia, por_semana
+
 # ============================================
 # RUTAS ADMINISTRATIVAS
 # ============================================
 # Estas rutas son solo para administradores.
 # Requieren estar logueados Y ser admin (@admin_required).
 
-@app.route('/admin')
+@app.route('/admin', methods=['GET', 'POST'])
 @admin_required
 def admin_dashboard():
     """
@@ -1652,9 +3591,11 @@ def admin_dashboard():
     - Total de servicios
     - Total de citas
     - Total de cotizaciones
+    - Citas y cotizaciones registradas por día y por semana
     
-    Cada estadística tiene su propio try-except para que si una tabla
-    no existe, no crashee todo el dashboard.
+    Todo sale de los contadores de estadisticas_totales y estadisticas_diarias
+    en una sola consulta. Si todavía no hay contadores (base de datos creada
+    antes de esta función), se calculan la primera vez.
     """
     conn = get_db_connection()
     if not conn:
@@ -1664,53 +3605,34 @@ def admin_dashboard():
     try:
         cursor = get_cursor(conn)
         
-        # Estadísticas con manejo de errores individual
-        stats = {
-            'usuarios': 0,
-            'servicios': 0,
-            'citas': 0,
-            'cotizaciones': 0
-        }
-        
-        try:
-            cursor.execute("SELECT COUNT(*) as total FROM usuarios WHERE activo = 1")
-            result = cursor.fetchone()
-            stats['usuarios'] = result['total'] if result else 0
-        except Error:
-            stats['usuarios'] = 0
-        
-        try:
-            cursor.execute("SELECT COUNT(*) as total FROM servicios")
-            result = cursor.fetchone()
-            stats['servicios'] = result['total'] if result else 0
-        except Error:
-            stats['servicios'] = 0
-        
-        try:
-            cursor.execute("SELECT COUNT(*) as total FROM citas")
-            result = cursor.fetchone()
-            stats['citas'] = result['total'] if result else 0
-        except Error:
-            stats['citas'] = 0
+        if request.method == 'POST' and request.form.get('accion') == 'recalcular':
+            recalcular_estadisticas(cursor)
+            conn.commit()
+            flash('Estadísticas recalculadas', 'success')
+            return redirect(url_for('admin_dashboard'))
         
         try:
-            cursor.execute("SELECT COUNT(*) as total FROM cotizaciones")
-            result = cursor.fetchone()
-            stats['cotizaciones'] = result['total'] if result else 0
-        except Error:
-            stats['cotizaciones'] = 0
+            resultado = leer_estadisticas(cursor)
+        except Error as e:
+            if e.errno != errorcode.ER_NO_SUCH_TABLE:
+                raise
+            # Base de datos sin las tablas de estadísticas: contar directo (más lento, sin desglose)
+            logger.warning("Faltan las tablas de estadísticas, contando directo: %s", e)
+            resultado = contar_estadisticas_directo(cursor)
+        if resultado is None:
+            logger.info("No hay contadores de estadísticas, calculándolos desde las tablas")
+            recalcular_estadisticas(cursor)
+            conn.commit()
+            resultado = leer_estadisticas(cursor)
+        stats, por_dia, por_semana = resultado
         
-        return render_template('admin/dashboard.html', stats=stats)
+        return render_template('admin/dashboard.html', stats=stats, por_dia=por_dia, por_semana=por_semana)
     except Error as e:
-        print(f"[ERROR] Error de BD en admin_dashboard: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en admin_dashboard: %s", e)
         flash(f'Error de base de datos: {str(e)}. Por favor ejecuta el script SQL para crear las tablas faltantes.', 'danger')
         return redirect(url_for('index'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en admin_dashboard: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en admin_dashboard: %s", e)
         flash(f'Error al cargar estadísticas: {str(e)}. Por favor ejecuta el script SQL para crear las tablas faltantes.', 'danger')
         return redirect(url_for('index'))
     finally:
@@ -1718,7 +3640,62 @@ def admin_dashboard():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en admin_dashboard: {e}")
+                logger.error("Error cerrando conexión en admin_dashboard: %s", e)
+
+@app.route('/admin/metricas/pool')
+@admin_required
+def admin_metricas_pool():
+    """
+    API con las métricas del pool de conexiones a la BD (para monitoreo).
+    
+    Retorna JSON con las conexiones prestadas, libres, cuántos hilos están
+    esperando una conexión y cuánto tiempo han esperado.
+    """
+    return jsonify(db_pool.metricas())
+
+@app.route('/admin/metricas')
+def admin_metricas():
+    """
+    Métricas de rendimiento en formato de texto de Prometheus.
+    
+    Solo para administradores: con sesión de admin, o (para Prometheus)
+    con el header Authorization: Bearer <METRICAS_TOKEN>.
+    Incluye latencia por endpoint, consultas y tiempo de BD por request,
+    tiempo de envío de correos y el estado del pool de conexiones.
+    Con METRICAS_DIR (varios workers) los números son la suma de todos.
+    """
+    token = METRICAS_CONFIG['token']
+    autorizacion = request.headers.get('Authorization', '')
+    por_token = bool(token) and hmac.compare_digest(autorizacion.encode(), f'Bearer {token}'.encode())
+    if not por_token and not ('usuario_id' in session and session.get('rol') == 'admin'):
+        return 'No autorizado', 403
+    
+    extra = medidores_proceso()
+    if not metricas_compartidas.activo:
+        return metricas.exportar(extra), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    
+    # Varios workers: se suman los números que cada uno guardó en METRICAS_DIR
+    guardar_metricas_proceso(forzar=True)
+    total, instantaneas, vivos = metricas_compartidas.combinar()
+    extra = {nombre: (ayuda, instantaneas.get(nombre, valor)) for nombre, (ayuda, valor) in extra.items()}
+    extra['taller_procesos'] = ('Workers que aportan a estas métricas', vivos)
+    return total.exportar(extra), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def medidores_proceso():
+    """Gauges de este proceso para /admin/metricas: {nombre: (ayuda, valor)}."""
+    pool = db_pool.metricas()
+    return {
+        'taller_db_pool_prestadas': ('Conexiones del pool prestadas en este momento', pool['prestadas']),
+        'taller_db_pool_libres': ('Conexiones del pool abiertas y libres', pool['libres']),
+        'taller_db_pool_en_espera': ('Hilos esperando una conexión del pool', pool['en_espera']),
+        'taller_db_pool_esperas_agotadas': ('Veces que se agotó la espera por una conexión', pool['esperas_agotadas']),
+        'taller_password_hash_en_espera': ('Verificaciones de contraseña en cola o en proceso', verificador_passwords.pendientes)
+    }
+
+def guardar_metricas_proceso(forzar=False):
+    """Guarda las métricas de este proceso en METRICAS_DIR (si está configurado)."""
+    if metricas_compartidas.activo:
+        metricas_compartidas.guardar({nombre: valor for nombre, (_, valor) in medidores_proceso().items()}, forzar)
 
 @app.route('/admin/usuarios', methods=['GET', 'POST'])
 @admin_required
@@ -1759,21 +3736,25 @@ def admin_usuarios():
                     if rol_id == 1 and not email:
                         flash('El correo electrónico es obligatorio para usuarios administradores', 'warning')
                     else:
-                        password_hash = generate_password_hash(password)
+                        password_hash = verificador_passwords.hashear(password)
                         sql = """INSERT INTO usuarios (username, password, nombre, email, telefono, rol_id) 
                                  VALUES (%s, %s, %s, %s, %s, %s)"""
                         cursor.execute(sql, (username, password_hash, nombre, email, telefono, rol_id))
                         usuario_id = cursor.lastrowid
+                        recontar_estadistica(cursor, 'usuarios')
+                        # Asignarle las citas y cotizaciones que hizo como invitado con este correo
+                        vincular_registros_usuario(cursor, usuario_id, email)
+                        
+                        # Si es admin y tiene correo, encolar el correo de bienvenida
+                        # (se guarda en la misma transacción que el usuario)
+                        # (no lleva la contraseña: el correo trae un enlace para elegirla)
+                        if rol_id == 1 and email:
+                            encolar_correo(cursor, 'bienvenida_admin', usuario_id, email)
                         conn.commit()
                         
-                        # Si es admin y tiene correo, enviar correo de bienvenida
                         if rol_id == 1 and email:
-                            try:
-                                enviar_correo_bienvenida_admin(email, nombre, username, password)
-                                flash('Usuario creado exitosamente. Correo de bienvenida enviado.', 'success')
-                            except Exception as e:
-                                print(f"Error enviando correo: {e}")
-                                flash('Usuario creado exitosamente, pero no se pudo enviar el correo de bienvenida', 'warning')
+                            cola_correos.despertar()
+                            flash('Usuario creado exitosamente. El correo de bienvenida se enviará en unos momentos.', 'success')
                         else:
                             flash('Usuario creado exitosamente', 'success')
                 else:
@@ -1790,6 +3771,8 @@ def admin_usuarios():
                 sql = """UPDATE usuarios SET nombre = %s, email = %s, telefono = %s, 
                          rol_id = %s, activo = %s WHERE usuario_id = %s"""
                 cursor.execute(sql, (nombre, email, telefono, rol_id, activo, usuario_id))
+                recontar_estadistica(cursor, 'usuarios')  # Pudo cambiar de activo a inactivo
+                vincular_registros_usuario(cursor, usuario_id, email)  # Por si cambió el correo
                 conn.commit()
                 flash('Usuario actualizado exitosamente', 'success')
             
@@ -1799,6 +3782,7 @@ def admin_usuarios():
                     flash('No puede eliminar su propio usuario', 'danger')
                 else:
                     cursor.execute("DELETE FROM usuarios WHERE usuario_id = %s", (usuario_id,))
+                    recontar_estadistica(cursor, 'usuarios')
                     conn.commit()
                     flash('Usuario eliminado exitosamente', 'success')
             
@@ -1806,7 +3790,7 @@ def admin_usuarios():
                 usuario_id = int(request.form.get('id', 0))
                 password = request.form.get('password', '').strip()
                 if password:
-                    password_hash = generate_password_hash(password)
+                    password_hash = verificador_passwords.hashear(password)
                     cursor.execute("UPDATE usuarios SET password = %s WHERE usuario_id = %s", 
                                  (password_hash, usuario_id))
                     conn.commit()
@@ -1825,19 +3809,15 @@ def admin_usuarios():
         return render_template('admin/usuarios.html', usuarios=usuarios, roles=roles)
     
     except ValueError as e:
-        print(f"[ERROR] Error de validación en admin_usuarios: {e}")
+        logger.error("Error de validación en admin_usuarios: %s", e)
         flash(f'Error en los datos ingresados: {str(e)}', 'danger')
         return redirect(url_for('admin_usuarios'))
     except Error as e:
-        print(f"[ERROR] Error de BD en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en admin_usuarios: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en admin_usuarios: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('admin_dashboard'))
     finally:
@@ -1845,7 +3825,7 @@ def admin_usuarios():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en admin_usuarios: {e}")
+                logger.error("Error cerrando conexión en admin_usuarios: %s", e)
 
 @app.route('/admin/servicios', methods=['GET', 'POST'])
 @admin_required
@@ -1877,7 +3857,11 @@ def admin_servicios():
                 if nombre:
                     sql = "INSERT INTO servicios (nombre, descripcion) VALUES (%s, %s)"
                     cursor.execute(sql, (nombre, descripcion))
+                    recontar_estadistica(cursor, 'servicios')
+                    avisos_cambios.publicar(cursor, 'servicios')
                     conn.commit()
+                    catalogos.invalidar('servicios')
+                    cache_paginas.invalidar()
                     flash('Servicio creado exitosamente', 'success')
                 else:
                     flash('Ingrese el nombre del servicio', 'warning')
@@ -1889,13 +3873,21 @@ def admin_servicios():
                 if nombre:
                     sql = "UPDATE servicios SET nombre = %s, descripcion = %s WHERE servicio_id = %s"
                     cursor.execute(sql, (nombre, descripcion, servicio_id))
+                    avisos_cambios.publicar(cursor, 'servicios')
                     conn.commit()
+                    catalogos.invalidar('servicios')
+                    cache_paginas.invalidar()
                     flash('Servicio actualizado exitosamente', 'success')
             
             elif accion == 'eliminar':
                 servicio_id = int(request.form.get('id', 0))
                 cursor.execute("DELETE FROM servicios WHERE servicio_id = %s", (servicio_id,))
+                recontar_estadistica(cursor, 'servicios')
+                avisos_cambios.publicar(cursor, 'servicios', 'precios')
                 conn.commit()
+                catalogos.invalidar('servicios')
+                cache_paginas.invalidar()
+                motor_precios.invalidar()  # Sus precios se borraron en cascada
                 flash('Servicio eliminado exitosamente', 'success')
         
         cursor.execute("SELECT * FROM servicios ORDER BY nombre")
@@ -1904,19 +3896,15 @@ def admin_servicios():
         return render_template('admin/servicios.html', servicios=servicios)
     
     except ValueError as e:
-        print(f"[ERROR] Error de validación en admin_usuarios: {e}")
+        logger.error("Error de validación en admin_servicios: %s", e)
         flash(f'Error en los datos ingresados: {str(e)}', 'danger')
         return redirect(url_for('admin_usuarios'))
     except Error as e:
-        print(f"[ERROR] Error de BD en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en admin_servicios: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en admin_servicios: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('admin_dashboard'))
     finally:
@@ -1924,7 +3912,7 @@ def admin_servicios():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en admin_usuarios: {e}")
+                logger.error("Error cerrando conexión en admin_servicios: %s", e)
 
 @app.route('/admin/roles', methods=['GET', 'POST'])
 @admin_required
@@ -1993,19 +3981,15 @@ def admin_roles():
         return render_template('admin/roles.html', roles=roles)
     
     except ValueError as e:
-        print(f"[ERROR] Error de validación en admin_usuarios: {e}")
+        logger.error("Error de validación en admin_roles: %s", e)
         flash(f'Error en los datos ingresados: {str(e)}', 'danger')
         return redirect(url_for('admin_usuarios'))
     except Error as e:
-        print(f"[ERROR] Error de BD en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en admin_roles: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en admin_roles: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('admin_dashboard'))
     finally:
@@ -2013,7 +3997,7 @@ def admin_roles():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en admin_usuarios: {e}")
+                logger.error("Error cerrando conexión en admin_roles: %s", e)
 
 @app.route('/admin/precios', methods=['GET', 'POST'])
 @admin_required
@@ -2066,7 +4050,9 @@ def admin_precios():
                     servicio_id, cilindros_min, cilindros_max, anio_min_int, anio_max_int,
                     precio_base, precio_por_cilindro, precio_por_anio
                 ))
+                avisos_cambios.publicar(cursor, 'precios')
                 conn.commit()
+                motor_precios.recargar(cursor)
                 flash('Precio creado exitosamente', 'success')
             
             elif accion == 'editar':
@@ -2093,246 +4079,886 @@ def admin_precios():
                     servicio_id, cilindros_min, cilindros_max, anio_min_int, anio_max_int,
                     precio_base, precio_por_cilindro, precio_por_anio, activo, precio_id
                 ))
+                avisos_cambios.publicar(cursor, 'precios')
                 conn.commit()
+                motor_precios.recargar(cursor)
                 flash('Precio actualizado exitosamente', 'success')
             
             elif accion == 'eliminar':
                 precio_id = int(request.form.get('id', 0))
                 cursor.execute("DELETE FROM servicio_precios WHERE servicio_precio_id = %s", (precio_id,))
+                avisos_cambios.publicar(cursor, 'precios')
                 conn.commit()
+                motor_precios.recargar(cursor)
                 flash('Precio eliminado exitosamente', 'success')
         
-        # Obtener servicios y precios
-        cursor.execute("SELECT * FROM servicios ORDER BY nombre")
-        servicios = cursor.fetchall()
+        # Obtener servicios (del cache de catálogos) y precios
+        servicios = catalogos.obtener('servicios', cursor)
+        
+        cursor.execute("""SELECT sp.*, s.nombre as servicio_nombre 
+                          FROM servicio_precios sp 
+                          INNER JOIN servicios s ON sp.servicio_id = s.servicio_id 
+                          ORDER BY s.nombre, sp.cilindros_min""")
+        precios = cursor.fetchall()
+        
+        return render_template('admin/precios.html', servicios=servicios, precios=precios)
+    
+    except ValueError as e:
+        logger.error("Error de validación en admin_precios: %s", e)
+        flash(f'Error en los datos ingresados: {str(e)}', 'danger')
+        return redirect(url_for('admin_usuarios'))
+    except Error as e:
+        logger.exception("Error de BD en admin_precios: %s", e)
+        flash(f'Error de base de datos: {str(e)}', 'danger')
+        return redirect(url_for('admin_dashboard'))
+    except Exception as e:
+        logger.exception("Error inesperado en admin_precios: %s", e)
+        flash('Error inesperado. Por favor intenta más tarde.', 'danger')
+        return redirect(url_for('admin_dashboard'))
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception as e: 
+                logger.error("Error cerrando conexión en admin_precios: %s", e)
+
+# ============================================
+# FUNCIONES DE CORREO
+# ============================================
+# Estas funciones manejan el envío de correos electrónicos.
+# Usan Flask-Mail y templates HTML para los correos.
+#
+# Ningún correo se envía dentro del request: las rutas llaman a encolar_correo()
+# (en la misma transacción que la cita/cotización/usuario que lo origina) y los
+# hilos de ColaCorreos los envían en segundo plano, con reintentos.
+
+ESTATUS_CORREOS = ['pendiente', 'enviando', 'enviado', 'fallido']
+MINUTOS_BLOQUEO_CORREO = 10  # Si un hilo muere a medio envío, el correo se libera después de esto
+
+# Sentencias de la cola. Las usan los hilos de ColaCorreos y el envío asíncrono de asgi.py.
+SQL_ENCOLAR_CORREO = """INSERT INTO correos_pendientes (tipo, referencia_id, destinatario, datos) 
+                        VALUES (%s, %s, %s, %s)"""
+SQL_RECLAMAR_CORREOS = """UPDATE correos_pendientes 
+                          SET estatus = 'enviando', token = %s, 
+                              bloqueado_hasta = NOW() + INTERVAL %s MINUTE 
+                          WHERE (estatus = 'pendiente' AND proximo_intento <= NOW()) 
+                             OR (estatus = 'enviando' AND bloqueado_hasta < NOW()) 
+                          ORDER BY correo_id 
+                          LIMIT %s"""
+SQL_CORREOS_RECLAMADOS = "SELECT * FROM correos_pendientes WHERE token = %s ORDER BY correo_id"
+SQL_CORREO_ENVIADO = """UPDATE correos_pendientes 
+                        SET estatus = 'enviado', intentos = intentos + 1, fecha_envio = NOW(), 
+                            datos = NULL, ultimo_error = NULL, token = NULL, bloqueado_hasta = NULL 
+                        WHERE correo_id = %s AND token = %s"""
+SQL_CORREO_FALLIDO = """UPDATE correos_pendientes 
+                        SET estatus = 'fallido', intentos = %s, ultimo_error = %s, 
+                            datos = NULL, token = NULL, bloqueado_hasta = NULL 
+                        WHERE correo_id = %s AND token = %s"""
+SQL_CORREO_REINTENTO = """UPDATE correos_pendientes 
+                          SET estatus = 'pendiente', intentos = %s, ultimo_error = %s, 
+                              proximo_intento = NOW() + INTERVAL %s SECOND, 
+                              token = NULL, bloqueado_hasta = NULL 
+                          WHERE correo_id = %s AND token = %s"""
+
+def encolar_correo(cursor, tipo, referencia_id=None, destinatario=None, datos=None):
+    """
+    Agrega un correo a la cola (tabla correos_pendientes).
+    
+    No hace commit: el correo queda en la misma transacción que el registro
+    que lo origina, así nunca hay una cita sin su correo ni un correo de una
+    cita que no se guardó. Después del commit hay que llamar a
+    cola_correos.despertar() para que se envíe de inmediato.
+    
+    Args:
+        cursor: Cursor de la base de datos
+        tipo: 'confirmacion_cita', 'cotizacion' o 'bienvenida_admin'
+        referencia_id: ID de la cita o cotización (si aplica)
+        destinatario: Correo del destinatario (para mostrarlo en el panel)
+        datos: dict con datos extra para armar el correo (se guarda como JSON)
+    
+    Returns:
+        int: ID del correo en la cola
+    """
+    cursor.execute(SQL_ENCOLAR_CORREO, (tipo, referencia_id, destinatario, json.dumps(datos) if datos else None))
+    return cursor.lastrowid
+
+def mensaje_bienvenida_admin(cursor, correo):
+    """
+    Arma el correo de bienvenida para un nuevo usuario admin.
+    
+    El correo incluye el username y un enlace para elegir su contraseña
+    (ver enlace_establecer_password); la contraseña no se guarda en la cola.
+    """
+    cursor.execute("SELECT usuario_id, username, nombre, password FROM usuarios WHERE usuario_id = %s",
+                   (correo['referencia_id'],))
+    usuario = cursor.fetchone()
+    if not usuario or not correo['destinatario']:
+        return None
+    return Message(
+        subject='Bienvenido al Sistema de Taller Automotriz',
+        recipients=[correo['destinatario']],
+        html=render_template('emails/bienvenida_admin.html',
+                          nombre=usuario['nombre'],
+                          username=usuario['username'],
+                          enlace=enlace_establecer_password(usuario),
+                          horas=ENLACES_CONFIG['horas'])
+    )
+
+def mensaje_confirmacion_cita(cursor, correo):
+    """
+    Arma el correo de confirmación de una cita.
+    
+    El correo incluye:
+    - Detalles de la cita (fecha, hora, servicios)
+    - Información de contacto del taller
+    - Ubicación del taller
+    
+    Se lee la cita al momento de enviar, así el correo refleja sus datos actuales.
+    """
+    cursor.execute("""SELECT c.*, cl.nombre as cliente_nombre, cl.telefono as cliente_telefono, 
+                     cl.correo as cliente_correo, s.nombre as servicio_nombre_completo
+                     FROM citas c
+                     LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
+                     LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
+                     WHERE c.cita_id = %s""", (correo['referencia_id'],))
+    cita = cursor.fetchone()
+    
+    if not cita or not cita['email']:
+        logger.error("La cita %s no existe o no tiene correo electrónico", correo['referencia_id'])
+        return None
+    
+    # Si hay servicios relacionados, usarlos en el asunto y el cuerpo del correo
+    agregar_servicios_relacionados(cursor, 'citas', [cita], 'cita_id')
+    if cita['servicios_relacionados']:
+        cita['servicio'] = ', '.join(s['nombre'] for s in cita['servicios_relacionados'])
+    
+    # MySQL puede regresar la hora como timedelta; el template espera un time
+    minutos = minutos_de_hora(cita['hora'])
+    if minutos is not None:
+        cita['hora'] = time(minutos // 60, minutos % 60)
+    
+    return Message(
+        subject=f'Confirmación de Cita - {cita["servicio"]}',
+        recipients=[cita['email'].strip()],
+        html=render_template('emails/confirmacion_cita.html', cita=cita)
+    )
+
+def mensaje_cotizacion(cursor, correo):
+    """
+    Arma el correo con los detalles de una cotización.
+    
+    El correo incluye:
+    - Detalles del servicio cotizado
+    - Información del vehículo
+    - Precio calculado
+    - Fecha de la cotización
+    - El PDF de la cotización como adjunto (si PDF_ADJUNTAR_CORREO está activo)
+    """
+    cotizacion = cargar_cotizacion_pdf(cursor, correo['referencia_id'])
+    
+    if not cotizacion or not cotizacion['email']:
+        logger.error("La cotización %s no existe o no tiene correo electrónico", correo['referencia_id'])
+        return None
+    
+    msg = Message(
+        subject=f'Cotización de Servicio - {cotizacion["servicio_nombre"] or "Servicio"}',
+        recipients=[cotizacion['email']],
+        html=render_template('emails/cotizacion.html', cotizacion=cotizacion)
+    )
+    
+    # Adjuntar el PDF (el mismo archivo guardado que se usa para las descargas)
+    if PDF_CONFIG['adjuntar_en_correo']:
+        try:
+            ruta, _ = obtener_pdf_cotizacion(cursor, cotizacion['cotizacion_id'], cotizacion)
+            with open(ruta, 'rb') as archivo:
+                msg.attach(f"cotizacion_{cotizacion['cotizacion_id']}.pdf", 'application/pdf', archivo.read())
+        except (Error, OSError) as e:
+            # Sin PDF el correo igual sirve: lleva los detalles en el HTML
+            logger.warning("No se pudo adjuntar el PDF de la cotización %s: %s", cotizacion['cotizacion_id'], e)
+    return msg
+
+# Qué función arma cada tipo de correo
+CONSTRUCTORES_CORREO = {
+    'bienvenida_admin': mensaje_bienvenida_admin,
+    'confirmacion_cita': mensaje_confirmacion_cita,
+    'cotizacion': mensaje_cotizacion
+}
+
+class ColaCorreos:
+    """
+    Envía en segundo plano los correos guardados en correos_pendientes.
+    
+    - Cada hilo "reclama" un lote con un UPDATE (estatus='enviando' y un token
+      propio), así dos hilos o dos procesos nunca envían el mismo correo.
+    - Si el envío falla se reintenta más tarde (backoff_base, el doble, el
+      doble...) y después de intentos_max se marca como 'fallido'.
+    - Si un proceso muere a medio envío, el correo vuelve a la cola cuando
+      vence bloqueado_hasta.
+    - La conexión SMTP se reutiliza mientras haya correos y se cierra cuando
+      la cola queda vacía.
+    """
+    
+    def __init__(self, workers=2, intentos_max=5, backoff_base=30, intervalo=15, lote=20):
+        self._workers = workers
+        self._intentos_max = intentos_max
+        self._backoff_base = backoff_base
+        self._intervalo = intervalo
+        self._lote = lote
+        self._hilos = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._aviso = threading.Event()
+        self._detener = threading.Event()
+        self._avisar_externo = None
+    
+    def delegar(self, avisar):
+        """
+        Deja el envío a otro mecanismo (el modo asíncrono de asgi.py): los hilos
+        no arrancan y despertar() llama a avisar(). Con None se vuelve a los hilos.
+        """
+        self._avisar_externo = avisar
+    
+    def iniciar(self):
+        """Arranca los hilos de envío (una sola vez por proceso)."""
+        if self._pid == os.getpid() or self._workers <= 0 or self._avisar_externo:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._detener.clear()
+            self._hilos = [threading.Thread(target=self._trabajar, name=f'correos-{i + 1}', daemon=True)
+                           for i in range(self._workers)]
+            for hilo in self._hilos:
+                hilo.start()
+            self._pid = os.getpid()
+    
+    def despertar(self):
+        """Avisa a los hilos que hay correos nuevos (si no, los ven en la siguiente revisión)."""
+        avisar = self._avisar_externo
+        if avisar:
+            avisar()
+            return
+        self.iniciar()
+        self._aviso.set()
+    
+    def detener(self, timeout=5):
+        """Detiene los hilos; los correos que falten se envían al volver a iniciar."""
+        self._detener.set()
+        self._aviso.set()
+        for hilo in self._hilos:
+            hilo.join(timeout)
+        self._hilos = []
+        self._pid = None
+    
+    def reiniciar_tras_fork(self):
+        """En el proceso hijo de un fork: sin hilos (arrancan con el primer request) y con locks nuevos."""
+        self._hilos = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._aviso = threading.Event()
+        self._detener = threading.Event()
+    
+    def _trabajar(self):
+        smtp = None
+        while not self._detener.is_set():
+            try:
+                procesados, smtp = self._procesar_lote(smtp)
+            except Exception as e:
+                logger.error("Error en la cola de correos: %s", e)
+                procesados = 0
+            if procesados:
+                continue  # Puede haber más correos pendientes
+            smtp = self._cerrar_smtp(smtp)
+            self._aviso.wait(self._intervalo)
+            self._aviso.clear()
+        self._cerrar_smtp(smtp)
+    
+    def _procesar_lote(self, smtp):
+        """Reclama un lote de correos y los envía. Retorna (cuántos se procesaron, smtp)."""
+        conn = get_db_connection()
+        if not conn:
+            return 0, smtp
+        try:
+            cursor = get_cursor(conn)
+            token = uuid.uuid4().hex
+            cursor.execute(SQL_RECLAMAR_CORREOS, (token, MINUTOS_BLOQUEO_CORREO, self._lote))
+            reclamados = cursor.rowcount
+            conn.commit()
+            if not reclamados:
+                return 0, smtp
+            
+            cursor.execute(SQL_CORREOS_RECLAMADOS, (token,))
+            correos = cursor.fetchall()
+            conn.commit()
+            
+            # render_template y Flask-Mail necesitan el contexto de la aplicación
+            with app.app_context():
+                for correo in correos:
+                    smtp = self._enviar(conn, cursor, correo, smtp)
+            return len(correos), smtp
+        finally:
+            conn.close()
+    
+    def _enviar(self, conn, cursor, correo, smtp):
+        g.request_id = f"correo-{correo['correo_id']}"  # Para identificar este correo en los logs
+        constructor = CONSTRUCTORES_CORREO.get(correo['tipo'])
+        try:
+            msg = constructor(cursor, correo) if constructor else None
+        except Exception as e:
+            self._registrar_fallo(conn, cursor, correo, f"Error armando el correo: {e}")
+            return smtp
+        if msg is None:
+            # No tiene caso reintentar: el registro no existe o no tiene a quién enviarse
+            self._registrar_fallo(conn, cursor, correo, 'No se pudo armar el correo (registro inexistente o sin destinatario)',
+                                  definitivo=True)
+            return smtp
         
-        cursor.execute("""SELECT sp.*, s.nombre as servicio_nombre 
-                          FROM servicio_precios sp 
-                          INNER JOIN servicios s ON sp.servicio_id = s.servicio_id 
-                          ORDER BY s.nombre, sp.cilindros_min""")
-        precios = cursor.fetchall()
+        inicio = perf_counter()
+        try:
+            if smtp is None:
+                smtp = mail.connect().__enter__()
+            smtp.send(msg)
+        except Exception as e:
+            metricas.registrar_correo(correo['tipo'], perf_counter() - inicio, 'error')
+            smtp = self._cerrar_smtp(smtp)
+            self._registrar_fallo(conn, cursor, correo, e)
+            return smtp
+        metricas.registrar_correo(correo['tipo'], perf_counter() - inicio, 'enviado')
         
-        return render_template('admin/precios.html', servicios=servicios, precios=precios)
+        # Ya enviado: se borran los datos extra
+        cursor.execute(SQL_CORREO_ENVIADO, (correo['correo_id'], correo['token']))
+        conn.commit()
+        logger.info("Correo %s (%s) enviado a %s", correo['correo_id'], correo['tipo'], msg.recipients[0])
+        return smtp
     
-    except ValueError as e:
-        print(f"[ERROR] Error de validación en admin_usuarios: {e}")
-        flash(f'Error en los datos ingresados: {str(e)}', 'danger')
-        return redirect(url_for('admin_usuarios'))
-    except Error as e:
-        print(f"[ERROR] Error de BD en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
-        flash(f'Error de base de datos: {str(e)}', 'danger')
-        return redirect(url_for('admin_dashboard'))
-    except Exception as e:
-        print(f"[ERROR] Error inesperado en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
-        flash('Error inesperado. Por favor intenta más tarde.', 'danger')
-        return redirect(url_for('admin_dashboard'))
-    finally:
-        if conn:
+    def _registrar_fallo(self, conn, cursor, correo, error, definitivo=False):
+        cursor.execute(*self.sentencia_fallo(correo, error, definitivo))
+        conn.commit()
+    
+    def sentencia_fallo(self, correo, error, definitivo=False):
+        """
+        Decide si un correo que falló se reintenta (con backoff) o queda como
+        'fallido'. Retorna (sql, parámetros) para marcarlo.
+        """
+        intentos = correo['intentos'] + 1
+        error = str(error)[:1000]
+        if definitivo or intentos >= self._intentos_max:
+            logger.error("Correo %s (%s) marcado como fallido: %s", correo['correo_id'], correo['tipo'], error)
+            return SQL_CORREO_FALLIDO, (intentos, error, correo['correo_id'], correo['token'])
+        espera = self._backoff_base * 2 ** (intentos - 1)
+        logger.warning("Error enviando correo %s (intento %s), se reintentará en %s s: %s", correo['correo_id'], intentos, espera, error)
+        return SQL_CORREO_REINTENTO, (intentos, error, espera, correo['correo_id'], correo['token'])
+    
+    def _cerrar_smtp(self, smtp):
+        if smtp is not None:
             try:
-                conn.close()
-            except Exception as e: 
-                print(f"[ERROR] Error cerrando conexión en admin_usuarios: {e}")
+                smtp.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
 
-# ============================================
-# FUNCIONES DE CORREO
-# ============================================
-# Estas funciones manejan el envío de correos electrónicos.
-# Usan Flask-Mail y templates HTML para los correos.
+# Cola global. Los hilos arrancan con el primer request (ver iniciar_cola_correos).
+cola_correos = ColaCorreos(**CORREO_CONFIG)
+
+@app.before_request
+def iniciar_cola_correos():
+    """Arranca los hilos de la cola de correos en el proceso que atiende requests."""
+    cola_correos.iniciar()
 
-def enviar_correo_bienvenida_admin(email, nombre, username, password):
+def enviar_cotizacion_por_correo(cotizacion_id):
     """
-    Envía un correo de bienvenida cuando se crea un nuevo usuario admin.
-    
-    El correo incluye:
-    - Mensaje de bienvenida personalizado
-    - Username y contraseña para que pueda iniciar sesión
-    - Información sobre el sistema
+    Pone en la cola el correo con los detalles de una cotización.
     
-    Se usa cuando un administrador crea otro usuario admin.
+    Se usa para reenviar una cotización (desde el panel del usuario o el de
+    administración); el correo de una cotización nueva se encola en la misma
+    transacción que la crea. Retorna True si el correo quedó en la cola.
     """
+    conn = get_db_connection()
+    if not conn:
+        logger.error("No se pudo conectar a la base de datos para encolar el correo")
+        return False
+    
     try:
-        msg = Message(
-            subject='Bienvenido al Sistema de Taller Automotriz',
-            recipients=[email],
-            html=render_template('emails/bienvenida_admin.html',
-                              nombre=nombre,
-                              username=username,
-                              password=password)
-        )
-        mail.send(msg)
-        return True
-    except Exception as e:
-        print(f"Error enviando correo de bienvenida: {e}")
+        cursor = get_cursor(conn)
+        cursor.execute("SELECT email FROM cotizaciones WHERE cotizacion_id = %s", (cotizacion_id,))
+        cotizacion = cursor.fetchone()
+        
+        if not cotizacion or not cotizacion['email']:
+            logger.error("La cotización %s no existe o no tiene correo electrónico", cotizacion_id)
+            return False
+        
+        encolar_correo(cursor, 'cotizacion', cotizacion_id, cotizacion['email'])
+        conn.commit()
+    except Error as e:
+        logger.error("Error encolando cotización por correo: %s", e)
+        conn.rollback()
         return False
+    finally:
+        conn.close()
+    
+    cola_correos.despertar()
+    return True
 
-def enviar_confirmacion_cita(cita_id):
+@app.route('/admin/correos', methods=['GET', 'POST'])
+@admin_required
+def admin_correos():
     """
-    Envía un correo de confirmación cuando se agenda una cita.
-    
-    Esta función se llama automáticamente después de que se guarda una cita.
-    El correo incluye:
-    - Detalles de la cita (fecha, hora, servicio)
-    - Información de contacto del taller
-    - Ubicación del taller
+    Panel para revisar la cola de correos.
     
-    Maneja la conversión de timedelta a time porque MySQL a veces retorna
-    las horas como timedelta en lugar de time objects.
+    Muestra cuántos correos hay en cada estatus, los más recientes (con el
+    último error si falló) y permite volver a poner en cola los fallidos.
     """
-    print(f"[DEBUG] ========== ENVIANDO CORREO DE CONFIRMACIÓN ==========")
-    print(f"[DEBUG] Cita ID: {cita_id}")
-    
     conn = get_db_connection()
     if not conn:
-        print("[ERROR] No se pudo conectar a la base de datos para enviar correo de confirmación")
-        return False
+        flash('Error de conexión', 'danger')
+        return redirect(url_for('admin_dashboard'))
     
     try:
         cursor = get_cursor(conn)
-        cursor.execute("""SELECT c.*, cl.nombre as cliente_nombre, cl.telefono as cliente_telefono, 
-                         cl.correo as cliente_correo, s.nombre as servicio_nombre_completo
-                         FROM citas c
-                         LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                         LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
-                         WHERE c.cita_id = %s""", (cita_id,))
-        cita = cursor.fetchone()
-        
-        if not cita:
-            print(f"[ERROR] No se encontró la cita con ID {cita_id}")
-            return False
         
-        # Obtener servicios relacionados para la cita
-        try:
-            cursor.execute("""SELECT s.servicio_id, s.nombre 
-                             FROM citas_servicios cs
-                             JOIN servicios s ON cs.servicio_id = s.servicio_id
-                             WHERE cs.cita_id = %s
-                             ORDER BY s.nombre""", (cita_id,))
-            servicios_relacionados = cursor.fetchall()
-            cita['servicios_relacionados'] = servicios_relacionados
-            # Si hay servicios relacionados, actualizar el campo servicio para el email
-            if servicios_relacionados:
-                servicios_nombres = [s['nombre'] for s in servicios_relacionados]
-                cita['servicio'] = ', '.join(servicios_nombres)
-        except Exception as e:
-            print(f"[WARNING] Error obteniendo servicios relacionados para email: {e}")
-            cita['servicios_relacionados'] = []
-        
-        print(f"[DEBUG] Cita encontrada: {cita}")
-        
-        # Convertir hora de timedelta a time si es necesario
-        if isinstance(cita['hora'], timedelta):
-            # Convertir timedelta a time
-            total_seconds = int(cita['hora'].total_seconds())
-            hours = total_seconds // 3600
-            minutes = (total_seconds % 3600) // 60
-            cita['hora'] = time(hours, minutes)
-            print(f"[DEBUG] Hora convertida de timedelta a time: {cita['hora']}")
-        elif isinstance(cita['hora'], str):
-            # Si es string, parsear
-            try:
-                if len(cita['hora'].split(':')) == 3:
-                    cita['hora'] = datetime.strptime(cita['hora'], '%H:%M:%S').time()
+        if request.method == 'POST':
+            accion = request.form.get('accion', '')
+            
+            if accion == 'reintentar':
+                correo_id = int(request.form.get('id', 0))
+                cursor.execute("""UPDATE correos_pendientes 
+                                  SET estatus = 'pendiente', intentos = 0, proximo_intento = NOW(), ultimo_error = NULL 
+                                  WHERE correo_id = %s AND estatus = 'fallido'""", (correo_id,))
+                conn.commit()
+                if cursor.rowcount:
+                    cola_correos.despertar()
+                    flash('El correo se volvió a poner en la cola', 'success')
                 else:
-                    cita['hora'] = datetime.strptime(cita['hora'], '%H:%M').time()
-                print(f"[DEBUG] Hora convertida de string a time: {cita['hora']}")
-            except ValueError as e:
-                print(f"[DEBUG] Error parseando hora string: {e}")
-        elif not isinstance(cita['hora'], time):
-            # Si no es time, intentar convertir
-            print(f"[DEBUG] Tipo de hora inesperado: {type(cita['hora'])}, valor: {cita['hora']}")
-        
-        if not cita['email']:
-            print(f"[ERROR] La cita {cita_id} no tiene correo electrónico")
-            return False
+                    flash('Solo se pueden reintentar correos fallidos', 'warning')
+            
+            return redirect(url_for('admin_correos', **request.args))
         
-        email_destino = cita['email'].strip()
-        print(f"[INFO] Enviando correo de confirmación a {email_destino} para cita {cita_id}")
+        cursor.execute("SELECT estatus, COUNT(*) as total FROM correos_pendientes GROUP BY estatus")
+        conteos = {estatus: 0 for estatus in ESTATUS_CORREOS}
+        for fila in cursor.fetchall():
+            conteos[fila['estatus']] = fila['total']
         
-        # Verificar configuración de correo
-        if not app.config.get('MAIL_SERVER'):
-            print("[ERROR] MAIL_SERVER no está configurado")
-            return False
+        estatus = request.args.get('estatus', '').strip()
+        if estatus in ESTATUS_CORREOS:
+            cursor.execute("""SELECT correo_id, tipo, referencia_id, destinatario, estatus, intentos, 
+                                     ultimo_error, proximo_intento, fecha_creacion, fecha_envio 
+                              FROM correos_pendientes WHERE estatus = %s 
+                              ORDER BY correo_id DESC LIMIT %s""", (estatus, REGISTROS_POR_PAGINA))
+        else:
+            estatus = ''
+            cursor.execute("""SELECT correo_id, tipo, referencia_id, destinatario, estatus, intentos, 
+                                     ultimo_error, proximo_intento, fecha_creacion, fecha_envio 
+                              FROM correos_pendientes 
+                              ORDER BY correo_id DESC LIMIT %s""", (REGISTROS_POR_PAGINA,))
+        correos = cursor.fetchall()
         
-        try:
-            msg = Message(
-                subject=f'Confirmación de Cita - {cita["servicio"]}',
-                recipients=[email_destino],
-                html=render_template('emails/confirmacion_cita.html', cita=cita)
-            )
-            print(f"[DEBUG] Mensaje creado, enviando...")
-            mail.send(msg)
-            print(f"[SUCCESS] ✅ Correo de confirmación enviado exitosamente a {email_destino}")
-            return True
-        except Exception as mail_error:
-            print(f"[ERROR] Error al enviar el mensaje de correo: {mail_error}")
-            import traceback
-            traceback.print_exc()
-            return False
-    except Exception as e:
-        print(f"[ERROR] Error enviando confirmación de cita por correo: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+        return render_template('admin/correos.html', correos=correos, conteos=conteos,
+                               estatus=estatus, estatus_opciones=ESTATUS_CORREOS)
+    except Error as e:
+        flash(f'Error: {str(e)}', 'danger')
+        return redirect(url_for('admin_dashboard'))
     finally:
         if conn:
             conn.close()
 
-def enviar_cotizacion_por_correo(cotizacion_id):
+# ============================================
+# PDF DE COTIZACIONES
+# ============================================
+# El PDF de una cotización se genera con ReportLab una sola vez y se guarda
+# en disco con un nombre que incluye una huella (hash) de su contenido:
+# cotizacion_<id>_<huella>.pdf. Mientras la cotización no cambie, las
+# descargas y el correo reutilizan el mismo archivo; si cambia, la huella es
+# otra y se genera uno nuevo (y se borra el anterior).
+# La huella también es el ETag de la descarga, así que el navegador puede
+# preguntar "¿cambió?" y recibir un 304 sin volver a bajar el archivo.
+PDF_CONFIG = {
+    'carpeta': os.environ.get('PDF_CACHE_DIR', os.path.join(app.instance_path, 'pdf_cotizaciones')),  # Dónde se guardan los PDF
+    'adjuntar_en_correo': os.environ.get('PDF_ADJUNTAR_CORREO', 'True').lower() in ['true', '1', 'yes']  # Adjuntar el PDF al correo de la cotización
+}
+
+# Cambiar este número cuando cambie el diseño del PDF (invalida los archivos guardados)
+VERSION_PLANTILLA_PDF = 1
+
+def cargar_cotizacion_pdf(cursor, cotizacion_id):
+    """Obtiene la cotización (con el nombre de su servicio principal) o None si no existe."""
+    cursor.execute("""SELECT c.*, s.nombre as servicio_nombre 
+                      FROM cotizaciones c 
+                      LEFT JOIN servicios s ON c.servicio_id = s.servicio_id 
+                      WHERE c.cotizacion_id = %s""", (cotizacion_id,))
+    return cursor.fetchone()
+
+def huella_cotizacion(cotizacion, renglones):
+    """Hash del contenido que aparece en el PDF; si algo cambia, cambia la huella."""
+    campos = ('cotizacion_id', 'nombre', 'telefono', 'email', 'servicio', 'servicio_nombre', 'marca_vehiculo',
+              'modelo_vehiculo', 'anio_vehiculo', 'cilindros', 'mensaje', 'precio_calculado', 'fecha_envio')
+    contenido = {
+        'version': VERSION_PLANTILLA_PDF,
+        'cotizacion': [cotizacion.get(campo) for campo in campos],
+        'renglones': [(r['servicio_id'], r['nombre'], r['precio_servicio']) for r in renglones]
+    }
+    datos = json.dumps(contenido, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(datos).hexdigest()[:16]
+
+def dibujar_pdf_cotizacion(cotizacion, renglones):
+    """Genera el PDF de la cotización y regresa sus bytes."""
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+    ancho, alto = letter
+    izquierda = inch
+    derecha = ancho - inch
+    
+    pdf.setTitle(f"Cotización #{cotizacion['cotizacion_id']}")
+    pdf.setFont('Helvetica-Bold', 18)
+    pdf.drawString(izquierda, alto - inch, 'Taller Automotriz')
+    pdf.setFont('Helvetica', 12)
+    pdf.drawRightString(derecha, alto - inch, f"Cotización #{cotizacion['cotizacion_id']}")
+    fecha = cotizacion['fecha_envio'].strftime('%d/%m/%Y') if cotizacion.get('fecha_envio') else ''
+    pdf.drawRightString(derecha, alto - inch - 16, fecha)
+    pdf.line(izquierda, alto - inch - 26, derecha, alto - inch - 26)
+    
+    y = alto - inch - 52
+    pdf.setFont('Helvetica-Bold', 12)
+    pdf.drawString(izquierda, y, 'Cliente')
+    pdf.drawString(ancho / 2, y, 'Vehículo')
+    pdf.setFont('Helvetica', 10)
+    cliente = [cotizacion.get('nombre') or '', cotizacion.get('telefono') or '', cotizacion.get('email') or '']
+    vehiculo = [
+        f"{cotizacion.get('marca_vehiculo') or 'N/A'} {cotizacion.get('modelo_vehiculo') or ''}".strip(),
+        f"Año: {cotizacion.get('anio_vehiculo') or 'N/A'}",
+        f"Cilindros: {cotizacion.get('cilindros') or 'N/A'}"
+    ]
+    for i in range(3):
+        y -= 15
+        pdf.drawString(izquierda, y, cliente[i])
+        pdf.drawString(ancho / 2, y, vehiculo[i])
+    
+    y -= 35
+    pdf.setFont('Helvetica-Bold', 11)
+    pdf.drawString(izquierda, y, 'Servicio')
+    pdf.drawRightString(derecha, y, 'Precio estimado')
+    y -= 6
+    pdf.line(izquierda, y, derecha, y)
+    pdf.setFont('Helvetica', 10)
+    # Sin renglones (cotizaciones antiguas) se muestra el servicio principal
+    filas = [(r['nombre'], r['precio_servicio']) for r in renglones] or \
+            [(cotizacion.get('servicio_nombre') or cotizacion.get('servicio') or 'Servicio', cotizacion.get('precio_calculado'))]
+    for nombre, precio in filas:
+        y -= 16
+        if y < inch:
+            pdf.showPage()
+            pdf.setFont('Helvetica', 10)
+            y = alto - inch
+        pdf.drawString(izquierda, y, str(nombre))
+        pdf.drawRightString(derecha, y, f"${float(precio):,.2f}" if precio is not None else 'N/A')
+    y -= 8
+    pdf.line(izquierda, y, derecha, y)
+    y -= 18
+    pdf.setFont('Helvetica-Bold', 12)
+    pdf.drawString(izquierda, y, 'Total estimado')
+    total = cotizacion.get('precio_calculado')
+    pdf.drawRightString(derecha, y, f"${float(total):,.2f}" if total is not None else 'N/A')
+    
+    if cotizacion.get('mensaje'):
+        y -= 36
+        pdf.setFont('Helvetica-Bold', 10)
+        pdf.drawString(izquierda, y, 'Comentarios del cliente:')
+        texto = pdf.beginText(izquierda, y - 14)
+        texto.setFont('Helvetica', 10)
+        for linea in cotizacion['mensaje'].splitlines()[:15]:
+            texto.textLine(linea[:100])
+        pdf.drawText(texto)
+    
+    pdf.setFont('Helvetica-Oblique', 8)
+    pdf.drawString(izquierda, 0.6 * inch,
+                   'Precios estimados según el vehículo; el precio final se confirma al revisar el vehículo en el taller.')
+    pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+def obtener_pdf_cotizacion(cursor, cotizacion_id, cotizacion=None):
     """
-    Envía un correo con los detalles de una cotización al cliente.
+    Regresa (ruta, huella) del PDF de una cotización, generándolo solo si
+    no hay uno guardado con la huella actual. Regresa None si no existe.
     
-    Esta función se llama automáticamente cuando se crea una cotización,
-    o manualmente desde el panel de administración.
-    El correo incluye:
-    - Detalles del servicio cotizado
-    - Información del vehículo
-    - Precio calculado
-    - Fecha de la cotización
+    Si el llamador ya tiene la fila de la cotización (c.* y servicio_nombre)
+    la puede pasar para no volver a consultarla.
+    """
+    if cotizacion is None:
+        cotizacion = cargar_cotizacion_pdf(cursor, cotizacion_id)
+        if not cotizacion:
+            return None
+    renglones = cargar_servicios_relacionados(cursor, 'cotizaciones', [cotizacion_id])[cotizacion_id]
+    huella = huella_cotizacion(cotizacion, renglones)
+    carpeta = PDF_CONFIG['carpeta']
+    ruta = os.path.join(carpeta, f'cotizacion_{cotizacion_id}_{huella}.pdf')
+    if os.path.exists(ruta):
+        return ruta, huella
+    
+    contenido = dibujar_pdf_cotizacion(cotizacion, renglones)
+    os.makedirs(carpeta, exist_ok=True)
+    # Se escribe a un archivo temporal y se renombra: nadie lee un PDF a medias
+    temporal = f'{ruta}.{uuid.uuid4().hex[:8]}.tmp'
+    with open(temporal, 'wb') as archivo:
+        archivo.write(contenido)
+    os.replace(temporal, ruta)
+    
+    # Borrar las versiones anteriores de esta misma cotización
+    prefijo = f'cotizacion_{cotizacion_id}_'
+    for nombre in os.listdir(carpeta):
+        if nombre.startswith(prefijo) and nombre.endswith('.pdf') and os.path.join(carpeta, nombre) != ruta:
+            try:
+                os.remove(os.path.join(carpeta, nombre))
+            except OSError:
+                pass
+    logger.info("PDF de la cotización %s generado (%s bytes)", cotizacion_id, len(contenido))
+    return ruta, huella
+
+@app.route('/cotizaciones/<int:cotizacion_id>/pdf')
+@login_required
+def descargar_cotizacion_pdf(cotizacion_id):
+    """
+    Descarga el PDF de una cotización.
+    
+    Los administradores pueden descargar cualquiera; los usuarios solo las suyas.
+    Se responde con ETag (la huella del contenido) y Last-Modified, así que
+    si el navegador ya tiene la versión actual recibe un 304.
     """
     conn = get_db_connection()
     if not conn:
-        print("[ERROR] No se pudo conectar a la base de datos para enviar correo")
-        return False
+        flash('Error de conexión a la base de datos', 'danger')
+        return redirect(url_for('index'))
     
     try:
         cursor = get_cursor(conn)
-        cursor.execute("""SELECT c.*, s.nombre as servicio_nombre 
-                          FROM cotizaciones c 
-                          LEFT JOIN servicios s ON c.servicio_id = s.servicio_id 
-                          WHERE c.cotizacion_id = %s""", (cotizacion_id,))
-        cotizacion = cursor.fetchone()
-        
-        if not cotizacion:
-            print(f"[ERROR] No se encontró la cotización con ID {cotizacion_id}")
-            return False
-        
-        if not cotizacion['email']:
-            print(f"[ERROR] La cotización {cotizacion_id} no tiene correo electrónico")
-            return False
-        
-        print(f"[INFO] Enviando correo a {cotizacion['email']} para cotización {cotizacion_id}")
+        cotizacion = cargar_cotizacion_pdf(cursor, cotizacion_id)
+        if not cotizacion or (session.get('rol') != 'admin' and cotizacion['propietario_id'] != session.get('usuario_id')):
+            return 'Cotización no encontrada', 404
         
-        msg = Message(
-            subject=f'Cotización de Servicio - {cotizacion["servicio_nombre"] or "Servicio"}',
-            recipients=[cotizacion['email']],
-            html=render_template('emails/cotizacion.html', cotizacion=cotizacion)
-        )
-        mail.send(msg)
-        print(f"[SUCCESS] Correo enviado exitosamente a {cotizacion['email']}")
-        return True
-    except Exception as e:
-        print(f"[ERROR] Error enviando cotización por correo: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+        ruta, huella = obtener_pdf_cotizacion(cursor, cotizacion_id, cotizacion)
+        respuesta = send_file(ruta, mimetype='application/pdf', as_attachment=True,
+                              download_name=f'cotizacion_{cotizacion_id}.pdf', etag=huella, conditional=True)
+        respuesta.cache_control.private = True
+        return respuesta
+    except (Error, OSError) as e:
+        logger.exception("Error generando el PDF de la cotización %s: %s", cotizacion_id, e)
+        return 'No se pudo generar el PDF', 500
     finally:
         if conn:
             conn.close()
 
+# ============================================
+# PAGINACIÓN Y FILTROS DEL PANEL ADMIN
+# ============================================
+# Los listados de citas y cotizaciones se paginan por "keyset": en lugar de
+# OFFSET, cada página pide los registros que van después (o antes) del último
+# que se mostró, usando las mismas columnas del ORDER BY. Con los índices
+# correctos, el costo de cada página es el mismo sin importar cuántos
+# registros haya en la tabla.
+
+ESTATUS_CITAS = ['Pendiente', 'Confirmada', 'En proceso', 'Completada', 'Cancelada']
+REGISTROS_POR_PAGINA = 50
+MAX_REGISTROS_POR_PAGINA = 200
+
+def _valor_para_cursor(valor):
+    """Convierte un valor de columna a texto para guardarlo en el cursor de página."""
+    if isinstance(valor, timedelta):
+        minutos_totales = int(valor.total_seconds()) // 60
+        return f"{minutos_totales // 60:02d}:{minutos_totales % 60:02d}:{int(valor.total_seconds()) % 60:02d}"
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d %H:%M:%S')
+    if hasattr(valor, 'isoformat'):
+        return valor.isoformat()
+    return str(valor)
+
+def codificar_cursor_pagina(fila, llaves):
+    """Arma el cursor de página ('valor|valor|id') a partir de un registro."""
+    valores = [fila.get(llave) for llave in llaves]
+    if any(valor is None for valor in valores):
+        return None
+    return '|'.join(_valor_para_cursor(valor) for valor in valores)
+
+def decodificar_cursor_pagina(texto, formatos):
+    """
+    Valida y separa un cursor de página. formatos indica el formato de cada
+    parte (strptime, o int). Retorna None si el cursor no es válido.
+    """
+    if not texto:
+        return None
+    partes = texto.split('|')
+    if len(partes) != len(formatos):
+        return None
+    valores = []
+    try:
+        for parte, formato in zip(partes, formatos):
+            if formato is int:
+                valores.append(int(parte))
+            else:
+                datetime.strptime(parte, formato)
+                valores.append(parte)
+    except ValueError:
+        return None
+    return valores
+
+def condicion_keyset(columnas, valores, operador):
+    """
+    Arma la condición "después de este registro" para un ORDER BY de varias columnas:
+    (a < x) OR (a = x AND b < y) OR (a = x AND b = y AND c < z)
+    Se antepone a <= x para que MySQL pueda usar el índice como rango.
+    """
+    partes = []
+    params = [valores[0]]
+    for i, columna in enumerate(columnas):
+        iguales = [f"{c} = %s" for c in columnas[:i]]
+        partes.append("(" + " AND ".join(iguales + [f"{columna} {operador} %s"]) + ")")
+        params.extend(valores[:i + 1])
+    sql = f"{columnas[0]} {operador}= %s AND (" + " OR ".join(partes) + ")"
+    return sql, params
+
+def consultar_pagina(cursor, select_sql, condiciones, params, orden, args):
+    """
+    Ejecuta una consulta paginada por keyset (orden descendente).
+    
+    Args:
+        cursor: Cursor de la base de datos
+        select_sql: SELECT ... FROM ... JOIN ... (sin WHERE ni ORDER BY)
+        condiciones: Lista de condiciones de filtro (se unen con AND)
+        params: Parámetros de esas condiciones
+        orden: Lista de (columna_sql, llave_en_resultado, formato) del ORDER BY
+        args: request.args (usa despues, antes y por_pagina)
+    
+    Returns:
+        tuple: (registros, info_pagina) donde info_pagina tiene 'siguiente',
+               'anterior' (cursores o None) y 'por_pagina'
+    """
+    try:
+        por_pagina = int(args.get('por_pagina', REGISTROS_POR_PAGINA))
+    except ValueError:
+        por_pagina = REGISTROS_POR_PAGINA
+    por_pagina = max(1, min(por_pagina, MAX_REGISTROS_POR_PAGINA))
+    
+    columnas = [columna for columna, _, _ in orden]
+    llaves = [llave for _, llave, _ in orden]
+    formatos = [formato for _, _, formato in orden]
+    
+    despues = decodificar_cursor_pagina(args.get('despues'), formatos)
+    antes = decodificar_cursor_pagina(args.get('antes'), formatos) if not despues else None
+    
+    condiciones = list(condiciones)
+    params = list(params)
+    if despues:
+        sql, extra = condicion_keyset(columnas, despues, '<')
+        condiciones.append(sql)
+        params.extend(extra)
+    elif antes:
+        sql, extra = condicion_keyset(columnas, antes, '>')
+        condiciones.append(sql)
+        params.extend(extra)
+    
+    # Para ir a la página anterior se recorre el índice al revés y luego se invierte
+    direccion = 'ASC' if antes else 'DESC'
+    sql = select_sql
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += " ORDER BY " + ", ".join(f"{columna} {direccion}" for columna in columnas)
+    sql += " LIMIT %s"
+    params.append(por_pagina + 1)  # Uno de más para saber si hay otra página
+    
+    cursor.execute(sql, tuple(params))
+    registros = cursor.fetchall()
+    hay_mas = len(registros) > por_pagina
+    registros = registros[:por_pagina]
+    if antes:
+        registros.reverse()
+    
+    info_pagina = {'siguiente': None, 'anterior': None, 'por_pagina': por_pagina}
+    if registros:
+        if hay_mas or antes:
+            info_pagina['siguiente'] = codificar_cursor_pagina(registros[-1], llaves)
+        if despues or (antes and hay_mas):
+            info_pagina['anterior'] = codificar_cursor_pagina(registros[0], llaves)
+    return registros, info_pagina
+
+def filtros_admin(args, con_estatus=False):
+    """
+    Lee y valida los filtros del panel admin desde request.args.
+    Retorna un dict solo con los filtros que tienen valor válido.
+    """
+    filtros = {}
+    for nombre in ('desde', 'hasta'):
+        valor = args.get(nombre, '').strip()
+        if valor:
+            try:
+                datetime.strptime(valor, '%Y-%m-%d')
+                filtros[nombre] = valor
+            except ValueError:
+                flash(f'La fecha "{valor}" no es válida (use AAAA-MM-DD)', 'warning')
+    servicio_id = args.get('servicio_id', type=int)
+    if servicio_id:
+        filtros['servicio_id'] = servicio_id
+    cliente = args.get('cliente', '').strip()
+    if cliente:
+        filtros['cliente'] = cliente
+    if con_estatus:
+        estatus = args.get('estatus', '').strip()
+        if estatus in ESTATUS_CITAS:
+            filtros['estatus'] = estatus
+    if args.get('por_pagina', type=int):
+        filtros['por_pagina'] = args.get('por_pagina', type=int)
+    return filtros
+
+def condicion_cliente(alias, cliente):
+    """
+    Filtro por cliente: si parece correo, busca el email exacto;
+    si no, busca nombres que empiecen con el texto (ambos usan índice).
+    """
+    if '@' in cliente:
+        return f"{alias}.email = %s", [cliente]
+    patron = cliente.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return f"{alias}.nombre LIKE %s", [patron]
+
+def condiciones_cotizaciones(filtros):
+    """Condiciones WHERE (y sus parámetros) de los filtros de cotizaciones (alias c)."""
+    condiciones = []
+    params = []
+    if 'desde' in filtros:
+        condiciones.append("c.fecha_envio >= %s")
+        params.append(filtros['desde'])
+    if 'hasta' in filtros:
+        condiciones.append("c.fecha_envio < DATE_ADD(%s, INTERVAL 1 DAY)")
+        params.append(filtros['hasta'])
+    if 'servicio_id' in filtros:
+        condiciones.append("""EXISTS (SELECT 1 FROM cotizaciones_servicios cs
+                                      WHERE cs.cotizacion_id = c.cotizacion_id AND cs.servicio_id = %s)""")
+        params.append(filtros['servicio_id'])
+    if 'cliente' in filtros:
+        sql_cliente, params_cliente = condicion_cliente('c', filtros['cliente'])
+        condiciones.append(sql_cliente)
+        params.extend(params_cliente)
+    return condiciones, params
+
+def condiciones_citas(filtros):
+    """Condiciones WHERE (y sus parámetros) de los filtros de citas (alias c)."""
+    condiciones = []
+    params = []
+    if 'desde' in filtros:
+        condiciones.append("c.fecha >= %s")
+        params.append(filtros['desde'])
+    if 'hasta' in filtros:
+        condiciones.append("c.fecha <= %s")
+        params.append(filtros['hasta'])
+    if 'estatus' in filtros:
+        condiciones.append("c.estatus = %s")
+        params.append(filtros['estatus'])
+    if 'servicio_id' in filtros:
+        condiciones.append("""EXISTS (SELECT 1 FROM citas_servicios cs
+                                      WHERE cs.cita_id = c.cita_id AND cs.servicio_id = %s)""")
+        params.append(filtros['servicio_id'])
+    if 'cliente' in filtros:
+        sql_cliente, params_cliente = condicion_cliente('c', filtros['cliente'])
+        condiciones.append(sql_cliente)
+        params.extend(params_cliente)
+    return condiciones, params
+
 @app.route('/admin/cotizaciones', methods=['GET', 'POST'])
 @admin_required
 def admin_cotizaciones():
@@ -2359,33 +4985,41 @@ def admin_cotizaciones():
             if accion == 'enviar_correo':
                 cotizacion_id = int(request.form.get('id', 0))
                 if enviar_cotizacion_por_correo(cotizacion_id):
-                    flash('Cotización enviada por correo exitosamente', 'success')
+                    flash('La cotización se enviará por correo en unos momentos', 'success')
                 else:
-                    flash('Error al enviar la cotización por correo', 'danger')
+                    flash('No se pudo enviar la cotización por correo (¿tiene correo electrónico?)', 'danger')
         
-        # Obtener cotizaciones
-        cursor.execute("""SELECT c.*, s.nombre as servicio_nombre 
-                         FROM cotizaciones c 
-                         LEFT JOIN servicios s ON c.servicio_id = s.servicio_id 
-                         ORDER BY c.fecha_envio DESC""")
-        cotizaciones = cursor.fetchall()
+        # Filtros (todos opcionales) y página actual
+        filtros = filtros_admin(request.args)
+        condiciones, params = condiciones_cotizaciones(filtros)
+        
+        # Obtener cotizaciones (una página)
+        cotizaciones, pagina = consultar_pagina(
+            cursor,
+            """SELECT c.*, s.nombre as servicio_nombre 
+               FROM cotizaciones c 
+               LEFT JOIN servicios s ON c.servicio_id = s.servicio_id""",
+            condiciones, params,
+            [('c.fecha_envio', 'fecha_envio', '%Y-%m-%d %H:%M:%S'),
+             ('c.cotizacion_id', 'cotizacion_id', int)],
+            request.args
+        )
         
-        return render_template('admin/cotizaciones.html', cotizaciones=cotizaciones)
+        servicios = catalogos.obtener('servicios', cursor)
+        
+        return render_template('admin/cotizaciones.html', cotizaciones=cotizaciones,
+                               servicios=servicios, filtros=filtros, pagina=pagina)
     
     except ValueError as e:
-        print(f"[ERROR] Error de validación en admin_usuarios: {e}")
+        logger.error("Error de validación en admin_cotizaciones: %s", e)
         flash(f'Error en los datos ingresados: {str(e)}', 'danger')
         return redirect(url_for('admin_usuarios'))
     except Error as e:
-        print(f"[ERROR] Error de BD en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en admin_cotizaciones: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en admin_cotizaciones: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('admin_dashboard'))
     finally:
@@ -2393,7 +5027,7 @@ def admin_cotizaciones():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en admin_usuarios: {e}")
+                logger.error("Error cerrando conexión en admin_cotizaciones: %s", e)
 
 @app.route('/admin/citas', methods=['GET', 'POST'])
 @admin_required
@@ -2423,7 +5057,12 @@ def admin_citas():
             if accion == 'eliminar':
                 cita_id = int(request.form.get('id', 0))
                 try:
+                    cursor.execute("SELECT DATE(fecha_registro) AS dia FROM citas WHERE cita_id = %s", (cita_id,))
+                    cita = cursor.fetchone()
                     cursor.execute("DELETE FROM citas WHERE cita_id = %s", (cita_id,))
+                    if cita and cursor.rowcount:
+                        # Se descuenta del día en que se registró la cita
+                        sumar_estadistica(cursor, 'citas', -1, cita['dia'])
                     conn.commit()
                     flash('Cita eliminada exitosamente', 'success')
                 except Error as e:
@@ -2438,16 +5077,28 @@ def admin_citas():
                 except Error as e:
                     flash(f'Error al actualizar el estatus: {str(e)}', 'danger')
         
-        # Obtener citas ordenadas por fecha y hora con JOINs
-        cursor.execute("""SELECT c.*, cl.nombre as cliente_nombre, cl.telefono as cliente_telefono, 
-                         cl.correo as cliente_correo, s.nombre as servicio_nombre_completo,
-                         u.nombre as usuario_nombre
-                         FROM citas c
-                         LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
-                         LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
-                         LEFT JOIN usuarios u ON c.usuario_id = u.usuario_id
-                         ORDER BY c.fecha DESC, c.hora DESC""")
-        citas = cursor.fetchall()
+        # Filtros (todos opcionales) y página actual
+        filtros = filtros_admin(request.args, con_estatus=True)
+        condiciones, params = condiciones_citas(filtros)
+        
+        # Obtener citas ordenadas por fecha y hora con JOINs (una página)
+        citas, pagina = consultar_pagina(
+            cursor,
+            """SELECT c.*, cl.nombre as cliente_nombre, cl.telefono as cliente_telefono, 
+               cl.correo as cliente_correo, s.nombre as servicio_nombre_completo,
+               u.nombre as usuario_nombre
+               FROM citas c
+               LEFT JOIN clientes cl ON c.cliente_id = cl.cliente_id
+               LEFT JOIN servicios s ON c.servicio_id = s.servicio_id
+               LEFT JOIN usuarios u ON c.usuario_id = u.usuario_id""",
+            condiciones, params,
+            [('c.fecha', 'fecha', '%Y-%m-%d'),
+             ('c.hora', 'hora', '%H:%M:%S'),
+             ('c.cita_id', 'cita_id', int)],
+            request.args
+        )
+        
+        servicios = catalogos.obtener('servicios', cursor)
         
         # Convertir horas de timedelta a time si es necesario
         for cita in citas:
@@ -2467,22 +5118,19 @@ def admin_citas():
                 except ValueError:
                     pass  # Mantener como string si no se puede parsear
         
-        return render_template('admin/citas.html', citas=citas)
+        return render_template('admin/citas.html', citas=citas, servicios=servicios,
+                               estatus_opciones=ESTATUS_CITAS, filtros=filtros, pagina=pagina)
     
     except ValueError as e:
-        print(f"[ERROR] Error de validación en admin_usuarios: {e}")
+        logger.error("Error de validación en admin_citas: %s", e)
         flash(f'Error en los datos ingresados: {str(e)}', 'danger')
         return redirect(url_for('admin_usuarios'))
     except Error as e:
-        print(f"[ERROR] Error de BD en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error de BD en admin_citas: %s", e)
         flash(f'Error de base de datos: {str(e)}', 'danger')
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Error inesperado en admin_usuarios: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error inesperado en admin_citas: %s", e)
         flash('Error inesperado. Por favor intenta más tarde.', 'danger')
         return redirect(url_for('admin_dashboard'))
     finally:
@@ -2490,13 +5138,368 @@ def admin_citas():
             try:
                 conn.close()
             except Exception as e:
-                print(f"[ERROR] Error cerrando conexión en admin_usuarios: {e}")
+                logger.error("Error cerrando conexión en admin_citas: %s", e)
+
+# ============================================
+# EXPORTACIÓN DE CITAS Y COTIZACIONES
+# ============================================
+# Para el cierre de mes se exportan todas las citas o cotizaciones (con los
+# mismos filtros del panel) a CSV o PDF. La respuesta se va generando
+# mientras se lee la BD: se usa una conexión propia con un cursor sin buffer
+# (las filas se leen del servidor de EXPORTACION_LOTE en EXPORTACION_LOTE) y
+# cada lote se escribe y se manda al navegador antes de leer el siguiente,
+# así que la memoria usada no depende de cuántos registros haya.
+
+EXPORTACION_LOTE = 500
+
+# Los servicios de cada registro se juntan en la misma consulta (con el
+# cursor sin buffer no se pueden hacer otras consultas mientras se lee)
+EXPORTACIONES = {
+    'cotizaciones': {
+        'sql': """SELECT c.cotizacion_id, c.fecha_envio, c.nombre, c.telefono, c.email,
+                         c.marca_vehiculo, c.modelo_vehiculo, c.anio_vehiculo, c.cilindros, c.precio_calculado,
+                         (SELECT GROUP_CONCAT(s.nombre ORDER BY s.nombre SEPARATOR ', ')
+                          FROM cotizaciones_servicios cs JOIN servicios s ON cs.servicio_id = s.servicio_id
+                          WHERE cs.cotizacion_id = c.cotizacion_id) AS servicios,
+                         c.servicio
+                  FROM cotizaciones c""",
+        'orden': "c.fecha_envio, c.cotizacion_id",
+        'condiciones': condiciones_cotizaciones,
+        'con_estatus': False,
+        # (título, llave, ancho en el PDF)
+        'columnas': [('ID', 'cotizacion_id', 40), ('Fecha', 'fecha_envio', 80), ('Cliente', 'nombre', 110),
+                     ('Teléfono', 'telefono', 70), ('Email', 'email', 130), ('Vehículo', 'vehiculo', 110),
+                     ('Servicios', 'servicios', 120), ('Precio', 'precio_calculado', 60)]
+    },
+    'citas': {
+        'sql': """SELECT c.cita_id, c.fecha, c.hora, c.nombre, c.telefono, c.email, c.estatus,
+                         (SELECT GROUP_CONCAT(s.nombre ORDER BY s.nombre SEPARATOR ', ')
+                          FROM citas_servicios cs JOIN servicios s ON cs.servicio_id = s.servicio_id
+                          WHERE cs.cita_id = c.cita_id) AS servicios,
+                         c.servicio
+                  FROM citas c""",
+        'orden': "c.fecha, c.hora, c.cita_id",
+        'condiciones': condiciones_citas,
+        'con_estatus': True,
+        'columnas': [('ID', 'cita_id', 40), ('Fecha', 'fecha', 60), ('Hora', 'hora', 40), ('Cliente', 'nombre', 120),
+                     ('Teléfono', 'telefono', 75), ('Email', 'email', 140), ('Servicios', 'servicios', 165),
+                     ('Estatus', 'estatus', 80)]
+    }
+}
+
+def _texto_exportacion(fila, llave):
+    """Valor de una columna como texto para el CSV o el PDF."""
+    if llave == 'vehiculo':
+        partes = [fila.get('marca_vehiculo'), fila.get('modelo_vehiculo'), fila.get('anio_vehiculo')]
+        return ' '.join(str(parte) for parte in partes if parte)
+    if llave == 'servicios':
+        return fila.get('servicios') or fila.get('servicio') or ''
+    valor = fila.get(llave)
+    if valor is None:
+        return ''
+    if isinstance(valor, timedelta):
+        minutos = int(valor.total_seconds()) // 60
+        return f"{minutos // 60:02d}:{minutos % 60:02d}"
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d %H:%M')
+    if hasattr(valor, 'isoformat'):
+        return valor.isoformat()
+    if llave == 'precio_calculado':
+        return f"{float(valor):.2f}"
+    return str(valor)
+
+# Excel (y LibreOffice) toman como fórmula una celda que empieza con estos caracteres
+INICIOS_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+def _celda_csv(texto):
+    """
+    Texto seguro para una celda del CSV: los nombres, correos y comentarios
+    vienen de formularios públicos, y algo como =HYPERLINK(...) se abriría
+    como fórmula en la hoja del admin. Se le antepone ' para que sea texto.
+    """
+    return "'" + texto if texto.startswith(INICIOS_FORMULA) else texto
+
+def leer_exportacion(definicion, filtros):
+    """
+    Generador de lotes de filas (dicts) leídos con un cursor sin buffer.
+    
+    Usa una conexión propia del pool (no la del request). Si se leyó todo
+    se devuelve al pool; si la descarga se cancela a medias (GeneratorExit)
+    o falla, se corta sin leer las filas que faltan (ConexionPool.descartar).
+    """
+    condiciones, params = definicion['condiciones'](filtros)
+    sql = definicion['sql']
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += " ORDER BY " + definicion['orden']
+    
+    conn = db_pool.obtener()
+    completa = False
+    try:
+        # Sin buffered=True: MySQL manda las filas conforme se van pidiendo
+        cursor = CursorMedido(conn.cursor(dictionary=True))
+        cursor.execute(sql, tuple(params))
+        while True:
+            filas = cursor.fetchmany(EXPORTACION_LOTE)
+            if not filas:
+                break
+            yield filas
+        completa = True
+    finally:
+        if completa:
+            conn.close()
+        else:
+            # Devolverla al pool haría rollback(), que primero lee todas las
+            # filas que faltan: una exportación cancelada seguiría leyendo el mes entero
+            conn.descartar()
+
+def generar_csv(definicion, filtros):
+    """Genera el CSV por partes: el encabezado y después un bloque por lote."""
+    salida = StringIO()
+    escritor = csv.writer(salida)
+    # BOM para que Excel reconozca los acentos
+    salida.write('\ufeff')
+    escritor.writerow([titulo for titulo, _, _ in definicion['columnas']])
+    yield salida.getvalue()
+    for filas in leer_exportacion(definicion, filtros):
+        salida.seek(0)
+        salida.truncate()
+        for fila in filas:
+            escritor.writerow([_celda_csv(_texto_exportacion(fila, llave)) for _, llave, _ in definicion['columnas']])
+        yield salida.getvalue()
+
+class PDFEnStreaming:
+    """
+    Escritor mínimo de PDF que manda cada página en cuanto se termina.
+    
+    ReportLab guarda todas las páginas hasta save(), así que para miles de
+    páginas la memoria crecería con el reporte. Aquí cada página se escribe
+    y se olvida; solo se recuerdan las posiciones (bytes) de cada objeto para
+    la tabla xref del final. Usa las fuentes estándar Helvetica y
+    Helvetica-Bold (no hay que incrustar nada) con codificación WinAnsi para
+    los acentos.
+    """
+    
+    FUENTES = {'F1': 'Helvetica', 'F2': 'Helvetica-Bold'}
+    
+    def __init__(self, ancho, alto):
+        self.ancho = ancho
+        self.alto = alto
+        self._posicion = 0
+        self._posiciones = {}  # {número de objeto: byte donde empieza}
+        self._paginas = []  # Números de objeto de cada página
+        # 1 = catálogo, 2 = árbol de páginas, 3 y 4 = fuentes; las páginas siguen
+        self._siguiente = 5
+    
+    def _escribir(self, datos):
+        self._posicion += len(datos)
+        return datos
+    
+    def _objeto(self, numero, cuerpo):
+        self._posiciones[numero] = self._posicion
+        return self._escribir(b'%d 0 obj\n' % numero + cuerpo + b'\nendobj\n')
+    
+    @staticmethod
+    def texto(x, y, texto, fuente='F1', tamaño=8):
+        """Instrucción para dibujar un texto (para armar el contenido de una página)."""
+        escapado = texto.encode('cp1252', 'replace').replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+        return b'BT /%s %d Tf %.2f %.2f Td (%s) Tj ET\n' % (fuente.encode(), tamaño, x, y, escapado)
+    
+    @staticmethod
+    def linea(x1, y1, x2, y2):
+        return b'%.2f %.2f m %.2f %.2f l S\n' % (x1, y1, x2, y2)
+    
+    def inicio(self):
+        cabecera = self._escribir(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        fuentes = b''.join(
+            self._objeto(numero, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % nombre.encode())
+            for numero, nombre in zip((3, 4), self.FUENTES.values()))
+        return cabecera + fuentes
+    
+    def pagina(self, contenido):
+        """Regresa los bytes de una página completa (contenido = instrucciones de dibujo)."""
+        comprimido = zlib.compress(contenido)
+        numero_contenido, numero_pagina = self._siguiente, self._siguiente + 1
+        self._siguiente += 2
+        self._paginas.append(numero_pagina)
+        return (self._objeto(numero_contenido, b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(comprimido)
+                             + comprimido + b'\nendstream')
+                + self._objeto(numero_pagina, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+                                              b'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>'
+                               % (self.ancho, self.alto, numero_contenido)))
+    
+    def fin(self):
+        """Árbol de páginas, catálogo, tabla xref y trailer."""
+        hijos = b' '.join(b'%d 0 R' % numero for numero in self._paginas)
+        datos = self._objeto(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (hijos, len(self._paginas)))
+        datos += self._objeto(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        inicio_xref = self._posicion
+        total = self._siguiente
+        xref = [b'xref\n0 %d\n' % total, b'0000000000 65535 f \n']
+        xref += [b'%010d 00000 n \n' % self._posiciones[numero] for numero in range(1, total)]
+        xref.append(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (total, inicio_xref))
+        return datos + self._escribir(b''.join(xref))
+
+def generar_pdf(definicion, filtros, titulo):
+    """Genera el PDF por partes: una página cada que se llena (carta horizontal)."""
+    ancho, alto = letter[1], letter[0]
+    margen = 0.5 * inch
+    alto_renglon = 12
+    pdf = PDFEnStreaming(ancho, alto)
+    columnas = definicion['columnas']
+    
+    def recortar(texto, ancho_columna, fuente='Helvetica', tamaño=8):
+        if stringWidth(texto, fuente, tamaño) <= ancho_columna - 4:
+            return texto
+        while texto and stringWidth(texto + '…', fuente, tamaño) > ancho_columna - 4:
+            texto = texto[:-1]
+        return texto + '…'
+    
+    def encabezado(numero_pagina):
+        y = alto - margen
+        contenido = pdf.texto(margen, y - 10, titulo, 'F2', 12)
+        contenido += pdf.texto(ancho - margen - 60, y - 10, f'Página {numero_pagina}', 'F1', 8)
+        y -= 30
+        x = margen
+        for nombre, _, ancho_columna in columnas:
+            contenido += pdf.texto(x, y, nombre, 'F2', 8)
+            x += ancho_columna
+        contenido += pdf.linea(margen, y - 3, ancho - margen, y - 3)
+        return contenido, y - alto_renglon - 3
+    
+    yield pdf.inicio()
+    numero_pagina = 1
+    contenido, y = encabezado(numero_pagina)
+    total = 0
+    for filas in leer_exportacion(definicion, filtros):
+        partes = []
+        for fila in filas:
+            if y < margen:
+                partes.append(pdf.pagina(contenido))
+                numero_pagina += 1
+                contenido, y = encabezado(numero_pagina)
+            x = margen
+            for _, llave, ancho_columna in columnas:
+                contenido += pdf.texto(x, y, recortar(_texto_exportacion(fila, llave), ancho_columna))
+                x += ancho_columna
+            y -= alto_renglon
+            total += 1
+        if partes:
+            yield b''.join(partes)
+    contenido += pdf.texto(margen, max(y - 6, margen / 2), f'Total de registros: {total}', 'F2', 9)
+    yield pdf.pagina(contenido) + pdf.fin()
+
+@app.route('/admin/<any(citas, cotizaciones):tabla>/exportar.<any(csv, pdf):formato>')
+@admin_required
+def admin_exportar(tabla, formato):
+    """
+    Exporta todas las citas o cotizaciones que cumplen los filtros del panel
+    (desde, hasta, servicio_id, cliente y, en citas, estatus) a CSV o PDF.
+    
+    La descarga empieza de inmediato y se va llenando conforme se leen
+    los registros (ver leer_exportacion).
+    """
+    definicion = EXPORTACIONES[tabla]
+    filtros = filtros_admin(request.args, con_estatus=definicion['con_estatus'])
+    sufijo = '_'.join(str(filtros[nombre]) for nombre in ('desde', 'hasta') if nombre in filtros)
+    nombre_archivo = f"{tabla}{'_' + sufijo if sufijo else ''}.{formato}"
+    
+    if formato == 'csv':
+        cuerpo = generar_csv(definicion, filtros)
+        tipo = 'text/csv; charset=utf-8'
+    else:
+        titulo = f"{tabla.capitalize()} - exportado el {datetime.now().strftime('%d/%m/%Y %H:%M')}"
+        if sufijo:
+            titulo += f" ({sufijo.replace('_', ' a ')})"
+        cuerpo = generar_pdf(definicion, filtros, titulo)
+        tipo = 'application/pdf'
+    
+    logger.info("Exportación de %s a %s con filtros %s", tabla, formato, filtros)
+    return Response(stream_with_context(cuerpo), mimetype=tipo, headers={
+        'Content-Disposition': f'attachment; filename="{nombre_archivo}"',
+        'X-Accel-Buffering': 'no'  # Que nginx no junte toda la respuesta antes de mandarla
+    })
+
+# ============================================
+# ARRANQUE EN PRODUCCIÓN (VARIOS PROCESOS)
+# ============================================
+# En producción la aplicación corre con gunicorn (ver gunicorn.conf.py y
+# wsgi.py): un proceso principal carga la aplicación una vez, precarga las
+# plantillas y los catálogos, y hace fork de varios workers con hilos.
+# Los workers comparten esa memoria (copy-on-write), pero todo lo que tiene
+# hilos, sockets o locks se vuelve a crear en cada uno (reiniciar_tras_fork).
+
+def precargar():
+    """
+    Compila todas las plantillas y carga los catálogos y el índice de precios,
+    para que ningún worker lo haga en su primer request.
+    
+    Al final cierra las conexiones que usó: un socket de MySQL no se puede
+    compartir entre procesos.
+    """
+    inicio = perf_counter()
+    plantillas = [nombre for nombre in app.jinja_env.list_templates() if nombre.endswith('.html')]
+    for nombre in plantillas:
+        app.jinja_env.get_template(nombre)
+    try:
+        # Primero las versiones de cache_versiones: así los workers (que las
+        # heredan) se enteran de cualquier cambio posterior a esta carga
+        avisos_cambios.revisar()
+        for nombre in CatalogosReferencia.CONSULTAS:
+            catalogos.obtener(nombre)
+        motor_precios.recargar()
+    except Error as e:
+        # Sin BD se arranca igual; cada worker los cargará cuando los necesite
+        logger.warning("No se pudieron precargar los catálogos: %s", e)
+    finally:
+        db_pool.cerrar()
+    logger.info("Precarga lista: %s plantillas y catálogos en %.0f ms", len(plantillas), (perf_counter() - inicio) * 1000)
+
+def reiniciar_tras_fork():
+    """Corre en cada proceso hijo justo después del fork (ver os.register_at_fork)."""
+    reiniciar_logs_tras_fork()
+    db_pool.reiniciar_tras_fork()
+    avisos_cambios.reiniciar_tras_fork()
+    verificador_passwords.reiniciar_tras_fork()
+    cola_correos.reiniciar_tras_fork()
+
+if hasattr(os, 'register_at_fork'):  # No existe en Windows (ahí no hay fork)
+    os.register_at_fork(after_in_child=reiniciar_tras_fork)
+
+def apagar():
+    """
+    Cierre ordenado del proceso: termina el lote de correos en curso, cierra
+    el pool de hashes y las conexiones libres. Se llama al salir (atexit) y
+    desde gunicorn cuando un worker termina.
+    """
+    cola_correos.detener()
+    verificador_passwords.cerrar()
+    db_pool.cerrar()
+    guardar_metricas_proceso(forzar=True)
+
+# Se registra después de detener_logs, así corre antes y sus mensajes sí se escriben
+atexit.register(apagar)
+
+def crear_app(precarga=True):
+    """
+    Punto de entrada para servidores WSGI (wsgi.py).
+    
+    Las rutas se registran al importar este módulo, así que aquí solo se deja
+    la aplicación lista para atender: con precarga=True se compilan las
+    plantillas y se cargan los catálogos antes de crear los workers.
+    También borra las métricas que dejó en METRICAS_DIR la ejecución anterior.
+    """
+    metricas_compartidas.limpiar()
+    if precarga:
+        precargar()
+    return app
 
 # ============================================
 # PUNTO DE ENTRADA DE LA APLICACIÓN
 # ============================================
 # Esto solo se ejecuta si ejecutamos este archivo directamente
-# (no si lo importamos como módulo)
+# (no si lo importamos como módulo). Es el servidor de desarrollo; en
+# producción se usa gunicorn (gunicorn -c gunicorn.conf.py wsgi:app).
 
 if __name__ == '__main__':
     # Iniciamos el servidor Flask
@@ -0,0 +1,587 @@
+"""
+Modo asíncrono (ASGI) del Taller Automotriz.
+
+Los endpoints que casi todo el tiempo esperan a la base de datos o al
+servidor de correo corren aquí como corrutinas, sobre aiomysql y
+aiosmtplib, así un solo proceso atiende muchos requests a la vez sin un
+hilo por cada uno:
+
+- GET  /api/horarios_disponibles/<fecha>
+- GET  /api/disponibilidad
+- POST /calcular_precio y /calcular_precios
+- GET  /usuario/cotizaciones/<id>/detalles
+- POST /usuario/cotizaciones/reenviar
+- El envío de la cola de correos (correos_pendientes)
+
+Todo lo demás (páginas HTML, panel de administración, login...) es la misma
+aplicación Flask de app.py, montada con WsgiToAsgi. Las consultas, las
+respuestas JSON y el SQL de la cola son los mismos de app.py, así que los
+dos modos responden igual. Si un handler asíncrono no puede atender un
+request (por ejemplo, no hay sesión y hay que redirigir al login con un
+mensaje flash), lo pasa a Flask.
+
+Ejecutar:
+    pip install -r requirements-async.txt
+    uvicorn asgi:aplicacion --host 0.0.0.0 --port 8000
+    (o simplemente: python asgi.py)
+
+El modo de siempre (python app.py o gunicorn app:app) no cambia y no
+necesita estas dependencias.
+"""
+
+import asyncio
+import contextlib
+import os
+import re
+import time
+import uuid
+from datetime import datetime
+from http.cookies import SimpleCookie, CookieError
+from time import perf_counter
+from urllib.parse import parse_qs
+
+try:
+    import aiomysql
+    import aiosmtplib
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError as e:
+    raise ImportError("El modo asíncrono necesita aiomysql, aiosmtplib y asgiref "
+                      f"(pip install -r requirements-async.txt): {e}") from e
+
+from flask_mail import sanitize_address, sanitize_addresses
+from itsdangerous import BadSignature
+
+import app as taller
+from app import logger, metricas
+
+ASYNC_CONFIG = {
+    'host': os.environ.get('ASGI_HOST', '127.0.0.1'),
+    'port': int(os.environ.get('ASGI_PORT', 8000)),
+    # Conexiones de aiomysql (aparte del pool de app.py, que sigue atendiendo a Flask)
+    'pool_size': int(os.environ.get('ASYNC_DB_POOL_SIZE', taller.DB_POOL_CONFIG['pool_size'])),
+    # Correos que se envían a la vez por SMTP
+    'correos_concurrencia': int(os.environ.get('ASYNC_CORREOS_CONCURRENCIA', 5)),
+    # Segundos máximos de una conversación SMTP
+    'smtp_timeout': float(os.environ.get('ASYNC_SMTP_TIMEOUT', 30))
+}
+
+flask_app = taller.app
+
+# ============================================
+# BASE DE DATOS ASÍNCRONA
+# ============================================
+
+class Medicion:
+    """Consultas y tiempo de BD de un request (lo mismo que g.db_consultas/g.db_tiempo en Flask)."""
+
+    def __init__(self):
+        self.inicio = perf_counter()
+        self.consultas = 0
+        self.tiempo_db = 0.0
+
+class CursorAsyncMedido:
+    """Envoltura del cursor de aiomysql que mide cada execute, igual que CursorMedido."""
+
+    def __init__(self, cursor, medicion):
+        self._cursor = cursor
+        self._medicion = medicion
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+    async def execute(self, sql, params=None):
+        inicio = perf_counter()
+        try:
+            return await self._cursor.execute(sql, params)
+        finally:
+            if self._medicion is not None:
+                self._medicion.consultas += 1
+                self._medicion.tiempo_db += perf_counter() - inicio
+
+class BaseDatosAsync:
+    """
+    Pool de conexiones de aiomysql.
+
+    Las conexiones trabajan en autocommit: cada handler hace una sola
+    sentencia de escritura, y así ninguna conexión vuelve al pool con una
+    transacción abierta.
+    """
+
+    def __init__(self, pool_size, timeout, recycle):
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._recycle = recycle
+        self._pool = None
+
+    async def abrir(self):
+        config = taller.DB_CONFIG
+        self._pool = await aiomysql.create_pool(
+            host=config['host'], port=config['port'], db=config['database'],
+            user=config['user'], password=config['password'], charset=config['charset'],
+            minsize=1, maxsize=self._pool_size, pool_recycle=self._recycle,
+            autocommit=True, cursorclass=aiomysql.DictCursor)
+        logger.info("Pool asíncrono de MySQL listo (%s conexiones)", self._pool_size)
+
+    async def cerrar(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    @contextlib.asynccontextmanager
+    async def cursor(self, medicion=None):
+        """Toma una conexión del pool (esperando como mucho DB_POOL_TIMEOUT) y da un cursor medido."""
+        if self._pool is None:
+            raise aiomysql.OperationalError("El pool asíncrono no está abierto")
+        try:
+            conn = await asyncio.wait_for(self._pool.acquire(), self._timeout)
+        except asyncio.TimeoutError:
+            raise aiomysql.OperationalError("No hay conexiones libres en el pool asíncrono")
+        try:
+            async with conn.cursor() as cursor:
+                yield CursorAsyncMedido(cursor, medicion)
+        finally:
+            self._pool.release(conn)
+
+base_datos = BaseDatosAsync(ASYNC_CONFIG['pool_size'], taller.DB_POOL_CONFIG['timeout'],
+                            taller.DB_POOL_CONFIG['recycle'])
+
+# ============================================
+# ENVÍO ASÍNCRONO DE CORREOS
+# ============================================
+
+class ColaCorreosAsync:
+    """
+    Envía la cola de correos_pendientes desde el event loop.
+
+    Reclama los lotes con el mismo UPDATE ... token que ColaCorreos (así puede
+    convivir con procesos que usan los hilos), arma los mensajes con los
+    constructores de app.py en un hilo (usan render_template y el cursor
+    síncrono) y los envía por aiosmtplib, varios a la vez.
+    """
+
+    def __init__(self, cola, concurrencia, smtp_timeout, intervalo, lote):
+        self._cola = cola
+        self._intervalo = intervalo
+        self._lote = lote
+        self._semaforo = asyncio.Semaphore(concurrencia)
+        self._smtp_timeout = smtp_timeout
+        self._aviso = asyncio.Event()
+        self._loop = None
+        self._tarea = None
+
+    def iniciar(self):
+        """Arranca la tarea de envío y hace que cola_correos.despertar() la avise a ella."""
+        self._loop = asyncio.get_running_loop()
+        self._cola.delegar(self.despertar)
+        self._tarea = asyncio.create_task(self._trabajar())
+
+    async def detener(self):
+        self._cola.delegar(None)
+        if self._tarea is not None:
+            self._tarea.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._tarea
+            self._tarea = None
+
+    def despertar(self):
+        """Se puede llamar desde cualquier hilo (las rutas de Flask corren en hilos)."""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._aviso.set)
+
+    async def _trabajar(self):
+        while True:
+            try:
+                procesados = await self._procesar_lote()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error en la cola de correos asíncrona: %s", e)
+                procesados = 0
+            if procesados:
+                continue  # Puede haber más correos pendientes
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._aviso.wait(), self._intervalo)
+            self._aviso.clear()
+
+    async def _procesar_lote(self):
+        token = uuid.uuid4().hex
+        async with base_datos.cursor() as cursor:
+            reclamados = await cursor.execute(taller.SQL_RECLAMAR_CORREOS,
+                                              (token, taller.MINUTOS_BLOQUEO_CORREO, self._lote))
+            if not reclamados:
+                return 0
+            await cursor.execute(taller.SQL_CORREOS_RECLAMADOS, (token,))
+            correos = await cursor.fetchall()
+
+        mensajes = await asyncio.to_thread(self._armar_mensajes, correos)
+        await asyncio.gather(*(self._enviar(correo, mensaje) for correo, mensaje in zip(correos, mensajes)))
+        return len(correos)
+
+    @staticmethod
+    def _armar_mensajes(correos):
+        """
+        Arma cada correo con CONSTRUCTORES_CORREO (en un hilo, con el contexto de Flask).
+        Retorna por cada correo (bytes, remitente, destinatarios) o la excepción / None si no se pudo.
+        """
+        resultado = []
+        conn = taller.get_db_connection()
+        if not conn:
+            return [taller.Error("No hay conexión para armar los correos")] * len(correos)
+        try:
+            cursor = taller.get_cursor(conn)
+            with flask_app.app_context():
+                for correo in correos:
+                    constructor = taller.CONSTRUCTORES_CORREO.get(correo['tipo'])
+                    try:
+                        msg = constructor(cursor, correo) if constructor else None
+                        if msg is not None:
+                            if msg.date is None:
+                                msg.date = time.time()
+                            msg = (msg.as_bytes(), sanitize_address(msg.sender), list(sanitize_addresses(msg.send_to)))
+                    except Exception as e:
+                        msg = e
+                    resultado.append(msg)
+        finally:
+            conn.close()
+        return resultado
+
+    async def _enviar(self, correo, mensaje):
+        if mensaje is None:
+            # No tiene caso reintentar: el registro no existe o no tiene a quién enviarse
+            await self._marcar(self._cola.sentencia_fallo(
+                correo, 'No se pudo armar el correo (registro inexistente o sin destinatario)', definitivo=True))
+            return
+        if isinstance(mensaje, Exception):
+            await self._marcar(self._cola.sentencia_fallo(correo, f"Error armando el correo: {mensaje}"))
+            return
+
+        contenido, remitente, destinatarios = mensaje
+        config = flask_app.config
+        inicio = perf_counter()
+        try:
+            if not config.get('MAIL_SUPPRESS_SEND', flask_app.testing):
+                async with self._semaforo:
+                    await aiosmtplib.send(
+                        contenido, sender=remitente, recipients=destinatarios,
+                        hostname=config['MAIL_SERVER'], port=config['MAIL_PORT'],
+                        username=config.get('MAIL_USERNAME'), password=config.get('MAIL_PASSWORD'),
+                        start_tls=config.get('MAIL_USE_TLS', False), use_tls=config.get('MAIL_USE_SSL', False),
+                        timeout=self._smtp_timeout)
+        except Exception as e:
+            metricas.registrar_correo(correo['tipo'], perf_counter() - inicio, 'error')
+            await self._marcar(self._cola.sentencia_fallo(correo, e))
+            return
+        metricas.registrar_correo(correo['tipo'], perf_counter() - inicio, 'enviado')
+
+        # Ya enviado: se borran los datos extra
+        await self._marcar((taller.SQL_CORREO_ENVIADO, (correo['correo_id'], correo['token'])))
+        logger.info("Correo %s (%s) enviado a %s", correo['correo_id'], correo['tipo'], destinatarios[0])
+
+    @staticmethod
+    async def _marcar(sentencia):
+        sql, params = sentencia
+        async with base_datos.cursor() as cursor:
+            await cursor.execute(sql, params)
+
+cola_correos_async = ColaCorreosAsync(taller.cola_correos, ASYNC_CONFIG['correos_concurrencia'],
+                                      ASYNC_CONFIG['smtp_timeout'], taller.CORREO_CONFIG['intervalo'],
+                                      taller.CORREO_CONFIG['lote'])
+
+# ============================================
+# REQUESTS Y RESPUESTAS
+# ============================================
+
+class PeticionAsync:
+    """Lo poco que los handlers necesitan del request: headers, query string, formulario y sesión."""
+
+    def __init__(self, scope, cuerpo=b''):
+        self.metodo = scope['method']
+        self.headers = {nombre.decode('latin-1').lower(): valor.decode('latin-1')
+                        for nombre, valor in scope.get('headers', [])}
+        self.args = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        self.form = parse_qs(cuerpo.decode('utf-8', 'replace')) if cuerpo else {}
+        request_id = self.headers.get('x-request-id', '')
+        self.request_id = request_id if taller.request_id_valido(request_id) else uuid.uuid4().hex[:16]
+        self.medicion = Medicion()
+        self._sesion = None
+
+    def arg(self, nombre, default=''):
+        return self.args.get(nombre, [default])[0]
+
+    def campo(self, nombre, default=''):
+        return self.form.get(nombre, [default])[0]
+
+    def campos(self, nombre):
+        return self.form.get(nombre, [])
+
+    @property
+    def sesion(self):
+        """La sesión firmada de Flask (solo lectura). {} si no hay cookie o la firma no es válida."""
+        if self._sesion is None:
+            self._sesion = {}
+            cookie = SimpleCookie()
+            try:
+                cookie.load(self.headers.get('cookie', ''))
+            except CookieError:
+                return self._sesion
+            nombre = flask_app.config['SESSION_COOKIE_NAME']
+            if nombre in cookie:
+                serializador = flask_app.session_interface.get_signing_serializer(flask_app)
+                try:
+                    self._sesion = serializador.loads(
+                        cookie[nombre].value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+                except BadSignature:
+                    pass
+        return self._sesion
+
+def respuesta_json(datos, codigo=200):
+    """(código, cuerpo) con el mismo JSON que jsonify() de Flask."""
+    return codigo, flask_app.json.dumps(datos).encode('utf-8') + b'\n'
+
+# ============================================
+# HANDLERS ASÍNCRONOS
+# ============================================
+# Cada handler recibe la petición y los grupos de la ruta, y regresa
+# (código, cuerpo JSON) o None para que lo atienda Flask.
+
+async def api_horarios_disponibles(peticion, fecha):
+    try:
+        dia = datetime.strptime(fecha, '%Y-%m-%d').date()
+    except ValueError:
+        return respuesta_json({'error': 'Formato de fecha inválido', 'horarios': []}, 400)
+    try:
+        async with base_datos.cursor(peticion.medicion) as cursor:
+            await cursor.execute(taller.CONSULTA_DISPONIBILIDAD, (dia, dia))
+            mascara = taller.mascaras_por_dia(dia, dia, await cursor.fetchall())[dia]
+    except aiomysql.Error as e:
+        logger.error("Error de BD obteniendo horarios: %s", e)
+        return respuesta_json({'error': 'Error de base de datos', 'horarios': []}, 500)
+    return respuesta_json({'horarios': taller.horarios_libres(mascara), 'ocupados': taller.horarios_ocupados(mascara)})
+
+async def api_disponibilidad(peticion):
+    try:
+        desde, hasta = taller.leer_rango_disponibilidad(peticion.arg('desde'), peticion.arg('hasta'))
+    except ValueError as e:
+        return respuesta_json({'error': str(e), 'dias': {}}, 400)
+    try:
+        async with base_datos.cursor(peticion.medicion) as cursor:
+            await cursor.execute(taller.CONSULTA_DISPONIBILIDAD, (desde, hasta))
+            dias = taller.mascaras_por_dia(desde, hasta, await cursor.fetchall())
+    except aiomysql.Error as e:
+        logger.error("Error de BD obteniendo disponibilidad: %s", e)
+        return respuesta_json({'error': 'Error de base de datos', 'dias': {}}, 500)
+    return respuesta_json(taller.respuesta_disponibilidad(dias))
+
+async def precios_vigentes():
+    """
+    Si el índice de precios venció (o cambió en otro proceso, ver
+    AvisosCambios), lo recarga en un hilo (usa la conexión síncrona).
+    """
+    if taller.avisos_cambios.toca_revisar():
+        await asyncio.to_thread(taller.avisos_cambios.revisar)
+    if taller.motor_precios.vencido():
+        await asyncio.to_thread(taller.motor_precios.recargar)
+
+async def calcular_precio(peticion):
+    try:
+        servicio_id = int(peticion.campo('servicio_id', 0))
+        anio = int(peticion.campo('anio', 0))
+        cilindros = int(peticion.campo('cilindros', 0))
+        if not (servicio_id and anio and cilindros):
+            return respuesta_json({'precio': 0, 'success': False, 'error': 'Datos incompletos'})
+        await precios_vigentes()
+        precio = taller.calcular_precio_servicio(None, servicio_id, cilindros, anio)
+        return respuesta_json({'precio': precio, 'success': True})
+    except ValueError as e:
+        logger.error("Error de validación en calcular_precio: %s", e)
+        return respuesta_json({'precio': 0, 'success': False, 'error': 'Datos inválidos'})
+    except taller.Error as e:
+        logger.error("Error en cálculo de precio (BD): %s", e)
+        return respuesta_json({'precio': 0, 'success': False, 'error': 'Error de base de datos'})
+
+async def calcular_precios(peticion):
+    try:
+        servicios_ids = taller.ids_servicios_unicos(peticion.campos('servicio_id[]'))
+        anio = int(peticion.campo('anio', 0))
+        cilindros = int(peticion.campo('cilindros', 0))
+        if not (servicios_ids and anio and cilindros):
+            return respuesta_json({'precios': {}, 'total': 0, 'success': False, 'error': 'Datos incompletos'})
+        await precios_vigentes()
+        return respuesta_json(taller.respuesta_precios(servicios_ids, cilindros, anio))
+    except ValueError as e:
+        logger.error("Error de validación en calcular_precios: %s", e)
+        return respuesta_json({'precios': {}, 'total': 0, 'success': False, 'error': 'Datos inválidos'})
+    except taller.Error as e:
+        logger.error("Error en cálculo de precios (BD): %s", e)
+        return respuesta_json({'precios': {}, 'total': 0, 'success': False, 'error': 'Error inesperado'})
+
+async def user_cotizacion_detalles(peticion, cotizacion_id):
+    usuario_id = peticion.sesion.get('usuario_id')
+    if not usuario_id:
+        return None  # Flask redirige al login con su mensaje
+    try:
+        async with base_datos.cursor(peticion.medicion) as cursor:
+            await cursor.execute(taller.CONSULTA_DETALLE_COTIZACION, (int(cotizacion_id), usuario_id))
+            cotizacion = await cursor.fetchone()
+    except aiomysql.Error as e:
+        logger.error("Error obteniendo detalles de cotización: %s", e)
+        return respuesta_json({'success': False, 'error': str(e)})
+    if not cotizacion:
+        return respuesta_json({'success': False, 'error': 'Cotización no encontrada o no tienes permisos'})
+    return respuesta_json({'success': True, 'cotizacion': taller.detalle_cotizacion_json(cotizacion)})
+
+async def user_reenviar_cotizacion(peticion):
+    usuario_id = peticion.sesion.get('usuario_id')
+    if not usuario_id:
+        return None  # Flask redirige al login con su mensaje
+    try:
+        cotizacion_id = int(peticion.campo('cotizacion_id', 0))
+    except ValueError:
+        return None  # Mismo error que en Flask
+    if not cotizacion_id:
+        return respuesta_json({'success': False, 'error': 'ID de cotización no proporcionado'})
+    try:
+        async with base_datos.cursor(peticion.medicion) as cursor:
+            # Verificar que la cotización pertenece al usuario (y que tenga a dónde enviarla)
+            await cursor.execute("""SELECT email FROM cotizaciones
+                                    WHERE cotizacion_id = %s AND propietario_id = %s""",
+                                 (cotizacion_id, usuario_id))
+            cotizacion = await cursor.fetchone()
+            if not cotizacion:
+                return respuesta_json({'success': False, 'error': 'Cotización no encontrada o no tienes permisos'})
+            if not cotizacion['email']:
+                logger.error("La cotización %s no existe o no tiene correo electrónico", cotizacion_id)
+                return respuesta_json({'success': False, 'error': 'No se pudo reenviar el correo'})
+            await cursor.execute(taller.SQL_ENCOLAR_CORREO, ('cotizacion', cotizacion_id, cotizacion['email'], None))
+    except aiomysql.Error as e:
+        logger.error("Error reenviando cotización: %s", e)
+        return respuesta_json({'success': False, 'error': str(e)})
+    taller.cola_correos.despertar()
+    return respuesta_json({'success': True, 'message': 'La cotización se reenviará a tu correo en unos momentos'})
+
+# (método, ruta, endpoint, handler). El endpoint es el nombre de la vista en
+# Flask, para que las métricas de los dos modos se sumen en la misma serie.
+RUTAS_ASYNC = [
+    ('GET', r'/api/horarios_disponibles/(\d{4}-\d{2}-\d{2})', 'api_horarios_disponibles', api_horarios_disponibles),
+    ('GET', r'/api/disponibilidad', 'api_disponibilidad', api_disponibilidad),
+    ('POST', r'/calcular_precio', 'calcular_precio', calcular_precio),
+    ('POST', r'/calcular_precios', 'calcular_precios', calcular_precios),
+    ('GET', r'/usuario/cotizaciones/(\d+)/detalles', 'user_cotizacion_detalles', user_cotizacion_detalles),
+    ('POST', r'/usuario/cotizaciones/reenviar', 'user_reenviar_cotizacion', user_reenviar_cotizacion),
+]
+RUTAS_ASYNC = [(metodo, re.compile(ruta + r'\Z'), endpoint, handler) for metodo, ruta, endpoint, handler in RUTAS_ASYNC]
+
+# ============================================
+# APLICACIÓN ASGI
+# ============================================
+
+class AplicacionASGI:
+    """
+    Punto de entrada ASGI: atiende las rutas de RUTAS_ASYNC con corrutinas y
+    pasa todo lo demás a la aplicación Flask (en hilos, con WsgiToAsgi).
+    """
+
+    def __init__(self, app_wsgi):
+        self._flask = WsgiToAsgi(app_wsgi)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._ciclo_de_vida(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        ruta = self._buscar_ruta(scope)
+        if ruta is None:
+            await self._flask(scope, receive, send)
+            return
+        endpoint, handler, grupos = ruta
+
+        cuerpo = b''
+        if scope['method'] == 'POST':
+            tipo = dict(scope.get('headers', [])).get(b'content-type', b'')
+            if not tipo.startswith(b'application/x-www-form-urlencoded'):
+                await self._flask(scope, receive, send)  # multipart y demás: Flask sabe leerlos
+                return
+            cuerpo = await self._leer_cuerpo(receive)
+
+        peticion = PeticionAsync(scope, cuerpo)
+        try:
+            respuesta = await handler(peticion, *grupos)
+        except Exception as e:
+            logger.exception("Error inesperado en %s (modo asíncrono): %s", endpoint, e)
+            respuesta = respuesta_json({'success': False, 'error': 'Error inesperado'}, 500)
+        if respuesta is None:
+            await self._flask(scope, self._repetir_cuerpo(cuerpo, receive), send)
+            return
+        await self._responder(send, peticion, endpoint, *respuesta)
+
+    @staticmethod
+    def _buscar_ruta(scope):
+        for metodo, patron, endpoint, handler in RUTAS_ASYNC:
+            if metodo == scope['method']:
+                coincidencia = patron.match(scope['path'])
+                if coincidencia:
+                    return endpoint, handler, coincidencia.groups()
+        return None
+
+    @staticmethod
+    async def _leer_cuerpo(receive):
+        partes = []
+        while True:
+            mensaje = await receive()
+            partes.append(mensaje.get('body', b''))
+            if not mensaje.get('more_body'):
+                return b''.join(partes)
+
+    @staticmethod
+    def _repetir_cuerpo(cuerpo, receive):
+        """receive() que primero entrega el cuerpo ya leído (para pasarle el request a Flask)."""
+        pendiente = [cuerpo]
+
+        async def recibir():
+            if pendiente:
+                return {'type': 'http.request', 'body': pendiente.pop(), 'more_body': False}
+            return await receive()
+        return recibir
+
+    @staticmethod
+    async def _responder(send, peticion, endpoint, codigo, cuerpo):
+        medicion = peticion.medicion
+        duracion = perf_counter() - medicion.inicio
+        metricas.registrar_request(endpoint, peticion.metodo, codigo, duracion, medicion.consultas, medicion.tiempo_db)
+        headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(cuerpo)).encode()),
+                   (b'x-request-id', peticion.request_id.encode())]
+        if taller.METRICAS_CONFIG['server_timing']:
+            headers.append((b'server-timing', (f'db;dur={medicion.tiempo_db * 1000:.1f};desc="{medicion.consultas} consultas", '
+                                               f'app;dur={duracion * 1000:.1f}').encode()))
+        await send({'type': 'http.response.start', 'status': codigo, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': cuerpo})
+
+    @staticmethod
+    async def _ciclo_de_vida(receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'lifespan.startup':
+                try:
+                    await base_datos.abrir()
+                    if taller.CORREO_CONFIG['workers'] > 0:
+                        cola_correos_async.iniciar()
+                except Exception as e:
+                    logger.exception("No se pudo iniciar el modo asíncrono: %s", e)
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensaje['type'] == 'lifespan.shutdown':
+                await cola_correos_async.detener()
+                await base_datos.cerrar()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+aplicacion = AplicacionASGI(flask_app)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi:aplicacion', host=ASYNC_CONFIG['host'], port=ASYNC_CONFIG['port'])
@@ -0,0 +1,33 @@
+-- ============================================
+-- MIGRACIÓN 0001: índices de citas y cotizaciones
+-- ============================================
+-- Reserva de citas (revisión de conflictos por fecha y hora), filtros del
+-- panel admin (estatus, correo, nombre) y orden por fecha de envío.
+
+-- Bases instaladas antes de que el script trajera la columna estatus
+ALTER TABLE citas 
+ADD COLUMN estatus VARCHAR(20) DEFAULT 'Pendiente' 
+AFTER servicio;
+
+UPDATE citas SET estatus = 'Pendiente' WHERE estatus IS NULL;
+
+ALTER TABLE citas 
+ADD KEY idx_citas_fecha_hora (fecha, hora);
+
+ALTER TABLE citas 
+ADD KEY idx_citas_estatus_fecha (estatus, fecha, hora);
+
+ALTER TABLE citas 
+ADD KEY idx_citas_email (email);
+
+ALTER TABLE citas 
+ADD KEY idx_citas_nombre (nombre);
+
+ALTER TABLE cotizaciones 
+ADD KEY idx_cotizaciones_fecha_envio (fecha_envio);
+
+ALTER TABLE cotizaciones 
+ADD KEY idx_cotizaciones_email (email);
+
+ALTER TABLE cotizaciones 
+ADD KEY idx_cotizaciones_nombre (nombre);
@@ -0,0 +1,22 @@
+-- ============================================
+-- MIGRACIÓN 0002: cola de correos salientes
+-- ============================================
+-- Los correos se guardan aquí y la aplicación los envía en segundo plano.
+CREATE TABLE IF NOT EXISTS correos_pendientes (
+  correo_id INT(11) NOT NULL AUTO_INCREMENT,
+  tipo VARCHAR(30) NOT NULL,
+  referencia_id INT(11) DEFAULT NULL,
+  destinatario VARCHAR(100) DEFAULT NULL,
+  datos TEXT DEFAULT NULL,
+  estatus VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+  intentos INT(11) NOT NULL DEFAULT 0,
+  ultimo_error TEXT DEFAULT NULL,
+  token VARCHAR(32) DEFAULT NULL,
+  bloqueado_hasta DATETIME DEFAULT NULL,
+  proximo_intento DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  fecha_creacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  fecha_envio DATETIME DEFAULT NULL,
+  PRIMARY KEY (correo_id),
+  KEY idx_correos_estatus_intento (estatus, proximo_intento),
+  KEY idx_correos_token (token)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
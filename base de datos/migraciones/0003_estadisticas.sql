@@ -0,0 +1,22 @@
+-- ============================================
+-- MIGRACIÓN 0003: contadores del dashboard admin
+-- ============================================
+CREATE TABLE IF NOT EXISTS estadisticas_totales (
+  nombre VARCHAR(30) NOT NULL,
+  total INT(11) NOT NULL DEFAULT 0,
+  fecha_actualizacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (nombre)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE IF NOT EXISTS estadisticas_diarias (
+  fecha DATE NOT NULL,
+  nombre VARCHAR(30) NOT NULL,
+  total INT(11) NOT NULL DEFAULT 0,
+  PRIMARY KEY (fecha, nombre)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Totales iniciales (el desglose diario se llena con las citas y cotizaciones nuevas)
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'usuarios', COUNT(*) FROM usuarios WHERE activo = 1;
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'servicios', COUNT(*) FROM servicios;
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'citas', COUNT(*) FROM citas;
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'cotizaciones', COUNT(*) FROM cotizaciones;
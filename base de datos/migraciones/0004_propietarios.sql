@@ -0,0 +1,42 @@
+-- ============================================
+-- MIGRACIÓN 0004: propietario de citas y cotizaciones
+-- ============================================
+-- Después de aplicarla, correr "flask vincular-propietarios" para asignar
+-- propietario a los registros que ya existían.
+CREATE TABLE IF NOT EXISTS trabajos_progreso (
+  trabajo VARCHAR(60) NOT NULL,
+  ultimo_id INT(11) NOT NULL DEFAULT 0,
+  fecha_actualizacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (trabajo)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+ALTER TABLE usuarios 
+ADD KEY idx_usuarios_email (email);
+
+ALTER TABLE cotizaciones 
+ADD COLUMN propietario_id INT(11) DEFAULT NULL 
+AFTER usuario_id;
+
+ALTER TABLE cotizaciones 
+ADD KEY idx_cotizaciones_propietario_fecha (propietario_id, fecha_envio);
+
+ALTER TABLE cotizaciones 
+ADD CONSTRAINT fk_cotizaciones_propietario 
+  FOREIGN KEY (propietario_id) 
+  REFERENCES usuarios (usuario_id) 
+  ON DELETE SET NULL 
+  ON UPDATE CASCADE;
+
+ALTER TABLE citas 
+ADD COLUMN propietario_id INT(11) DEFAULT NULL 
+AFTER usuario_id;
+
+ALTER TABLE citas 
+ADD KEY idx_citas_propietario_fecha (propietario_id, fecha, hora);
+
+ALTER TABLE citas 
+ADD CONSTRAINT fk_citas_propietario 
+  FOREIGN KEY (propietario_id) 
+  REFERENCES usuarios (usuario_id) 
+  ON DELETE SET NULL 
+  ON UPDATE CASCADE;
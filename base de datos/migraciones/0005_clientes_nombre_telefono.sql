@@ -0,0 +1,6 @@
+-- ============================================
+-- MIGRACIÓN 0005: búsqueda de clientes sin correo
+-- ============================================
+-- obtener_o_crear_cliente busca por (nombre, telefono) cuando no hay correo.
+ALTER TABLE clientes 
+ADD KEY idx_clientes_nombre_telefono (nombre, telefono);
@@ -0,0 +1,9 @@
+-- ============================================
+-- MIGRACIÓN 0006: índice cubriente de servicio_precios
+-- ============================================
+-- El motor de precios carga todas las filas activas ordenadas por
+-- servicio_id y precio_base. Con este índice MySQL las lee en ese orden
+-- directamente del índice (sin filesort y sin ir a la tabla).
+ALTER TABLE servicio_precios 
+ADD KEY idx_servicio_precios_activo_orden (activo, servicio_id, precio_base, 
+  cilindros_min, cilindros_max, anio_min, anio_max, precio_por_cilindro, precio_por_anio);
@@ -0,0 +1,7 @@
+-- ============================================
+-- MIGRACIÓN 0007: correos de bienvenida sin contraseña
+-- ============================================
+-- El correo de bienvenida de un admin ya no guarda la contraseña en la
+-- columna datos (ahora lleva un enlace para elegirla). Se borran las que
+-- quedaron de los correos que aún estaban en la cola.
+UPDATE correos_pendientes SET datos = NULL WHERE tipo = 'bienvenida_admin';
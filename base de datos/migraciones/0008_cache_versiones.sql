@@ -0,0 +1,11 @@
+-- ============================================
+-- MIGRACIÓN 0008: versiones de los caches en memoria
+-- ============================================
+-- Cada proceso guarda en memoria los catálogos y los precios. Cuando un
+-- admin los cambia se sube aquí la versión del área ('precios',
+-- 'servicios') y los demás procesos descartan su copia al verla.
+CREATE TABLE IF NOT EXISTS cache_versiones (
+  area VARCHAR(30) NOT NULL,
+  version BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (area)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
@@ -46,6 +46,7 @@ CREATE TABLE usuarios (
   PRIMARY KEY (usuario_id),
   UNIQUE KEY uk_usuarios_username (username),
   KEY idx_usuarios_rol_id (rol_id),
+  KEY idx_usuarios_email (email),
   CONSTRAINT fk_usuarios_rol FOREIGN KEY (rol_id) 
     REFERENCES roles (rol_id) 
     ON DELETE RESTRICT 
@@ -94,6 +95,8 @@ CREATE TABLE servicio_precios (
   PRIMARY KEY (servicio_precio_id),
   KEY idx_servicio_precios_servicio (servicio_id),
   KEY idx_servicio_precios_cilindros (cilindros_min, cilindros_max),
+  KEY idx_servicio_precios_activo_orden (activo, servicio_id, precio_base, 
+    cilindros_min, cilindros_max, anio_min, anio_max, precio_por_cilindro, precio_por_anio),
   CONSTRAINT fk_servicio_precios_servicio 
     FOREIGN KEY (servicio_id) 
     REFERENCES servicios (servicio_id) 
@@ -146,7 +149,8 @@ CREATE TABLE clientes (
   telefono VARCHAR(20) DEFAULT NULL,
   correo VARCHAR(100) DEFAULT NULL,
   PRIMARY KEY (cliente_id),
-  UNIQUE KEY uk_clientes_correo (correo)
+  UNIQUE KEY uk_clientes_correo (correo),
+  KEY idx_clientes_nombre_telefono (nombre, telefono)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
 -- ============================================
@@ -171,12 +175,17 @@ CREATE TABLE cotizaciones (
   precio_calculado DECIMAL(10,2) DEFAULT NULL,
   fecha_envio TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   usuario_id INT(11) DEFAULT NULL,
+  propietario_id INT(11) DEFAULT NULL,
   PRIMARY KEY (cotizacion_id),
   KEY idx_cotizaciones_cliente (cliente_id),
   KEY idx_cotizaciones_servicio (servicio_id),
   KEY idx_cotizaciones_marca (marca_id),
   KEY idx_cotizaciones_año (año_id),
   KEY idx_cotizaciones_usuario (usuario_id),
+  KEY idx_cotizaciones_fecha_envio (fecha_envio),
+  KEY idx_cotizaciones_email (email),
+  KEY idx_cotizaciones_nombre (nombre),
+  KEY idx_cotizaciones_propietario_fecha (propietario_id, fecha_envio),
   CONSTRAINT fk_cotizaciones_cliente 
     FOREIGN KEY (cliente_id) 
     REFERENCES clientes (cliente_id),
@@ -185,6 +194,11 @@ CREATE TABLE cotizaciones (
     REFERENCES usuarios (usuario_id) 
     ON DELETE SET NULL 
     ON UPDATE CASCADE,
+  CONSTRAINT fk_cotizaciones_propietario 
+    FOREIGN KEY (propietario_id) 
+    REFERENCES usuarios (usuario_id) 
+    ON DELETE SET NULL 
+    ON UPDATE CASCADE,
   CONSTRAINT fk_cotizaciones_servicio 
     FOREIGN KEY (servicio_id) 
     REFERENCES servicios (servicio_id) 
@@ -217,6 +231,7 @@ CREATE TABLE citas (
   servicio VARCHAR(100) DEFAULT NULL,
   servicio_id INT(11) DEFAULT NULL,
   usuario_id INT(11) DEFAULT NULL,
+  propietario_id INT(11) DEFAULT NULL,
   cotizacion_id INT(11) DEFAULT NULL,
   fecha_registro TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (cita_id),
@@ -224,6 +239,10 @@ CREATE TABLE citas (
   KEY idx_citas_servicio (servicio_id),
   KEY idx_citas_usuario (usuario_id),
   KEY idx_citas_cotizacion (cotizacion_id),
+  KEY idx_citas_fecha_hora (fecha, hora),
+  KEY idx_citas_email (email),
+  KEY idx_citas_nombre (nombre),
+  KEY idx_citas_propietario_fecha (propietario_id, fecha, hora),
   CONSTRAINT fk_citas_cliente 
     FOREIGN KEY (cliente_id) 
     REFERENCES clientes (cliente_id) 
@@ -243,6 +262,11 @@ CREATE TABLE citas (
     FOREIGN KEY (usuario_id) 
     REFERENCES usuarios (usuario_id) 
     ON DELETE SET NULL 
+    ON UPDATE CASCADE,
+  CONSTRAINT fk_citas_propietario 
+    FOREIGN KEY (propietario_id) 
+    REFERENCES usuarios (usuario_id) 
+    ON DELETE SET NULL 
     ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
@@ -367,6 +391,78 @@ CREATE TABLE presupuesto_items (
     ON UPDATE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
+-- ============================================
+-- TABLA: correos_pendientes (cola de correos salientes)
+-- ============================================
+-- Los correos se guardan aquí y la aplicación los envía en segundo plano.
+-- estatus: pendiente -> enviando -> enviado (o fallido tras varios intentos)
+DROP TABLE IF EXISTS correos_pendientes;
+CREATE TABLE correos_pendientes (
+  correo_id INT(11) NOT NULL AUTO_INCREMENT,
+  tipo VARCHAR(30) NOT NULL,
+  referencia_id INT(11) DEFAULT NULL,
+  destinatario VARCHAR(100) DEFAULT NULL,
+  datos TEXT DEFAULT NULL,
+  estatus VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+  intentos INT(11) NOT NULL DEFAULT 0,
+  ultimo_error TEXT DEFAULT NULL,
+  token VARCHAR(32) DEFAULT NULL,
+  bloqueado_hasta DATETIME DEFAULT NULL,
+  proximo_intento DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  fecha_creacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  fecha_envio DATETIME DEFAULT NULL,
+  PRIMARY KEY (correo_id),
+  KEY idx_correos_estatus_intento (estatus, proximo_intento),
+  KEY idx_correos_token (token)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- ============================================
+-- TABLAS: estadisticas_totales y estadisticas_diarias
+-- ============================================
+-- Contadores del dashboard admin. La aplicación los actualiza en la misma
+-- transacción en que crea o elimina usuarios, servicios, citas y cotizaciones.
+DROP TABLE IF EXISTS estadisticas_totales;
+CREATE TABLE estadisticas_totales (
+  nombre VARCHAR(30) NOT NULL,
+  total INT(11) NOT NULL DEFAULT 0,
+  fecha_actualizacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (nombre)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Citas y cotizaciones registradas por día (para el desglose diario y semanal)
+DROP TABLE IF EXISTS estadisticas_diarias;
+CREATE TABLE estadisticas_diarias (
+  fecha DATE NOT NULL,
+  nombre VARCHAR(30) NOT NULL,
+  total INT(11) NOT NULL DEFAULT 0,
+  PRIMARY KEY (fecha, nombre)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- ============================================
+-- TABLA: trabajos_progreso
+-- ============================================
+-- Guarda hasta dónde llegó un trabajo por lotes (por ejemplo,
+-- "flask vincular-propietarios") para poder continuarlo si se interrumpe.
+DROP TABLE IF EXISTS trabajos_progreso;
+CREATE TABLE trabajos_progreso (
+  trabajo VARCHAR(60) NOT NULL,
+  ultimo_id INT(11) NOT NULL DEFAULT 0,
+  fecha_actualizacion TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (trabajo)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- ============================================
+-- TABLA: cache_versiones
+-- ============================================
+-- Versión de cada área que los procesos guardan en memoria ('precios',
+-- 'servicios'). Al cambiarla, los demás procesos descartan su copia.
+DROP TABLE IF EXISTS cache_versiones;
+CREATE TABLE cache_versiones (
+  area VARCHAR(30) NOT NULL,
+  version BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (area)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
 -- ============================================
 -- INSERTAR DATOS: MARCAS
 -- ============================================
@@ -402,6 +498,7 @@ ALTER TABLE clientes AUTO_INCREMENT = 1;
 ALTER TABLE cotizaciones AUTO_INCREMENT = 1;
 ALTER TABLE presupuestos AUTO_INCREMENT = 1;
 ALTER TABLE presupuesto_items AUTO_INCREMENT = 1;
+ALTER TABLE correos_pendientes AUTO_INCREMENT = 1;
 ALTER TABLE servicios AUTO_INCREMENT = 7;
 ALTER TABLE roles AUTO_INCREMENT = 3;
 ALTER TABLE usuarios AUTO_INCREMENT = 2;
@@ -421,6 +518,10 @@ ALTER TABLE citas
 ADD COLUMN estatus VARCHAR(20) DEFAULT 'Pendiente' 
 AFTER servicio;
 
+-- Índice para filtrar por estatus en el panel admin (ordenado por fecha y hora)
+ALTER TABLE citas 
+ADD KEY idx_citas_estatus_fecha (estatus, fecha, hora);
+
 -- Desactivar modo seguro temporalmente si fuera necesario
 SET SQL_SAFE_UPDATES = 0;
 
@@ -431,6 +532,15 @@ WHERE estatus IS NULL;
 
 -- Volver a activar modo seguro (opcional)
 SET SQL_SAFE_UPDATES = 1;
+
+-- ============================================
+-- CONTADORES INICIALES DEL DASHBOARD
+-- ============================================
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'usuarios', COUNT(*) FROM usuarios WHERE activo = 1;
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'servicios', COUNT(*) FROM servicios;
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'citas', COUNT(*) FROM citas;
+REPLACE INTO estadisticas_totales (nombre, total) SELECT 'cotizaciones', COUNT(*) FROM cotizaciones;
+
 -- ============================================
 -- FIN DEL SCRIPT
 -- ============================================
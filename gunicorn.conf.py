@@ -0,0 +1,64 @@
+"""
+Configuración de gunicorn para producción.
+
+    pip install -r requirements-produccion.txt
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+- Un proceso principal importa la aplicación una vez (preload_app), precarga
+  plantillas y catálogos, y hace fork de WEB_WORKERS workers.
+- Cada worker atiende con WEB_THREADS hilos (worker gthread): la mayor parte
+  del tiempo de un request es espera de MySQL, así que los hilos sí ayudan.
+- Cada worker arma su propio pool de conexiones, su cola de correos y su
+  pool de hashes (app.reiniciar_tras_fork).
+- Con SIGTERM los workers dejan de aceptar conexiones, terminan los requests
+  en curso (hasta WEB_GRACEFUL_TIMEOUT segundos) y cierran en orden (app.apagar).
+
+Lo que cada worker guarda en memoria es solo suyo:
+- Catálogos, precios y páginas en cache: un cambio en /admin/servicios o
+  /admin/precios llega a los demás workers por la tabla cache_versiones,
+  que cada uno revisa cada CACHE_REVISION segundos (app.AvisosCambios).
+  Hasta entonces pueden seguir cotizando con los precios anteriores.
+- Métricas: cada worker guarda las suyas en METRICAS_DIR y /admin/metricas
+  regresa la suma (app.MetricasCompartidas); /admin/metricas/pool es solo
+  el pool del worker que atiende el request.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+preload_app = True
+
+# Un request que tarda más que esto se considera colgado y se reinicia el worker
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+
+# Reiniciar cada worker después de N requests (con algo de azar para que no
+# se reinicien todos a la vez) evita que una fuga de memoria crezca sin fin
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 500))
+
+accesslog = os.environ.get('WEB_ACCESS_LOG') or None  # '-' para la consola
+
+# Carpeta donde los workers juntan sus métricas (se lee al importar app.py)
+os.environ.setdefault('METRICAS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'metricas'))
+
+
+def post_fork(server, worker):
+    server.log.info("Worker %s listo", worker.pid)
+
+
+def worker_exit(server, worker):
+    from app import apagar
+    apagar()
+
+
+def child_exit(server, worker):
+    # Corre en el proceso principal: los números del worker que terminó se
+    # conservan en finalizados.json para que los contadores no bajen
+    from app import metricas_compartidas
+    metricas_compartidas.retirar(worker.pid)
@@ -0,0 +1,605 @@
+"""
+Asesor de índices del taller.
+
+Crea una base de datos aparte (por defecto servicio_automotriz_asesor) con el
+script de instalación y los mismos datos sintéticos del benchmark, recorre
+las páginas de la aplicación (como invitado, usuario y administrador)
+guardando cada consulta que se ejecuta con sus parámetros reales, y corre
+EXPLAIN sobre cada una. También busca todas las consultas escritas en app.py
+para avisar cuáles no se ejecutaron en el recorrido (esas se analizan con
+parámetros de ejemplo).
+
+En cada plan se marcan:
+- recorridos completos de una tabla (type = ALL) o de un índice (type = index)
+- "Using filesort" (ordenar en memoria o en disco en lugar de leer en orden)
+- "Using temporary" (tabla temporal para GROUP BY / DISTINCT)
+cuando afectan más de --umbral filas.
+
+Para cada tabla marcada se propone un índice (columnas con "=" primero,
+luego la de rango y luego las del ORDER BY), se crea en la base del asesor,
+se vuelve a correr EXPLAIN y se deshace. El reporte muestra el plan antes y
+después. Con --generar, los índices que sí mejoraron el plan se escriben
+como la siguiente migración de "base de datos/migraciones" (se aplica con
+"flask migrar").
+
+Uso (desde la carpeta del proyecto, con MySQL/MariaDB corriendo en local):
+
+    python herramientas/asesor_indices.py
+    python herramientas/asesor_indices.py --sin-sembrar --reporte herramientas/reportes/indices.md
+    python herramientas/asesor_indices.py --sin-sembrar --generar
+
+La conexión usa las mismas variables que la aplicación (DB_HOST, DB_PORT,
+DB_USER, DB_PASSWORD); el nombre de la base se toma de ASESOR_DB_NAME.
+⚠️ La base del asesor se BORRA y se vuelve a crear en cada corrida
+(salvo con --sin-sembrar).
+"""
+
+import argparse
+import ast
+import logging
+import os
+import re
+import sys
+import threading
+from argparse import Namespace
+from datetime import date, timedelta
+
+import mysql.connector
+
+from benchmark import (BASE_PRODUCCION, PASSWORD_BENCH, RAIZ, ServidorSMTPFalso,
+                       config_mysql, crear_base, sembrar)
+
+ARCHIVO_APP = os.path.join(RAIZ, 'app.py')
+CARPETA_MIGRACIONES = os.path.join(RAIZ, 'base de datos', 'migraciones')
+
+# Sentencias que vale la pena explicar (los INSERT ... VALUES no leen tablas)
+RE_CONSULTA = re.compile(r'^\s*(SELECT|UPDATE|DELETE|REPLACE|INSERT)\b', re.I)
+RE_INSERT_VALUES = re.compile(r'^\s*(INSERT|REPLACE)\b(?!.*\bSELECT\b)', re.I | re.S)
+RE_TABLAS = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+`?(\w+)`?(?:\s+(?:AS\s+)?`?(\w+)`?)?', re.I)
+PALABRAS_SQL = {'WHERE', 'INNER', 'LEFT', 'RIGHT', 'JOIN', 'ON', 'SET', 'ORDER', 'GROUP', 'LIMIT',
+                'USING', 'VALUES', 'SELECT', 'FOR', 'HAVING', 'AND', 'OR', 'AS', 'CROSS', 'STRAIGHT_JOIN'}
+
+
+# ============================================
+# CONSULTAS DE app.py
+# ============================================
+
+def normalizar(sql):
+    return ' '.join(sql.split())
+
+def consultas_estaticas(ruta=ARCHIVO_APP):
+    """
+    Busca en app.py los textos que son consultas SQL (incluidas las f-strings).
+
+    Returns:
+        list: [{'linea', 'sql', 'patron', 'dinamica', 'fijo'}, ...] donde patron es
+              una expresión regular que reconoce la consulta ya armada y fijo
+              cuántos caracteres no dependen de variables
+    """
+    with open(ruta, encoding='utf-8') as f:
+        arbol = ast.parse(f.read())
+    consultas = []
+    dentro_de_fstring = set()
+    for nodo in ast.walk(arbol):
+        if isinstance(nodo, ast.JoinedStr):
+            partes = []
+            for valor in nodo.values:
+                dentro_de_fstring.add(id(valor))
+                if isinstance(valor, ast.Constant):
+                    partes.append((True, valor.value))
+                else:
+                    partes.append((False, '{' + ast.unparse(valor.value) + '}'))
+            texto = ''.join(p for _, p in partes)
+            if RE_CONSULTA.match(texto):
+                patron = ''.join(re.escape(normalizar(p)) if constante else '.+?' for constante, p in partes)
+                fijo = sum(len(p) for constante, p in partes if constante)
+                consultas.append({'linea': nodo.lineno, 'sql': normalizar(texto), 'patron': patron, 'dinamica': True,
+                                  'fijo': fijo})
+    for nodo in ast.walk(arbol):
+        if (isinstance(nodo, ast.Constant) and isinstance(nodo.value, str) and id(nodo) not in dentro_de_fstring
+                and RE_CONSULTA.match(nodo.value)):
+            sql = normalizar(nodo.value)
+            consultas.append({'linea': nodo.lineno, 'sql': sql, 'patron': re.escape(sql), 'dinamica': False,
+                              'fijo': len(sql)})
+    consultas.sort(key=lambda c: c['linea'])
+    return consultas
+
+def origen(sql, estaticas):
+    """Línea de app.py de donde salió una consulta ejecutada (la más específica que coincida)."""
+    texto = normalizar(sql)
+    # Las f-strings casi sin texto fijo (p. ej. "SELECT {columnas}") coinciden con todo
+    candidatas = [c for c in estaticas if c['fijo'] >= 20 and re.search(c['patron'], texto)]
+    if not candidatas:
+        return None
+    return max(candidatas, key=lambda c: c['fijo'])['linea']
+
+def valor_ejemplo(sql_previo):
+    """Valor de ejemplo para un %s, según la columna con la que se compara."""
+    if re.search(r'\bLIMIT\s*$|\bLIMIT\s+%s\s*,\s*$|\bINTERVAL\s*$', sql_previo, re.I):
+        return 20
+    columna = re.search(r'(\w+)`?\s*(?:=|<=>|<|>|<=|>=|LIKE|IN\s*\(|BETWEEN|,)?\s*$', sql_previo, re.I)
+    columna = columna.group(1).lower() if columna else ''
+    if columna.endswith('_id') or columna in ('id', 'total', 'intentos', 'cilindros'):
+        return 1
+    if 'fecha' in columna or columna in ('desde', 'hasta'):
+        return date.today().isoformat()
+    if 'hora' in columna:
+        return '10:00:00'
+    if 'email' in columna or 'correo' in columna:
+        return 'cliente1@bench.local'
+    if 'telefono' in columna:
+        return '5500000001'
+    if 'estatus' in columna:
+        return 'Pendiente'
+    if 'username' in columna:
+        return 'bench_admin'
+    return 'Cliente 1'
+
+def parametros_ejemplo(sql):
+    partes = sql.split('%s')
+    return tuple(valor_ejemplo('%s'.join(partes[:i + 1])) for i in range(len(partes) - 1))
+
+
+# ============================================
+# RECORRIDO DE LA APLICACIÓN
+# ============================================
+
+def capturar_consultas(taller):
+    """Hace que cada execute de la aplicación se guarde en una lista (sql, params)."""
+    capturadas = []
+    lock = threading.Lock()
+    execute_original = taller.CursorMedido.execute
+
+    def execute(self, sql, params=None, *args, **kwargs):
+        with lock:
+            capturadas.append((sql, params))
+        return execute_original(self, sql, params, *args, **kwargs)
+
+    taller.CursorMedido.execute = execute
+    return capturadas
+
+def siguiente_pagina(respuesta):
+    """Cursor de la página siguiente (si el listado tiene más de una)."""
+    encontrado = re.search(r'despues=([^&"\']+)', respuesta.get_data(as_text=True))
+    return encontrado.group(1) if encontrado else None
+
+def recorrer_aplicacion(taller):
+    """Visita las páginas y APIs principales con datos sembrados; regresa [(ruta, código)]."""
+    cliente = taller.app.test_client()
+    visitas = []
+    hoy = date.today()
+    manana = (hoy + timedelta(days=1)).isoformat()
+    hace_un_mes = (hoy - timedelta(days=30)).isoformat()
+
+    def pedir(metodo, ruta, datos=None):
+        respuesta = cliente.open(ruta, method=metodo, data=datos)
+        visitas.append((f"{metodo} {ruta}", respuesta.status_code))
+        return respuesta
+
+    conn = mysql.connector.connect(**config_mysql())
+    cursor = conn.cursor()
+    cursor.execute("""SELECT c.cotizacion_id FROM cotizaciones c
+                      INNER JOIN usuarios u ON c.propietario_id = u.usuario_id
+                      WHERE u.username = 'bench_usuario_0' LIMIT 1""")
+    fila = cursor.fetchone()
+    cotizacion_usuario = fila[0] if fila else 1
+    conn.close()
+
+    formulario_cita = {'nombre': 'Asesor', 'telefono': '5599999999', 'email': 'asesor@bench.local',
+                       'fecha': (hoy + timedelta(days=400)).isoformat(), 'hora': '10:00', 'servicio_id[]': ['1', '2']}
+    formulario_cotizacion = {'nombre': 'Asesor', 'telefono': '5599999999', 'email': 'asesor@bench.local',
+                             'servicio_id[]': ['1', '3'], 'marca_vehiculo': 'Toyota', 'modelo_vehiculo': 'Corolla',
+                             'año_id': '1', 'cilindros': '4', 'mensaje': 'asesor de índices'}
+
+    # Invitado
+    for ruta in ('/', '/servicios', '/cotizaciones', '/citas', '/contacto',
+                 f'/api/horarios_disponibles/{manana}', f'/api/disponibilidad?desde={manana}'):
+        pedir('GET', ruta)
+    pedir('POST', '/calcular_precio', {'servicio_id': 1, 'anio': 2015, 'cilindros': 4})
+    pedir('POST', '/calcular_precios', {'servicio_id[]': ['1', '2', '3'], 'anio': 2015, 'cilindros': 6})
+    pedir('POST', '/citas', formulario_cita)
+    pedir('POST', '/cotizaciones', formulario_cotizacion)
+    pedir('POST', '/login', {'username': 'no_existe', 'password': 'x'})
+
+    # Usuario
+    pedir('POST', '/login', {'username': 'bench_usuario_0', 'password': PASSWORD_BENCH})
+    for ruta in ('/usuario', '/usuario/citas', '/usuario/cotizaciones',
+                 f'/usuario/cotizaciones/{cotizacion_usuario}/detalles', f'/cotizaciones/{cotizacion_usuario}/pdf',
+                 f'/citas?cotizacion_id={cotizacion_usuario}', '/cotizaciones'):
+        pedir('GET', ruta)
+    pedir('POST', '/citas', dict(formulario_cita, hora='13:00'))
+    pedir('POST', '/cotizaciones', formulario_cotizacion)
+    pedir('GET', '/logout')
+
+    # Administrador
+    pedir('POST', '/login', {'username': 'bench_admin', 'password': PASSWORD_BENCH})
+    for ruta in ('/admin', '/admin/usuarios', '/admin/servicios', '/admin/roles', '/admin/precios',
+                 '/admin/correos', '/admin/correos?estatus=pendiente', '/admin/metricas'):
+        pedir('GET', ruta)
+    filtros = ('', 'cliente=Cliente+1', 'cliente=cliente1@bench.local', f'desde={hace_un_mes}&hasta={manana}',
+               'servicio_id=1')
+    for tabla in ('citas', 'cotizaciones'):
+        for filtro in filtros + (('estatus=Pendiente', f'estatus=Pendiente&desde={hace_un_mes}') if tabla == 'citas' else ()):
+            respuesta = pedir('GET', f'/admin/{tabla}?{filtro}')
+            despues = siguiente_pagina(respuesta)
+            if despues:
+                pedir('GET', f'/admin/{tabla}?{filtro}&despues={despues}')
+        pedir('GET', f'/admin/{tabla}/exportar.csv?desde={hace_un_mes}')
+
+    # Trabajos fuera de los requests
+    taller.cola_correos._procesar_lote(None)
+    taller.vincular_propietarios(lote=2000)
+    conn = taller.get_db_connection()
+    taller.recalcular_estadisticas(taller.get_cursor(conn))
+    conn.commit()
+    conn.close()
+    return visitas
+
+
+# ============================================
+# EXPLAIN Y SUGERENCIAS
+# ============================================
+
+def explicar(cursor, sql, params):
+    cursor.execute("EXPLAIN " + sql, params or ())
+    return cursor.fetchall()
+
+def problemas_del_plan(plan, umbral):
+    """Regresa [(fila del plan, descripción)] de los pasos caros del plan."""
+    problemas = []
+    for paso in plan:
+        filas = int(paso.get('rows') or 0)
+        extra = paso.get('Extra') or ''
+        if filas < umbral or not paso.get('table') or paso['table'].startswith('<'):
+            continue
+        if paso.get('type') == 'ALL':
+            problemas.append((paso, f"recorre toda la tabla (~{filas} filas)"))
+        elif paso.get('type') == 'index' and 'Using index' not in extra:
+            problemas.append((paso, f"recorre todo el índice {paso.get('key')} (~{filas} filas)"))
+        if 'Using filesort' in extra:
+            problemas.append((paso, f"ordena ~{filas} filas (filesort)"))
+        if 'Using temporary' in extra:
+            problemas.append((paso, "usa una tabla temporal"))
+    return problemas
+
+def tablas_de_consulta(sql):
+    """{alias: tabla} de las tablas que usa la consulta."""
+    tablas = {}
+    for tabla, alias in RE_TABLAS.findall(sql):
+        if tabla.upper() in PALABRAS_SQL:
+            continue
+        if alias and alias.upper() not in PALABRAS_SQL:
+            tablas[alias] = tabla
+        tablas.setdefault(tabla, tabla)
+    return tablas
+
+def cortar_clausula(sql, inicio, fines):
+    encontrado = re.search(rf'\b{inicio}\b(.*?)(?:\b(?:{"|".join(fines)})\b|$)', sql, re.I | re.S)
+    return encontrado.group(1) if encontrado else ''
+
+def columnas_de(texto, alias, columnas_tabla, una_sola_tabla, patron_operador):
+    """Columnas de la tabla (por alias o sin alias) que aparecen en texto seguidas del operador."""
+    encontradas = []
+    for prefijo, columna in re.findall(rf'(?:\b(\w+)\.)?`?(\w+)`?\s*{patron_operador}', texto, re.I):
+        if prefijo and prefijo != alias:
+            continue
+        if not prefijo and not una_sola_tabla:
+            continue
+        if columna in columnas_tabla and columna not in encontradas:
+            encontradas.append(columna)
+    return encontradas
+
+def columnas_de_union(sql, alias, tabla):
+    """Columnas de la tabla usadas en el ON de su JOIN (solo si la tabla es la que se une)."""
+    union = re.search(rf'\bJOIN\s+`?{tabla}`?(?:\s+(?:AS\s+)?{alias})?\s+ON\b(.*?)'
+                      rf'(?=\b(?:INNER|LEFT|RIGHT|CROSS|JOIN|WHERE|ORDER|GROUP|LIMIT|SET)\b|$)', sql, re.I | re.S)
+    if not union:
+        return []
+    columnas = []
+    for a1, c1, a2, c2 in re.findall(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', union.group(1)):
+        for a, c in ((a1, c1), (a2, c2)):
+            if a == alias and c not in columnas:
+                columnas.append(c)
+    return columnas
+
+def sugerir_indice(sql, alias, tabla, columnas_tabla, indices_existentes):
+    """
+    Propone las columnas de un índice para la tabla marcada: igualdades
+    (WHERE y, si la tabla se une con JOIN, su ON), luego una columna de
+    rango, luego el ORDER BY. Si la consulta es de una sola tabla y pide
+    pocas columnas, se agregan al final para que el índice sea cubriente.
+    Regresa (columnas, None) o (None, motivo).
+    """
+    tablas = tablas_de_consulta(sql)
+    una_sola_tabla = len(set(tablas.values())) == 1
+    donde = cortar_clausula(sql, 'WHERE', ['GROUP BY', 'ORDER BY', 'LIMIT', 'FOR UPDATE', 'HAVING'])
+    orden = cortar_clausula(sql, 'ORDER BY', ['LIMIT', 'FOR UPDATE'])
+
+    igualdades = columnas_de_union(sql, alias, tabla)
+    igualdades += [c for c in columnas_de(donde, alias, columnas_tabla, una_sola_tabla, r'(?:=|<=>|IN\s*\(|IS\s+NULL)')
+                   if c not in igualdades]
+    rangos = [c for c in columnas_de(donde, alias, columnas_tabla, una_sola_tabla, r'(?:<=|>=|<|>|BETWEEN|LIKE)')
+              if c not in igualdades]
+    columnas_orden = columnas_de(orden + ',', alias, columnas_tabla, una_sola_tabla, r'(?:ASC|DESC)?\s*(?:,|$)')
+    # El ORDER BY solo sirve si todas sus columnas son de esta tabla
+    orden_completo = len(columnas_orden) == len([c for c in orden.split(',') if c.strip()])
+
+    columnas = list(igualdades)
+    if rangos and orden_completo and columnas_orden and columnas_orden[0] == rangos[0]:
+        columnas += [c for c in columnas_orden if c not in columnas]
+    elif rangos:
+        columnas.append(rangos[0])
+    elif orden_completo:
+        columnas += [c for c in columnas_orden if c not in columnas]
+    if not columnas:
+        return None, "no hay filtros ni orden sobre esta tabla que un índice pueda aprovechar"
+
+    # InnoDB ya guarda la llave primaria al final de cada índice
+    primaria = indices_existentes.get('PRIMARY', [])
+    while len(columnas) > 1 and columnas[-1] in primaria:
+        columnas.pop()
+
+    seleccion = cortar_clausula(sql, 'SELECT', ['FROM'])
+    if una_sola_tabla and sql.lstrip().upper().startswith('SELECT') and '*' not in seleccion:
+        pedidas = [c for c in columnas_de(seleccion + ',', alias, columnas_tabla, True, r'\s*(?:,|$)')
+                   if c not in columnas and c not in primaria]
+        if pedidas and len(columnas) + len(pedidas) <= 10:
+            columnas += pedidas
+
+    for nombre, existentes in indices_existentes.items():
+        if existentes[:len(columnas)] == columnas:
+            return None, f"ya existe {nombre} ({', '.join(existentes)}) pero el optimizador prefiere no usarlo"
+    return columnas, None
+
+def nombre_indice(tabla, columnas):
+    return f"idx_{tabla}_{'_'.join(columnas)}"[:64]
+
+def esquema(cursor, base):
+    """{tabla: {'columnas': [...], 'indices': {nombre: [columnas]}}}"""
+    cursor.execute("""SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS
+                      WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, ORDINAL_POSITION""", (base,))
+    tablas = {}
+    for fila in cursor.fetchall():
+        tablas.setdefault(fila['TABLE_NAME'], {'columnas': [], 'indices': {}})['columnas'].append(fila['COLUMN_NAME'])
+    cursor.execute("""SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS
+                      WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX""", (base,))
+    for fila in cursor.fetchall():
+        tablas[fila['TABLE_NAME']]['indices'].setdefault(fila['INDEX_NAME'], []).append(fila['COLUMN_NAME'])
+    return tablas
+
+def probar_indice(cursor, tabla, columnas, consultas):
+    """Crea el índice en la base del asesor, vuelve a explicar las consultas y lo borra."""
+    nombre = nombre_indice(tabla, columnas)
+    cursor.execute(f"ALTER TABLE `{tabla}` ADD KEY `{nombre}` ({', '.join(f'`{c}`' for c in columnas)})")
+    try:
+        return [explicar(cursor, c['sql'], c['params']) for c in consultas]
+    finally:
+        cursor.execute(f"ALTER TABLE `{tabla}` DROP KEY `{nombre}`")
+
+def costo(plan):
+    """Filas examinadas estimadas (producto de los pasos, como las cuenta el optimizador)."""
+    total = 1
+    for paso in plan:
+        total *= max(1, int(paso.get('rows') or 1))
+    return total
+
+
+# ============================================
+# REPORTE Y MIGRACIÓN
+# ============================================
+
+def tabla_plan(plan):
+    lineas = ['| tabla | type | key | rows | Extra |', '|---|---|---|---|---|']
+    for paso in plan:
+        lineas.append(f"| {paso.get('table')} | {paso.get('type')} | {paso.get('key') or ''} | "
+                      f"{paso.get('rows')} | {paso.get('Extra') or ''} |")
+    return '\n'.join(lineas)
+
+def escribir_migracion(sugerencias):
+    existentes = [int(a.split('_', 1)[0]) for a in os.listdir(CARPETA_MIGRACIONES) if a[:4].isdigit()]
+    version = max(existentes, default=0) + 1
+    ruta = os.path.join(CARPETA_MIGRACIONES, f"{version:04d}_asesor_indices.sql")
+    lineas = ['-- ============================================',
+              f'-- MIGRACIÓN {version:04d}: índices sugeridos por herramientas/asesor_indices.py',
+              '-- ============================================']
+    for s in sugerencias:
+        lineas.append('')
+        lineas.append(f"-- {s['motivo']}")
+        for linea in sorted(s['lineas']):
+            lineas.append(f"-- Consulta de app.py:{linea}")
+        lineas.append(f"ALTER TABLE {s['tabla']} ")
+        lineas.append(f"ADD KEY {s['nombre']} ({', '.join(s['columnas'])});")
+    with open(ruta, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lineas) + '\n')
+    return ruta
+
+def armar_reporte(base, visitas, analizadas, sin_ejecutar, sugerencias, omitidas):
+    con_problemas = [c for c in analizadas if c['problemas']]
+    partes = [f"# Asesor de índices ({base})", '',
+              f"- Páginas recorridas: {len(visitas)} "
+              f"({sum(1 for _, codigo in visitas if codigo >= 500)} con error 5xx)",
+              f"- Consultas distintas analizadas: {len(analizadas)}",
+              f"- Consultas con problemas: {len(con_problemas)}",
+              f"- Índices sugeridos: {len(sugerencias)}",
+              f"- Consultas de app.py que no se ejecutaron en el recorrido: {len(sin_ejecutar)}", '']
+    if sugerencias:
+        partes += ['## Índices sugeridos', '']
+        for s in sugerencias:
+            partes.append(f"- `{s['tabla']}.{s['nombre']}` ({', '.join(s['columnas'])}): {s['motivo']}")
+        partes.append('')
+    partes += ['## Consultas con problemas', '']
+    if not con_problemas:
+        partes += ['Ninguna: todas las consultas usan índices (o leen menos filas que el umbral).', '']
+    for c in con_problemas:
+        partes += [f"### app.py:{c['linea'] or '?'} ({c['ejecuciones']} ejecuciones)", '',
+                   '```sql', c['sql'], '```', '', '**Antes:**', '', tabla_plan(c['plan']), '']
+        partes += [f"- {descripcion}" for _, descripcion in c['problemas']]
+        partes.append('')
+        for nota in c['notas']:
+            partes += [f"- {nota}"]
+        for tabla, columnas, plan in c['despues']:
+            partes += ['', f"**Después** (con índice en {tabla}: {', '.join(columnas)}):", '', tabla_plan(plan)]
+        partes.append('')
+    if sin_ejecutar:
+        partes += ['## Consultas de app.py que no se ejecutaron en el recorrido', '']
+        partes += [f"- app.py:{c['linea']}: `{c['sql'][:120]}`" for c in sin_ejecutar]
+        partes.append('')
+    if omitidas:
+        partes += ['## Consultas que no se pudieron explicar', '']
+        partes += [f"- app.py:{linea or '?'}: {error}" for linea, error in omitidas]
+        partes.append('')
+    return '\n'.join(partes)
+
+
+# ============================================
+# PROGRAMA PRINCIPAL
+# ============================================
+
+def leer_argumentos():
+    parser = argparse.ArgumentParser(description='Corre EXPLAIN sobre las consultas de app.py y sugiere índices.')
+    parser.add_argument('--umbral', type=int, default=1000,
+                        help='Filas a partir de las cuales un recorrido completo o filesort se marca')
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--clientes', type=int, default=20000)
+    parser.add_argument('--citas', type=int, default=30000)
+    parser.add_argument('--cotizaciones', type=int, default=30000)
+    parser.add_argument('--precios', type=int, default=2000, help='Filas extra de servicio_precios')
+    parser.add_argument('--sin-sembrar', action='store_true', help='Reusar la base del asesor de la corrida anterior')
+    parser.add_argument('--reporte', metavar='ARCHIVO', help='Guardar el reporte (Markdown) en un archivo')
+    parser.add_argument('--generar', action='store_true',
+                        help='Escribir los índices que mejoraron el plan como una migración nueva')
+    return parser.parse_args()
+
+def main():
+    args = leer_argumentos()
+    base = os.environ.get('ASESOR_DB_NAME', 'servicio_automotriz_asesor')
+    if base == BASE_PRODUCCION:
+        sys.exit("ASESOR_DB_NAME no puede ser la base real: el asesor la borra y le agrega y quita índices.")
+    os.environ['BENCH_DB_NAME'] = base  # crear_base, sembrar y config_mysql usan esta variable
+
+    if not args.sin_sembrar:
+        print(f"Creando la base {base}...")
+        crear_base(base)
+        sembrar(Namespace(semilla=args.semilla, precios=args.precios, clientes=args.clientes,
+                          citas=args.citas, cotizaciones=args.cotizaciones))
+
+    smtp = ServidorSMTPFalso()
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+    config = config_mysql(con_base=False)
+    os.environ.update({
+        'DB_HOST': config['host'],
+        'DB_PORT': str(config['port']),
+        'DB_USER': config['user'],
+        'DB_PASSWORD': config['password'],
+        'DB_NAME': base,
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': str(smtp.puerto),
+        'MAIL_USE_TLS': 'False',
+        'MAIL_USERNAME': '',
+        'MAIL_PASSWORD': '',
+        'MAIL_DEFAULT_SENDER': 'taller@bench.local',
+        'CORREO_WORKERS': '0',  # La cola se procesa a mano durante el recorrido
+        'PDF_CACHE_DIR': os.path.join(RAIZ, 'instance', 'pdf_asesor')
+    })
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    sys.path.insert(0, RAIZ)
+    import app as taller
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    print("Recorriendo la aplicación...")
+    capturadas = capturar_consultas(taller)
+    visitas = recorrer_aplicacion(taller)
+    estaticas = consultas_estaticas()
+
+    # Una entrada por consulta distinta (con los parámetros de su primera ejecución)
+    distintas = {}
+    for sql, params in capturadas:
+        texto = normalizar(sql)
+        if not RE_CONSULTA.match(texto) or RE_INSERT_VALUES.match(texto):
+            continue
+        if texto in distintas:
+            distintas[texto]['ejecuciones'] += 1
+        else:
+            distintas[texto] = {'sql': texto, 'params': params, 'ejecuciones': 1, 'linea': origen(texto, estaticas)}
+    ejecutadas = list(distintas)
+    sin_ejecutar = [c for c in estaticas if not any(re.search(c['patron'], t) for t in ejecutadas)]
+    for c in sin_ejecutar:
+        if not c['dinamica'] and not RE_INSERT_VALUES.match(c['sql']):
+            distintas[c['sql']] = {'sql': c['sql'], 'params': parametros_ejemplo(c['sql']), 'ejecuciones': 0,
+                                   'linea': c['linea']}
+
+    conn = mysql.connector.connect(**config_mysql())
+    cursor = conn.cursor(dictionary=True)
+    tablas = esquema(cursor, base)
+
+    print(f"Explicando {len(distintas)} consultas...")
+    analizadas = []
+    omitidas = []
+    for consulta in distintas.values():
+        try:
+            consulta['plan'] = explicar(cursor, consulta['sql'], consulta['params'])
+        except mysql.connector.Error as e:
+            omitidas.append((consulta['linea'], e.msg))
+            continue
+        consulta['problemas'] = problemas_del_plan(consulta['plan'], args.umbral)
+        consulta['notas'] = []
+        consulta['despues'] = []
+        analizadas.append(consulta)
+
+    # Agrupar por índice sugerido: un mismo índice puede arreglar varias consultas
+    propuestas = {}
+    for consulta in analizadas:
+        vistas = set()
+        for paso, descripcion in consulta['problemas']:
+            alias = paso['table']
+            tabla = tablas_de_consulta(consulta['sql']).get(alias, alias)
+            if tabla not in tablas or alias in vistas:
+                continue
+            vistas.add(alias)
+            columnas, nota = sugerir_indice(consulta['sql'], alias, tabla, tablas[tabla]['columnas'],
+                                            tablas[tabla]['indices'])
+            if columnas is None:
+                consulta['notas'].append(f"{tabla}: {nota}")
+                continue
+            propuesta = propuestas.setdefault((tabla, tuple(columnas)), {'consultas': [], 'motivos': []})
+            propuesta['consultas'].append(consulta)
+            propuesta['motivos'].append(descripcion)
+
+    sugerencias = []
+    for (tabla, columnas), propuesta in propuestas.items():
+        columnas = list(columnas)
+        despues = probar_indice(cursor, tabla, columnas, propuesta['consultas'])
+        mejoraron = []
+        for consulta, plan in zip(propuesta['consultas'], despues):
+            consulta['despues'].append((tabla, columnas, plan))
+            if (costo(plan) < costo(consulta['plan'])
+                    or len(problemas_del_plan(plan, args.umbral)) < len(consulta['problemas'])):
+                mejoraron.append(consulta)
+            else:
+                consulta['notas'].append(f"el índice {tabla}({', '.join(columnas)}) no mejoró el plan")
+        if mejoraron:
+            sugerencias.append({'tabla': tabla, 'columnas': columnas, 'nombre': nombre_indice(tabla, columnas),
+                                'motivo': propuesta['motivos'][0],
+                                'lineas': {c['linea'] for c in mejoraron if c['linea']}})
+    conn.close()
+
+    reporte = armar_reporte(base, visitas, analizadas, sin_ejecutar, sugerencias, omitidas)
+    if args.reporte:
+        os.makedirs(os.path.dirname(os.path.abspath(args.reporte)), exist_ok=True)
+        with open(args.reporte, 'w', encoding='utf-8') as f:
+            f.write(reporte)
+        print(f"Reporte guardado en {args.reporte}")
+    else:
+        print()
+        print(reporte)
+
+    if args.generar:
+        if sugerencias:
+            print(f"Migración escrita en {escribir_migracion(sugerencias)} (aplicar con: flask migrar)")
+        else:
+            print("No hay índices que agregar: no se escribió ninguna migración")
+
+    smtp.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,702 @@
+"""
+Pruebas de carga y rendimiento del taller.
+
+Crea una base de datos aparte (por defecto servicio_automotriz_bench) con el
+script de "base de datos/servicio_automotriz.sql", la llena con datos
+sintéticos (decenas de miles de clientes, citas, cotizaciones y precios),
+levanta la aplicación en este mismo proceso con un servidor SMTP falso
+(los correos no salen de la máquina) y lanza peticiones concurrentes a los
+endpoints más usados. Al final imprime peticiones por segundo y latencias
+p50/p95/p99 de cada escenario.
+
+Los resultados se pueden guardar como baseline y comparar en la siguiente
+corrida para ver si un cambio hizo la aplicación más lenta.
+
+Además corre una prueba de doble reserva: muchos hilos intentan agendar a
+la vez horarios que se enciman (9:00, 9:30, 10:00...) y se verifica que
+ninguna cita guardada quede a menos de 1 hora de otra.
+
+Uso (desde la carpeta del proyecto, con MySQL/MariaDB corriendo en local):
+
+    python herramientas/benchmark.py
+    python herramientas/benchmark.py --guardar-baseline antes
+    python herramientas/benchmark.py --sin-sembrar --comparar antes
+    python herramientas/benchmark.py --escenarios calcular_precio,admin_citas -c 32 -d 30
+
+La conexión usa las mismas variables que la aplicación (DB_HOST, DB_PORT,
+DB_USER, DB_PASSWORD); el nombre de la base se toma de BENCH_DB_NAME.
+⚠️ La base de pruebas se BORRA y se vuelve a crear en cada corrida
+(salvo con --sin-sembrar).
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import re
+import socketserver
+import subprocess
+import sys
+import threading
+from datetime import date, datetime, timedelta
+from time import perf_counter, sleep
+from urllib.parse import urlencode
+
+import mysql.connector
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_SQL = os.path.join(RAIZ, 'base de datos', 'servicio_automotriz.sql')
+CARPETA_BASELINES = os.path.join(RAIZ, 'herramientas', 'baselines')
+
+BASE_PRODUCCION = 'servicio_automotriz'
+PASSWORD_BENCH = 'bench12345'
+USUARIOS_BENCH = 50
+
+# Los datos sembrados ocupan desde hace un año hasta DIAS_FUTUROS adelante;
+# las citas nuevas del benchmark se agendan después, en días vacíos
+DIAS_PASADOS = 365
+DIAS_FUTUROS = 60
+HORAS_CITAS = (7, 9, 11, 13, 15)  # Separadas 2 horas para que no choquen entre sí
+# Prueba de doble reserva: horarios a menos de 1 hora unos de otros (caben a lo más 3 citas)
+HORAS_RESERVA = ('09:00', '09:30', '10:00', '10:30', '11:00')
+
+
+# ============================================
+# BASE DE DATOS DE PRUEBAS
+# ============================================
+
+def config_mysql(con_base=True):
+    config = {
+        'host': os.environ.get('DB_HOST', 'localhost'),
+        'port': int(os.environ.get('DB_PORT', 3306)),
+        'user': os.environ.get('DB_USER', 'root'),
+        'password': os.environ.get('DB_PASSWORD', ''),
+        'charset': 'utf8mb4',
+        'collation': 'utf8mb4_general_ci'
+    }
+    if con_base:
+        config['database'] = os.environ['BENCH_DB_NAME']
+    return config
+
+def dividir_sentencias(script):
+    """Separa el script SQL en sentencias (respetando ';' dentro de textos)."""
+    sentencias = []
+    actual = []
+    en_texto = False
+    for linea in script.splitlines():
+        if not en_texto and (linea.strip().startswith('--') or not linea.strip()):
+            continue
+        i = 0
+        while i < len(linea):
+            c = linea[i]
+            if c == "'" and en_texto and i + 1 < len(linea) and linea[i + 1] == "'":
+                actual.append("''")
+                i += 2
+                continue
+            if c == "'":
+                en_texto = not en_texto
+            if c == ';' and not en_texto:
+                sentencia = ''.join(actual).strip()
+                if sentencia:
+                    sentencias.append(sentencia)
+                actual = []
+            else:
+                actual.append(c)
+            i += 1
+        actual.append('\n')
+    sentencia = ''.join(actual).strip()
+    if sentencia:
+        sentencias.append(sentencia)
+    return sentencias
+
+def crear_base(nombre):
+    """Borra y crea la base de pruebas ejecutando el script de instalación."""
+    with open(SCRIPT_SQL, encoding='utf-8') as f:
+        script = f.read()
+    # El script crea y usa servicio_automotriz; aquí se redirige a la base de pruebas
+    script = re.sub(r'\b(CREATE DATABASE IF NOT EXISTS|USE)\s+servicio_automotriz\b', rf'\1 {nombre}', script)
+
+    conn = mysql.connector.connect(**config_mysql(con_base=False))
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {nombre}")
+    for sentencia in dividir_sentencias(script):
+        try:
+            cursor.execute(sentencia)
+            if cursor.with_rows:
+                cursor.fetchall()
+        except mysql.connector.Error as e:
+            # El script tiene sentencias que pueden fallar sin problema
+            # (p. ej. agregar una columna que ya existe); igual que en Workbench se sigue
+            print(f"  aviso: {e.msg[:100]}")
+    conn.commit()
+    conn.close()
+
+def insertar_por_lotes(cursor, sql, filas, lote=1000):
+    for i in range(0, len(filas), lote):
+        cursor.executemany(sql, filas[i:i + lote])
+
+def sembrar(args):
+    """Llena la base de pruebas con datos sintéticos reproducibles (misma semilla, mismos datos)."""
+    from werkzeug.security import generate_password_hash
+
+    rnd = random.Random(args.semilla)
+    conn = mysql.connector.connect(**config_mysql())
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT servicio_id FROM servicios")
+    servicios = [fila[0] for fila in cursor.fetchall()]
+    cursor.execute("SELECT marca_id, nombre FROM marcas_vehiculos")
+    marcas = cursor.fetchall()
+    cursor.execute("SELECT año_id, año FROM años_vehiculos")
+    años = cursor.fetchall()
+    cursor.execute("SELECT rol_id, nombre FROM roles")
+    roles = {nombre: rol_id for rol_id, nombre in cursor.fetchall()}
+
+    # Usuarios: un admin y USUARIOS_BENCH usuarios normales (todos con la misma contraseña)
+    hash_bench = generate_password_hash(PASSWORD_BENCH)
+    usuarios = [('bench_admin', hash_bench, 'Admin Bench', 'admin@bench.local', roles['admin'])]
+    usuarios += [(f'bench_usuario_{i}', hash_bench, f'Usuario Bench {i}', f'usuario{i}@bench.local', roles['usuario'])
+                 for i in range(USUARIOS_BENCH)]
+    cursor.executemany("INSERT INTO usuarios (username, password, nombre, email, rol_id) VALUES (%s, %s, %s, %s, %s)",
+                       usuarios)
+    cursor.execute("SELECT usuario_id FROM usuarios WHERE username LIKE 'bench_usuario_%' ORDER BY usuario_id")
+    usuarios_ids = [fila[0] for fila in cursor.fetchall()]
+
+    print(f"  {args.precios} precios...")
+    precios = []
+    for _ in range(args.precios):
+        cil_min = rnd.choice((2, 3, 4, 6, 8))
+        anio_min = rnd.randint(1950, 2020)
+        precios.append((rnd.choice(servicios), cil_min, cil_min + rnd.choice((0, 2, 4)),
+                        anio_min, anio_min + rnd.randint(0, 15),
+                        rnd.randint(300, 3000), rnd.randint(0, 80), round(rnd.random(), 2)))
+    insertar_por_lotes(cursor, """INSERT INTO servicio_precios
+                                  (servicio_id, cilindros_min, cilindros_max, anio_min, anio_max,
+                                   precio_base, precio_por_cilindro, precio_por_anio)
+                                  VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""", precios)
+
+    print(f"  {args.clientes} clientes...")
+    clientes = [(f'Cliente {i}', f'55{i:08d}', f'cliente{i}@bench.local') for i in range(args.clientes)]
+    insertar_por_lotes(cursor, "INSERT INTO clientes (nombre, telefono, correo) VALUES (%s, %s, %s)", clientes)
+    cursor.execute("SELECT MIN(cliente_id) FROM clientes")
+    primer_cliente = cursor.fetchone()[0]
+
+    def cliente_y_propietario():
+        # ~5% de los registros pertenecen a los usuarios del benchmark (para /usuario/citas)
+        i = rnd.randrange(args.clientes)
+        propietario = rnd.choice(usuarios_ids) if rnd.random() < 0.05 else None
+        return i, primer_cliente + i, propietario
+
+    print(f"  {args.cotizaciones} cotizaciones...")
+    cotizaciones = []
+    renglones_por_cotizacion = []
+    for _ in range(args.cotizaciones):
+        i, cliente_id, propietario = cliente_y_propietario()
+        marca_id, marca = rnd.choice(marcas)
+        año_id, año = rnd.choice(años)
+        elegidos = rnd.sample(servicios, rnd.randint(1, 3))
+        precios_renglones = [round(rnd.uniform(300, 5000), 2) for _ in elegidos]
+        enviada = datetime.now() - timedelta(days=rnd.randint(0, DIAS_PASADOS), minutes=rnd.randint(0, 1440))
+        cotizaciones.append((f'Cliente {i}', f'55{i:08d}', f'cliente{i}@bench.local', cliente_id,
+                             'Servicios', elegidos[0], marca, marca_id, 'Modelo', año, año_id,
+                             rnd.choice((4, 6, 8)), '', sum(precios_renglones), enviada, propietario, propietario))
+        renglones_por_cotizacion.append(list(zip(elegidos, precios_renglones)))
+    insertar_por_lotes(cursor, """INSERT INTO cotizaciones
+                                  (nombre, telefono, email, cliente_id, servicio, servicio_id, marca_vehiculo, marca_id,
+                                   modelo_vehiculo, anio_vehiculo, año_id, cilindros, mensaje, precio_calculado,
+                                   fecha_envio, usuario_id, propietario_id)
+                                  VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                       cotizaciones)
+    cursor.execute("SELECT MIN(cotizacion_id) FROM cotizaciones")
+    primera_cotizacion = cursor.fetchone()[0]
+    renglones = [(primera_cotizacion + n, servicio_id, precio)
+                 for n, elegidos in enumerate(renglones_por_cotizacion) for servicio_id, precio in elegidos]
+    insertar_por_lotes(cursor, "INSERT INTO cotizaciones_servicios (cotizacion_id, servicio_id, precio_calculado) VALUES (%s, %s, %s)",
+                       renglones)
+
+    print(f"  {args.citas} citas...")
+    citas = []
+    servicios_por_cita = []
+    hoy = date.today()
+    for _ in range(args.citas):
+        i, cliente_id, propietario = cliente_y_propietario()
+        fecha = hoy + timedelta(days=rnd.randint(-DIAS_PASADOS, DIAS_FUTUROS))
+        elegidos = rnd.sample(servicios, rnd.randint(1, 2))
+        citas.append((f'Cliente {i}', f'55{i:08d}', f'cliente{i}@bench.local', cliente_id, fecha,
+                      f'{rnd.randint(7, 16):02d}:{rnd.choice((0, 30)):02d}', 'Servicios', elegidos[0],
+                      propietario, propietario, rnd.choice(('Pendiente', 'Confirmada', 'Completada', 'Cancelada'))))
+        servicios_por_cita.append(elegidos)
+    insertar_por_lotes(cursor, """INSERT INTO citas
+                                  (nombre, telefono, email, cliente_id, fecha, hora, servicio, servicio_id,
+                                   usuario_id, propietario_id, estatus)
+                                  VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", citas)
+    cursor.execute("SELECT MIN(cita_id) FROM citas")
+    primera_cita = cursor.fetchone()[0]
+    insertar_por_lotes(cursor, "INSERT INTO citas_servicios (cita_id, servicio_id) VALUES (%s, %s)",
+                       [(primera_cita + n, servicio_id)
+                        for n, elegidos in enumerate(servicios_por_cita) for servicio_id in elegidos])
+
+    conn.commit()
+    conn.close()
+
+
+# ============================================
+# SERVIDOR SMTP FALSO
+# ============================================
+
+class ManejadorSMTP(socketserver.StreamRequestHandler):
+    """Habla lo mínimo de SMTP para que Flask-Mail crea que envió el correo; no guarda nada."""
+
+    def responder(self, texto):
+        self.wfile.write((texto + '\r\n').encode())
+
+    def handle(self):
+        self.responder('220 bench.local SMTP falso')
+        while True:
+            linea = self.rfile.readline()
+            if not linea:
+                return
+            comando = linea.decode('utf-8', 'replace').strip().upper()
+            if comando.startswith('EHLO'):
+                self.responder('250-bench.local')
+                self.responder('250 8BITMIME')
+            elif comando.startswith('DATA'):
+                self.responder('354 Termina con <CRLF>.<CRLF>')
+                while True:
+                    linea = self.rfile.readline()
+                    if not linea or linea in (b'.\r\n', b'.\n'):
+                        break
+                with self.server.lock:
+                    self.server.recibidos += 1
+                self.responder('250 OK')
+            elif comando.startswith('QUIT'):
+                self.responder('221 Adiós')
+                return
+            else:
+                # HELO, MAIL FROM, RCPT TO, RSET, NOOP...
+                self.responder('250 OK')
+
+class ServidorSMTPFalso(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ManejadorSMTP)
+        self.lock = threading.Lock()
+        self.recibidos = 0
+
+    @property
+    def puerto(self):
+        return self.server_address[1]
+
+
+# ============================================
+# CLIENTE HTTP Y ESCENARIOS
+# ============================================
+
+class Cliente:
+    """Una conexión HTTP persistente con su propia cookie de sesión (un "navegador")."""
+
+    def __init__(self, puerto):
+        self.puerto = puerto
+        self.conexion = http.client.HTTPConnection('127.0.0.1', puerto, timeout=60)
+        self.cookie = None
+
+    def pedir(self, metodo, ruta, datos=None):
+        cuerpo = urlencode(datos, doseq=True) if datos is not None else None
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if cuerpo is not None else {}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        try:
+            self.conexion.request(metodo, ruta, body=cuerpo, headers=headers)
+            respuesta = self.conexion.getresponse()
+        except (http.client.HTTPException, OSError):
+            # El servidor cerró la conexión persistente: se abre otra y se reintenta una vez
+            self.conexion.close()
+            self.conexion = http.client.HTTPConnection('127.0.0.1', self.puerto, timeout=60)
+            self.conexion.request(metodo, ruta, body=cuerpo, headers=headers)
+            respuesta = self.conexion.getresponse()
+        respuesta.read()
+        cookie = respuesta.getheader('Set-Cookie')
+        if cookie and cookie.startswith('session='):
+            self.cookie = cookie.split(';', 1)[0]
+        return respuesta.status
+
+    def iniciar_sesion(self, username):
+        self.pedir('POST', '/login', {'username': username, 'password': PASSWORD_BENCH})
+        if not self.cookie:
+            raise RuntimeError(f"No se pudo iniciar sesión como {username}")
+
+    def cerrar(self):
+        self.conexion.close()
+
+class Horarios:
+    """Reparte horarios libres (días después de los datos sembrados) entre los hilos."""
+
+    def __init__(self, desde):
+        self._lock = threading.Lock()
+        self._desde = desde
+        self._n = 0
+
+    def siguiente(self):
+        with self._lock:
+            n = self._n
+            self._n += 1
+        dia, slot = divmod(n, len(HORAS_CITAS))
+        return (self._desde + timedelta(days=dia)).isoformat(), f'{HORAS_CITAS[slot]:02d}:00'
+
+    def dia_completo(self):
+        """Un día que ningún otro hilo va a usar (para la prueba de doble reserva)."""
+        with self._lock:
+            dia = -(-self._n // len(HORAS_CITAS))  # Primer día del que no se ha dado ningún horario
+            self._n = (dia + 1) * len(HORAS_CITAS)
+        return (self._desde + timedelta(days=dia)).isoformat()
+
+def formulario_invitado(rnd):
+    i = rnd.randrange(1_000_000)
+    return {'nombre': f'Invitado {i}', 'telefono': f'56{i:08d}', 'email': f'invitado{i}@bench.local'}
+
+def escenarios(horarios, años):
+    """
+    Cada escenario es (preparar, petición):
+    - preparar(cliente, n) se llama una vez por hilo (p. ej. para iniciar sesión).
+    - petición(rnd) regresa (método, ruta, datos) de la siguiente petición.
+    """
+    hoy = date.today()
+
+    def sin_preparar(cliente, n):
+        pass
+
+    def como_usuario(cliente, n):
+        cliente.iniciar_sesion(f'bench_usuario_{n % USUARIOS_BENCH}')
+
+    def como_admin(cliente, n):
+        cliente.iniciar_sesion('bench_admin')
+
+    def calcular_precio(rnd):
+        return 'POST', '/calcular_precio', {'servicio_id': rnd.randint(1, 6), 'anio': rnd.randint(1990, 2025),
+                                            'cilindros': rnd.choice((4, 6, 8))}
+
+    def horarios_disponibles(rnd):
+        fecha = hoy + timedelta(days=rnd.randint(-30, DIAS_FUTUROS))
+        return 'GET', f'/api/horarios_disponibles/{fecha.isoformat()}', None
+
+    def citas_post(rnd):
+        fecha, hora = horarios.siguiente()
+        datos = formulario_invitado(rnd)
+        datos.update({'fecha': fecha, 'hora': hora, 'servicio_id[]': rnd.sample(range(1, 7), rnd.randint(1, 3))})
+        return 'POST', '/citas', datos
+
+    def cotizaciones_post(rnd):
+        datos = formulario_invitado(rnd)
+        datos.update({'servicio_id[]': rnd.sample(range(1, 7), rnd.randint(1, 4)), 'marca_vehiculo': 'Toyota',
+                      'modelo_vehiculo': 'Corolla', 'año_id': rnd.choice(años), 'cilindros': rnd.choice((4, 6, 8)),
+                      'mensaje': 'benchmark'})
+        return 'POST', '/cotizaciones', datos
+
+    def usuario_citas(rnd):
+        return 'GET', '/usuario/citas', None
+
+    def admin_citas(rnd):
+        return 'GET', '/admin/citas', None
+
+    return {
+        'calcular_precio': (sin_preparar, calcular_precio),
+        'horarios_disponibles': (sin_preparar, horarios_disponibles),
+        'citas_post': (sin_preparar, citas_post),
+        'cotizaciones_post': (sin_preparar, cotizaciones_post),
+        'usuario_citas': (como_usuario, usuario_citas),
+        'admin_citas': (como_admin, admin_citas)
+    }
+
+def percentil(ordenados, p):
+    """Percentil por rango más cercano de una lista ya ordenada."""
+    if not ordenados:
+        return 0.0
+    k = max(0, min(len(ordenados) - 1, math.ceil(p / 100 * len(ordenados)) - 1))
+    return ordenados[k]
+
+def correr_escenario(puerto, nombre, preparar, peticion, args):
+    """Lanza args.concurrencia hilos durante args.duracion segundos y resume las latencias."""
+    latencias = []
+    errores = [0]
+    lock = threading.Lock()
+    listos = threading.Barrier(args.concurrencia + 1)
+    fin = [0.0]
+    medir_desde = [0.0]
+
+    def trabajador(n):
+        rnd = random.Random(f'{args.semilla}-{nombre}-{n}')
+        cliente = Cliente(puerto)
+        try:
+            preparar(cliente, n)
+        finally:
+            listos.wait()
+        propias = []
+        fallidas = 0
+        while True:
+            metodo, ruta, datos = peticion(rnd)
+            inicio = perf_counter()
+            if inicio >= fin[0]:
+                break
+            try:
+                estatus = cliente.pedir(metodo, ruta, datos)
+            except (http.client.HTTPException, OSError):
+                estatus = 599
+            termino = perf_counter()
+            if inicio >= medir_desde[0]:
+                propias.append(termino - inicio)
+                if estatus >= 400:
+                    fallidas += 1
+        cliente.cerrar()
+        with lock:
+            latencias.extend(propias)
+            errores[0] += fallidas
+
+    hilos = [threading.Thread(target=trabajador, args=(n,), daemon=True) for n in range(args.concurrencia)]
+    for hilo in hilos:
+        hilo.start()
+    listos.wait()
+    inicio = perf_counter()
+    medir_desde[0] = inicio + args.calentamiento
+    fin[0] = medir_desde[0] + args.duracion
+    for hilo in hilos:
+        hilo.join()
+
+    latencias.sort()
+    return {
+        'peticiones': len(latencias),
+        'errores': errores[0],
+        'por_segundo': round(len(latencias) / args.duracion, 2),
+        'p50_ms': round(percentil(latencias, 50) * 1000, 2),
+        'p95_ms': round(percentil(latencias, 95) * 1000, 2),
+        'p99_ms': round(percentil(latencias, 99) * 1000, 2)
+    }
+
+
+# ============================================
+# PRUEBA DE DOBLE RESERVA
+# ============================================
+
+def prueba_doble_reserva(puerto, horarios, args, separacion):
+    """
+    En cada ronda varios hilos mandan a la vez citas para el mismo día en
+    horarios que se enciman (HORAS_RESERVA: 10:00 contra 9:30, 10:30...) y se
+    revisa en la BD que ninguna de las citas guardadas quede a menos de
+    `separacion` minutos de otra (y que se haya guardado al menos una).
+    Regresa las rondas fallidas.
+    """
+    fallidas = []
+    conn = mysql.connector.connect(**config_mysql())
+    for ronda in range(args.rondas_reserva):
+        fecha = horarios.dia_completo()
+        salida = threading.Barrier(args.concurrencia)
+
+        def intentar(n):
+            rnd = random.Random(f'reserva-{ronda}-{n}')
+            cliente = Cliente(puerto)
+            datos = formulario_invitado(rnd)
+            datos.update({'fecha': fecha, 'hora': HORAS_RESERVA[n % len(HORAS_RESERVA)], 'servicio_id[]': [1]})
+            salida.wait()
+            try:
+                cliente.pedir('POST', '/citas', datos)
+            finally:
+                cliente.cerrar()
+
+        hilos = [threading.Thread(target=intentar, args=(n,)) for n in range(args.concurrencia)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+        conn.commit()  # Para leer lo último (REPEATABLE READ)
+        cursor = conn.cursor()
+        cursor.execute("SELECT hora FROM citas WHERE fecha = %s ORDER BY hora", (fecha,))
+        minutos = [int(hora.total_seconds()) // 60 for (hora,) in cursor.fetchall()]
+        cursor.close()
+        # Ordenadas por hora, basta revisar cada cita contra la siguiente
+        encimadas = [(a, b) for a, b in zip(minutos, minutos[1:]) if b - a < separacion]
+        if not minutos or encimadas:
+            fallidas.append({'fecha': fecha, 'horas': [f'{m // 60:02d}:{m % 60:02d}' for m in minutos]})
+    conn.close()
+    return fallidas
+
+
+# ============================================
+# BASELINES
+# ============================================
+
+def commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def ruta_baseline(nombre):
+    return os.path.join(CARPETA_BASELINES, f'{nombre}.json')
+
+def guardar_baseline(nombre, corrida):
+    os.makedirs(CARPETA_BASELINES, exist_ok=True)
+    with open(ruta_baseline(nombre), 'w', encoding='utf-8') as f:
+        json.dump(corrida, f, indent=2, ensure_ascii=False)
+    print(f"\nBaseline guardado en {ruta_baseline(nombre)}")
+
+def comparar_baseline(nombre, resultados, tolerancia):
+    """Imprime la diferencia contra el baseline; regresa los escenarios que empeoraron más que la tolerancia."""
+    with open(ruta_baseline(nombre), encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nComparación contra '{nombre}' (commit {baseline.get('commit')}, {baseline.get('fecha')}):")
+    print(f"{'escenario':<22}{'req/s':>18}{'p95 ms':>20}{'p99 ms':>20}")
+    empeoraron = []
+    for escenario, actual in resultados.items():
+        anterior = baseline['resultados'].get(escenario)
+        if not anterior:
+            continue
+
+        def cambio(clave):
+            return (actual[clave] - anterior[clave]) / anterior[clave] if anterior[clave] else 0.0
+
+        print(f"{escenario:<22}"
+              f"{anterior['por_segundo']:>8} → {actual['por_segundo']:<7}"
+              f"{anterior['p95_ms']:>9} → {actual['p95_ms']:<8}"
+              f"{anterior['p99_ms']:>9} → {actual['p99_ms']:<8}"
+              f"  ({cambio('p95_ms'):+.0%} p95)")
+        if cambio('p95_ms') > tolerancia or cambio('por_segundo') < -tolerancia:
+            empeoraron.append(escenario)
+    return empeoraron
+
+
+# ============================================
+# PROGRAMA PRINCIPAL
+# ============================================
+
+def leer_argumentos():
+    parser = argparse.ArgumentParser(description='Pruebas de carga del taller contra una base de MySQL local.')
+    parser.add_argument('--escenarios', default='calcular_precio,horarios_disponibles,citas_post,cotizaciones_post,usuario_citas,admin_citas',
+                        help='Escenarios separados por coma')
+    parser.add_argument('-c', '--concurrencia', type=int, default=16, help='Hilos que mandan peticiones a la vez')
+    parser.add_argument('-d', '--duracion', type=float, default=20, help='Segundos medidos por escenario')
+    parser.add_argument('--calentamiento', type=float, default=3, help='Segundos iniciales que no se miden')
+    parser.add_argument('--semilla', type=int, default=42, help='Semilla de los datos y peticiones aleatorias')
+    parser.add_argument('--clientes', type=int, default=20000)
+    parser.add_argument('--citas', type=int, default=30000)
+    parser.add_argument('--cotizaciones', type=int, default=30000)
+    parser.add_argument('--precios', type=int, default=2000, help='Filas extra de servicio_precios')
+    parser.add_argument('--sin-sembrar', action='store_true', help='Reusar la base de pruebas de la corrida anterior')
+    parser.add_argument('--rondas-reserva', type=int, default=20, help='Rondas de la prueba de doble reserva (0 la omite)')
+    parser.add_argument('--guardar-baseline', metavar='NOMBRE', help='Guardar los resultados como baseline')
+    parser.add_argument('--comparar', metavar='NOMBRE', help='Comparar contra un baseline guardado')
+    parser.add_argument('--tolerancia', type=float, default=0.15,
+                        help='Empeoramiento permitido de p95 o req/s al comparar (0.15 = 15%%)')
+    return parser.parse_args()
+
+def main():
+    args = leer_argumentos()
+    nombre_base = os.environ.setdefault('BENCH_DB_NAME', 'servicio_automotriz_bench')
+    if nombre_base == BASE_PRODUCCION:
+        sys.exit("BENCH_DB_NAME no puede ser la base real: el benchmark la borra y la vuelve a crear.")
+
+    if not args.sin_sembrar:
+        print(f"Creando la base {nombre_base}...")
+        inicio = perf_counter()
+        crear_base(nombre_base)
+        sembrar(args)
+        print(f"  lista en {perf_counter() - inicio:.1f} s")
+
+    smtp = ServidorSMTPFalso()
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+
+    # La aplicación lee su configuración al importarse, así que se ajusta antes
+    config = config_mysql(con_base=False)
+    os.environ.update({
+        'DB_HOST': config['host'],
+        'DB_PORT': str(config['port']),
+        'DB_USER': config['user'],
+        'DB_PASSWORD': config['password'],
+        'DB_NAME': nombre_base,
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': str(smtp.puerto),
+        'MAIL_USE_TLS': 'False',
+        'MAIL_USERNAME': '',
+        'MAIL_PASSWORD': '',
+        'MAIL_DEFAULT_SENDER': 'taller@bench.local',
+        'CORREO_INTERVALO': '1'
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, RAIZ)
+    import app as taller
+    from werkzeug.serving import make_server
+
+    # Se recalculan los contadores del panel para los datos sembrados
+    conn = taller.get_db_connection()
+    taller.recalcular_estadisticas(taller.get_cursor(conn))
+    conn.commit()
+    conn.close()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # Sin una línea por petición
+    servidor = make_server('127.0.0.1', 0, taller.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    puerto = servidor.server_port
+
+    conn = mysql.connector.connect(**config_mysql())
+    cursor = conn.cursor()
+    cursor.execute("SELECT año_id FROM años_vehiculos WHERE activo = 1")
+    años = [fila[0] for fila in cursor.fetchall()]
+    cursor.execute("SELECT MAX(fecha) FROM citas")
+    ultima = cursor.fetchone()[0] or date.today()
+    conn.close()
+    horarios = Horarios(max(ultima, date.today() + timedelta(days=DIAS_FUTUROS)) + timedelta(days=1))
+    disponibles = escenarios(horarios, años)
+
+    resultados = {}
+    print(f"\n{args.concurrencia} hilos, {args.duracion:g} s por escenario (+{args.calentamiento:g} s de calentamiento)\n")
+    print(f"{'escenario':<22}{'peticiones':>11}{'errores':>9}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for nombre in [e.strip() for e in args.escenarios.split(',') if e.strip()]:
+        if nombre not in disponibles:
+            sys.exit(f"Escenario desconocido: {nombre} (hay: {', '.join(disponibles)})")
+        r = correr_escenario(puerto, nombre, *disponibles[nombre], args)
+        resultados[nombre] = r
+        print(f"{nombre:<22}{r['peticiones']:>11}{r['errores']:>9}{r['por_segundo']:>10}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+    fallidas = []
+    if args.rondas_reserva:
+        print(f"\nDoble reserva: {args.rondas_reserva} rondas de {args.concurrencia} intentos a la vez "
+              f"en {', '.join(HORAS_RESERVA)}...")
+        fallidas = prueba_doble_reserva(puerto, horarios, args, taller.MINUTOS_ENTRE_CITAS)
+        if fallidas:
+            print(f"  ❌ {len(fallidas)} día(s) con citas a menos de {taller.MINUTOS_ENTRE_CITAS} minutos "
+                  f"(o ninguna cita): {fallidas[:5]}")
+        else:
+            print(f"  ✅ Ninguna cita quedó a menos de {taller.MINUTOS_ENTRE_CITAS} minutos de otra")
+
+    # Dar un momento a la cola para mandar los correos pendientes al SMTP falso
+    sleep(2)
+    print(f"\nCorreos recibidos por el SMTP falso: {smtp.recibidos}")
+
+    corrida = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit_actual(),
+        'parametros': {clave: valor for clave, valor in vars(args).items()
+                       if clave not in ('guardar_baseline', 'comparar', 'tolerancia')},
+        'resultados': resultados
+    }
+    empeoraron = comparar_baseline(args.comparar, resultados, args.tolerancia) if args.comparar else []
+    if args.guardar_baseline:
+        guardar_baseline(args.guardar_baseline, corrida)
+
+    servidor.shutdown()
+    smtp.shutdown()
+    taller.cola_correos.detener()
+
+    if empeoraron:
+        print(f"\n❌ Empeoraron más de {args.tolerancia:.0%}: {', '.join(empeoraron)}")
+    if fallidas or empeoraron:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Compila los archivos estáticos para producción.
+
+Copia todo lo de static/ a static/dist/ con una huella (hash del contenido)
+en el nombre (css/estilo.css -> dist/css/estilo.3f9a1c2b7d.css). Como el
+nombre cambia cada vez que cambia el archivo, la aplicación puede servirlos
+con caché de un año ("immutable") sin que nadie vea una versión vieja.
+
+Además:
+- Los CSS, JS y SVG se guardan también comprimidos (.gz y, si está instalado
+  el paquete brotli, .br) para no comprimirlos en cada request.
+- Las imágenes PNG/JPG se convierten a WebP y se generan versiones más
+  chicas (--anchos) en el formato original y en WebP, para el srcset que arma
+  imagen_responsiva() en las plantillas (necesita Pillow).
+- Las rutas url(...) dentro de los CSS se cambian por los nombres con huella.
+
+Todo queda descrito en static/dist/manifest.json, que app.py lee al arrancar
+para que url_for('static', ...) apunte a los archivos con huella. Si no
+existe el manifiesto, la aplicación sirve los archivos originales como siempre.
+
+Uso (desde la carpeta del proyecto, antes de arrancar o reiniciar la aplicación):
+
+    python herramientas/compilar_estaticos.py
+    python herramientas/compilar_estaticos.py --anchos 320 640 --calidad-webp 75
+
+Los archivos de compilaciones anteriores se conservan (los procesos que aún
+no se reinician los siguen anunciando); --limpiar los borra.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import sys
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CARPETA_STATIC = os.path.join(RAIZ, 'static')
+CARPETA_DIST = 'dist'  # Dentro de static/
+VERSION_MANIFIESTO = 1
+
+EXTENSIONES_COMPRIMIBLES = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map'}
+EXTENSIONES_IMAGEN = {'.png', '.jpg', '.jpeg'}
+FORMATOS_PIL = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG'}
+RE_URL_CSS = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def huella(contenido):
+    return hashlib.sha256(contenido).hexdigest()[:10]
+
+
+def nombre_con_huella(ruta, contenido, sufijo='', extension=None):
+    """css/estilo.css -> dist/css/estilo.<huella>.css (sufijo: '-320w'; extension: '.webp')."""
+    base, ext = posixpath.splitext(ruta)
+    return f'{CARPETA_DIST}/{base}{sufijo}.{huella(contenido)}{extension or ext}'
+
+
+def listar_archivos():
+    """Rutas relativas (con /) de todo lo que hay en static/, sin dist/."""
+    rutas = []
+    for carpeta, subcarpetas, archivos in os.walk(CARPETA_STATIC):
+        relativa = os.path.relpath(carpeta, CARPETA_STATIC).replace(os.sep, '/')
+        if relativa == '.':
+            subcarpetas[:] = [s for s in subcarpetas if s != CARPETA_DIST]
+        for archivo in archivos:
+            if archivo.startswith('.'):
+                continue
+            rutas.append(archivo if relativa == '.' else f'{relativa}/{archivo}')
+    return sorted(rutas)
+
+
+class Compilador:
+    def __init__(self, destino, anchos, calidad_webp, calidad_jpeg):
+        self.destino = destino  # static/dist
+        self.anchos = sorted(anchos)
+        self.calidad_webp = calidad_webp
+        self.calidad_jpeg = calidad_jpeg
+        self.manifiesto = {'version': VERSION_MANIFIESTO, 'archivos': {}, 'imagenes': {}, 'comprimidos': {}}
+        self.bytes_originales = 0
+        self.bytes_servidos = 0
+
+    def _escribir(self, ruta_dist, contenido):
+        ruta = os.path.join(self.destino, *ruta_dist.split('/')[1:])
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with open(ruta, 'wb') as archivo:
+            archivo.write(contenido)
+
+    def _comprimir(self, ruta_dist, contenido):
+        """Guarda .gz y .br junto al archivo, solo si de verdad son más chicos."""
+        codificaciones = []
+        variantes = [('gzip', '.gz', gzip.compress(contenido, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variantes.insert(0, ('br', '.br', brotli.compress(contenido, quality=11)))
+        for codificacion, extension, comprimido in variantes:
+            if len(comprimido) < len(contenido) * 0.9:
+                self._escribir(ruta_dist + extension, comprimido)
+                codificaciones.append(codificacion)
+        if codificaciones:
+            self.manifiesto['comprimidos'][ruta_dist] = codificaciones
+
+    def copiar(self, ruta, contenido):
+        ruta_dist = nombre_con_huella(ruta, contenido)
+        self._escribir(ruta_dist, contenido)
+        self.manifiesto['archivos'][ruta] = ruta_dist
+        if posixpath.splitext(ruta)[1].lower() in EXTENSIONES_COMPRIMIBLES:
+            self._comprimir(ruta_dist, contenido)
+        return ruta_dist
+
+    @staticmethod
+    def _codificar(imagen, formato, calidad):
+        salida = BytesIO()
+        if formato == 'WEBP':
+            imagen.save(salida, 'WEBP', quality=calidad, method=6)
+        elif formato == 'JPEG':
+            imagen.convert('RGB').save(salida, 'JPEG', quality=calidad, optimize=True, progressive=True)
+        else:
+            imagen.save(salida, 'PNG', optimize=True)
+        return salida.getvalue()
+
+    def imagen(self, ruta, contenido):
+        """Copia la imagen original y genera WebP y versiones más chicas."""
+        ruta_dist = self.copiar(ruta, contenido)
+        if Image is None:
+            return
+        ext = posixpath.splitext(ruta)[1].lower()
+        with Image.open(BytesIO(contenido)) as original:
+            original.load()
+            ancho, alto = original.size
+            if original.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+            info = {'ancho': ancho, 'alto': alto, 'original': ruta_dist, 'webp': None, 'variantes': []}
+
+            webp = self._codificar(original, 'WEBP', self.calidad_webp)
+            if len(webp) < len(contenido):
+                info['webp'] = nombre_con_huella(ruta, webp, extension='.webp')
+                self._escribir(info['webp'], webp)
+
+            for ancho_variante in self.anchos:
+                if ancho_variante >= ancho:
+                    break
+                alto_variante = max(1, round(alto * ancho_variante / ancho))
+                reducida = original.resize((ancho_variante, alto_variante), Image.LANCZOS)
+                variante = {'ancho': ancho_variante}
+                for clave, formato, calidad, extension in (('original', FORMATOS_PIL[ext], self.calidad_jpeg, None),
+                                                           ('webp', 'WEBP', self.calidad_webp, '.webp')):
+                    codificada = self._codificar(reducida, formato, calidad)
+                    variante[clave] = nombre_con_huella(ruta, codificada, f'-{ancho_variante}w', extension)
+                    self._escribir(variante[clave], codificada)
+                info['variantes'].append(variante)
+        self.manifiesto['imagenes'][ruta] = info
+
+    def css(self, ruta, contenido):
+        """Cambia url(...) por los nombres con huella (relativos a dist/) antes de copiar."""
+        carpeta = posixpath.dirname(ruta)
+        archivos = self.manifiesto['archivos']
+
+        def reemplazar(coincidencia):
+            comillas, url = coincidencia.groups()
+            if url.startswith(('data:', 'http:', 'https:', '//', '#')):
+                return coincidencia.group(0)
+            limpia = url.partition('?')[0]
+            destino = posixpath.normpath(posixpath.join(carpeta, limpia)) if not limpia.startswith('/') else None
+            if destino not in archivos:
+                return coincidencia.group(0)
+            relativa = posixpath.relpath(archivos[destino], posixpath.join(CARPETA_DIST, carpeta))
+            return f'url({comillas}{relativa}{comillas})'
+
+        texto = RE_URL_CSS.sub(reemplazar, contenido.decode('utf-8'))
+        return self.copiar(ruta, texto.encode('utf-8'))
+
+    def compilar(self):
+        rutas = listar_archivos()
+        # Primero todo lo que no es CSS, para que los url() de los CSS ya tengan a dónde apuntar
+        rutas.sort(key=lambda ruta: ruta.lower().endswith('.css'))
+        for ruta in rutas:
+            with open(os.path.join(CARPETA_STATIC, *ruta.split('/')), 'rb') as archivo:
+                contenido = archivo.read()
+            ext = posixpath.splitext(ruta)[1].lower()
+            try:
+                if ext in EXTENSIONES_IMAGEN:
+                    self.imagen(ruta, contenido)
+                elif ext == '.css':
+                    self.css(ruta, contenido)
+                else:
+                    self.copiar(ruta, contenido)
+            except Exception as e:
+                print(f"  ⚠️  {ruta}: {e} (se copia sin procesar)")
+                self.copiar(ruta, contenido)
+            self._resumir(ruta, len(contenido))
+        # El manifiesto va al final y de una sola vez: hasta ese momento la
+        # aplicación sigue usando los archivos anteriores
+        temporal = os.path.join(self.destino, 'manifest.json.nuevo')
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            json.dump(self.manifiesto, archivo, indent=2, sort_keys=True, ensure_ascii=False)
+        os.replace(temporal, os.path.join(self.destino, 'manifest.json'))
+
+    def limpiar(self):
+        """Borra de dist/ lo que ya no está en el manifiesto (huellas viejas). Retorna cuántos archivos borró."""
+        vigentes = set(self.manifiesto['archivos'].values())
+        for info in self.manifiesto['imagenes'].values():
+            vigentes.add(info['webp'])
+            for variante in info['variantes']:
+                vigentes.update((variante['original'], variante['webp']))
+        for ruta_dist, codificaciones in self.manifiesto['comprimidos'].items():
+            vigentes.update(ruta_dist + ('.br' if codificacion == 'br' else '.gz') for codificacion in codificaciones)
+        borrados = 0
+        for carpeta, _, archivos in os.walk(self.destino):
+            for archivo in archivos:
+                relativa = os.path.relpath(os.path.join(carpeta, archivo), self.destino).replace(os.sep, '/')
+                if relativa != 'manifest.json' and f'{CARPETA_DIST}/{relativa}' not in vigentes:
+                    os.remove(os.path.join(carpeta, archivo))
+                    borrados += 1
+        return borrados
+
+    def _resumir(self, ruta, tamano):
+        """Muestra cuánto pesa lo que recibe un navegador moderno (WebP / br o gzip)."""
+        imagen = self.manifiesto['imagenes'].get(ruta)
+        ruta_dist = self.manifiesto['archivos'][ruta]
+        if imagen and imagen['webp']:
+            servido = os.path.getsize(os.path.join(self.destino, *imagen['webp'].split('/')[1:]))
+        elif ruta_dist in self.manifiesto['comprimidos']:
+            extension = '.br' if 'br' in self.manifiesto['comprimidos'][ruta_dist] else '.gz'
+            servido = os.path.getsize(os.path.join(self.destino, *(ruta_dist + extension).split('/')[1:]))
+        else:
+            servido = tamano
+        self.bytes_originales += tamano
+        self.bytes_servidos += servido
+        extra = f", {len(imagen['variantes'])} tamaños" if imagen else ''
+        print(f"  {ruta:45} {tamano / 1024:8.1f} KB -> {servido / 1024:8.1f} KB{extra}")
+
+
+def leer_argumentos():
+    parser = argparse.ArgumentParser(description='Compila static/ a static/dist/ con huellas, compresión e imágenes WebP.')
+    parser.add_argument('--anchos', type=int, nargs='+', default=[320, 640, 960],
+                        help='Anchos (px) de las versiones reducidas de las imágenes')
+    parser.add_argument('--calidad-webp', type=int, default=80)
+    parser.add_argument('--calidad-jpeg', type=int, default=82)
+    parser.add_argument('--limpiar', action='store_true',
+                        help='Borrar las versiones anteriores (hacerlo cuando ya se reiniciaron todos los procesos)')
+    return parser.parse_args()
+
+
+def main():
+    args = leer_argumentos()
+    if Image is None:
+        print("⚠️  Pillow no está instalado: las imágenes se copian sin WebP ni versiones reducidas")
+    if brotli is None:
+        print("⚠️  brotli no está instalado: solo se genera .gz")
+
+    # Los archivos viejos se quedan (tienen otro nombre), así los procesos que
+    # todavía no se reinician siguen encontrando los que anuncia su manifiesto
+    compilador = Compilador(os.path.join(CARPETA_STATIC, CARPETA_DIST), args.anchos, args.calidad_webp, args.calidad_jpeg)
+    print(f"Compilando {CARPETA_STATIC} ...")
+    compilador.compilar()
+    if args.limpiar:
+        print(f"Se borraron {compilador.limpiar()} archivos de versiones anteriores")
+
+    total = len(compilador.manifiesto['archivos'])
+    print(f"\n{total} archivos en static/{CARPETA_DIST}/: "
+          f"{compilador.bytes_originales / 1024:.1f} KB -> {compilador.bytes_servidos / 1024:.1f} KB servidos")
+    print("Reinicia la aplicación para que use el nuevo manifiesto.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
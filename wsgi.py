@@ -0,0 +1,12 @@
+"""
+Punto de entrada WSGI para producción.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Con preload_app (ver gunicorn.conf.py) este módulo se importa una sola vez
+en el proceso principal, antes de crear los workers.
+"""
+
+from app import crear_app
+
+app = crear_app(precarga=True)